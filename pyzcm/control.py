@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Control socket for reconfiguring a running miner
+
+The control server accepts JSON messages separated by newlines, in
+the same request/response form as the stratum protocol:
+
+    {"id": 1, "method": "add_server", "params": ["stratum+tcp://..."]}
+    {"id": 1, "result": true, "error": null}
+
+Commands are applied to the running ServerSwitcher and MinerManager,
+i.e. without restarting solvers and their backend processes.
+
+The socket is either a unix socket path or [host:]port (localhost is
+used when host is omitted). The commands are not authenticated, TCP
+sockets are therefore bound to loopback addresses only. Run
+'python -m pyzcm.control ADDRESS METHOD [PARAMS]...' to send a command.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import re
+import socket
+import stat
+import sys
+import time
+
+
+def parse_address(address):
+    """Parses the control socket address
+
+    @return tuple (host, port) for TCP or (path, None) for unix sockets
+    """
+    x = re.match(r'^((?P<host>[^/]*):)?(?P<port>\d+)$', address)
+    if x is None:
+        return (address, None)
+    return (x.group('host') or 'localhost', int(x.group('port')))
+
+
+def is_loopback(host):
+    """@return True if all addresses of the host are loopback ones"""
+    try:
+        addresses = [ipaddress.ip_address(info[4][0].split('%')[0])
+                     for info in socket.getaddrinfo(host, None)]
+    except (OSError, ValueError):
+        return False
+    return bool(addresses) and all(a.is_loopback for a in addresses)
+
+
+def parse_governor_policy(name, value):
+    """Converts the value of a governor policy sent by a client
+
+    @return the value to be set on the Governor
+    """
+    if name == 'adaptive':
+        if value in (True, False, 0, 1) and not isinstance(value, float):
+            return bool(value)
+        raise ValueError('adaptive requires true or false: {}'.format(value))
+    if name not in ('cpu_share', 'max_hash_rate'):
+        raise ValueError('Unknown governor policy: {}'.format(name))
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError('{0} requires a number: {1}'.format(name, value))
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('{0} requires a number: {1}'.format(name, value))
+    if not value > 0 or (name == 'cpu_share' and value > 1):
+        raise ValueError('{0} out of range: {1}'.format(name, value))
+    return value
+
+
+class ControlServer(object):
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'ControlServer'))
+
+    def __init__(self, loop, switcher, server_factory):
+        """
+        @param switcher - ServerSwitcher to be controlled along with its
+        MinerManager
+        @param server_factory - creates Server from a connection string
+        """
+        self.loop = loop
+        self.switcher = switcher
+        self.miners = switcher.miners
+        self.server_factory = server_factory
+        # the listening server has to be referenced while running
+        self.server = None
+        self.methods = {name[len('cmd_'):]: getattr(self, name)
+                        for name in dir(self) if name.startswith('cmd_')}
+
+    async def start(self, address):
+        (host, port) = parse_address(address)
+        if port is None:
+            # remove a stale socket of a previous run
+            if os.path.exists(host) and stat.S_ISSOCK(os.stat(host).st_mode):
+                os.unlink(host)
+            self.server = await asyncio.start_unix_server(self.handle_client,
+                                                          path=host)
+        else:
+            if not is_loopback(host):
+                raise ValueError('Control socket has to be bound to a ' \
+                                 'loopback address: {}'.format(host))
+            self.server = await asyncio.start_server(self.handle_client,
+                                                     host, port)
+        self.log.info('Listening for control commands on {}'.format(address))
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                data = await reader.readline()
+                if data == b'':
+                    break
+                response = self.dispatch(data)
+                writer.write('{}\n'.format(json.dumps(response)).encode())
+                await writer.drain()
+        except Exception as e:
+            self.log.warn('Control connection failed: {}'.format(e))
+        finally:
+            writer.close()
+
+    def dispatch(self, data):
+        msg_id = None
+        try:
+            msg = json.loads(data.decode())
+            msg_id = msg.get('id')
+            try:
+                method = self.methods[msg['method']]
+            except KeyError:
+                raise ValueError('Unknown method: {}'.format(msg.get('method')))
+            self.log.info('Control command: {0}{1}'.format(
+                msg['method'], tuple(msg.get('params', []))))
+            result = method(*msg.get('params', []))
+            return {'id': msg_id, 'result': result, 'error': None}
+        except Exception as e:
+            self.log.warn('Control command failed: {}'.format(e))
+            return {'id': msg_id, 'result': None, 'error': str(e)}
+
+    def cmd_state(self):
+        """Current servers and miners"""
+        selector = self.switcher.selector
+        servers = []
+        for s in self.switcher.servers:
+            servers.append({
+                'tag': s.tag,
+                'host': s.host,
+                'port': s.port,
+                'username': s.username,
+                'tls': s.tls,
+                'solo': s.solo,
+                'active': s is selector.active,
+                'healthy': selector.is_healthy(s),
+                'rtt': s.stats.rtt,
+                'stratum_rtt': s.stats.stratum_rtt,
+                'failure_count': s.stats.failure_count,
+                'quarantine_until': s.stats.quarantine_until,
+            })
+        miners = []
+        for m in self.miners.miners:
+            miners.append({
+                'id': m.miner_id,
+                'name': format(m, 's'),
+                'worker': self.miners.get_worker(m),
+                'paused': m.paused,
+                'duty_cycle': m.duty_cycle,
+                'instances': getattr(m, 'instances', 1),
+                'hash_rate': m.stats.hash_rate,
+                'accepted': m.stats.accepted_share_count,
+                'rejected': m.stats.rejected_share_count,
+                'invalid': m.stats.invalid_solution_count,
+                'duplicate': m.stats.duplicate_solution_count,
+                'stale': m.stats.stale_share_count,
+                'lost': m.stats.lost_share_count,
+                'found': m.stats.found_share_count,
+                'expected': m.stats.expected_share_count,
+                'effective_hash_rate': m.stats.effective_hash_rate(
+                    time.time() - (m.time_start or time.time())),
+            })
+        resources = self.miners.resources
+        stragglers = self.miners.stragglers
+        health = self.switcher.health
+        return {'servers': servers, 'miners': miners,
+                'governor': self.miners.governor.as_dict(),
+                'resources': resources.as_dict() if resources is not None
+                             else None,
+                'stragglers': stragglers.as_dict() if stragglers is not None
+                              else None,
+                'health': health.as_dict() if health is not None else None,
+                'alarms': sorted(self.miners.alarms)}
+
+    def cmd_add_server(self, url):
+        self.switcher.add_server(self.server_factory(url))
+        return True
+
+    def cmd_remove_server(self, tag):
+        self.switcher.remove_server(tag)
+        return True
+
+    def cmd_failover(self):
+        self.switcher.failover()
+        return True
+
+    def cmd_pause(self, *miner_ids):
+        """Pauses the specified miners, all of them when no ID is given"""
+        self.miners.pause(miner_ids)
+        return True
+
+    def cmd_resume(self, *miner_ids):
+        self.miners.resume(miner_ids)
+        return True
+
+    def cmd_scale_cpu(self, count):
+        self.miners.set_cpu_miner_count(int(count))
+        return True
+
+    def cmd_set_instances(self, count, *miner_ids):
+        """Number of solver instances of GPU miners"""
+        self.miners.set_gpu_instances(miner_ids, int(count))
+        return True
+
+    def cmd_duty_cycle(self, duty_cycle, *miner_ids):
+        """Duty cycle of the specified miners or of all miners when no ID
+        is given, null removes the setting"""
+        self.miners.set_duty_cycle(miner_ids, duty_cycle)
+        return True
+
+    def cmd_governor(self, name, value):
+        """Changes a governor policy: cpu_share, max_hash_rate (null =
+        unlimited) or adaptive"""
+        setattr(self.miners.governor, name,
+                parse_governor_policy(name, value))
+        return True
+
+    def cmd_log_level(self, level, logger=None):
+        """Sets level of a logger (root logger by default) in the main
+        process and in the backend processes of the miners"""
+        level = level.upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError('Unknown log level: {}'.format(level))
+        self.miners.set_log_level(level, logger)
+        return True
+
+
+def send_command(address, method, params):
+    """Sends a single command to the control server
+
+    @return the response message
+    """
+    (host, port) = parse_address(address)
+    if port is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(host)
+    else:
+        sock = socket.create_connection((host, port))
+    with sock, sock.makefile('rwb') as f:
+        msg = {'id': 1, 'method': method, 'params': params}
+        f.write('{}\n'.format(json.dumps(msg)).encode())
+        f.flush()
+        return json.loads(f.readline().decode())
+
+
+def main():
+    """Send a command to a running miner"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('address', help='Control socket path or [host:]port')
+    parser.add_argument('method', help='Command, e.g. state, add_server, ' \
+                        'remove_server, failover, pause, resume, scale_cpu, ' \
+                        'set_instances, duty_cycle, governor, log_level')
+    parser.add_argument('params', nargs='*', help='Command parameters')
+    args = parser.parse_args()
+
+    params = []
+    for p in args.params:
+        # numbers are passed as such, anything else as a string
+        try:
+            params.append(json.loads(p))
+        except ValueError:
+            params.append(p)
+    response = send_command(args.address, args.method, params)
+    if response['error'] is not None:
+        sys.stderr.write('Error: {}\n'.format(response['error']))
+        sys.exit(1)
+    print(json.dumps(response['result'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
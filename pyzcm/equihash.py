@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Equihash (200,9) solution verification
+
+The verifier checks solutions the same way as the zcash node does
+(distinct indices, index ordering, collisions on every level of the
+solution tree and XOR of all hashes being zero). The solution tree
+is evaluated with NumPy for all solutions of a header at once.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import hashlib
+import logging
+import random
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from pyzcm.miner.params import *
+
+EH_N = 200
+EH_K = 9
+# Bits that have to collide on each level of the solution tree
+EH_COLLISION_BIT_LENGTH = EH_N // (EH_K + 1)
+EH_INDEX_BIT_LENGTH = EH_COLLISION_BIT_LENGTH + 1
+EH_SOLUTION_INDICES = 2 ** EH_K
+EH_HASH_LENGTH = EH_N // 8
+# BLAKE2b output is split into multiple hashes
+EH_INDICES_PER_HASH_OUTPUT = 512 // EH_N
+EH_HASH_OUTPUT_LENGTH = EH_INDICES_PER_HASH_OUTPUT * EH_HASH_LENGTH
+EH_PERSONALIZATION = b'ZcashPoW' + struct.pack('<II', EH_N, EH_K)
+
+# How many recently submitted solutions are remembered for detecting
+# duplicates
+DEDUP_CACHE_SIZE = 1024
+
+_index_bit_weights = 1 << np.arange(EH_INDEX_BIT_LENGTH - 1, -1, -1,
+                                    dtype=np.uint32)
+
+
+def blake2b_state(header):
+    """Personalized BLAKE2b state with the header (incl. nonce) hashed in.
+
+    The state is copied for every hash index, so the header is
+    processed only once.
+    """
+    state = hashlib.blake2b(digest_size=EH_HASH_OUTPUT_LENGTH,
+                            person=EH_PERSONALIZATION)
+    state.update(header)
+    return state
+
+
+def generate_hashes(state, groups):
+    """Computes BLAKE2b outputs for the specified hash groups (index //
+    EH_INDICES_PER_HASH_OUTPUT)
+
+    @return uint8 array of shape (len(groups) * EH_INDICES_PER_HASH_OUTPUT,
+    EH_HASH_LENGTH) with hashes of indices of all groups
+    """
+    out = bytearray(len(groups) * EH_HASH_OUTPUT_LENGTH)
+    pack_into = struct.Struct('<I').pack_into
+    group_bytes = bytearray(4)
+    for i, group in enumerate(groups):
+        h = state.copy()
+        pack_into(group_bytes, 0, int(group))
+        h.update(group_bytes)
+        out[i * EH_HASH_OUTPUT_LENGTH:(i + 1) * EH_HASH_OUTPUT_LENGTH] = h.digest()
+    return np.frombuffer(out, dtype=np.uint8).reshape(-1, EH_HASH_LENGTH)
+
+
+def solution_to_indices(solutions):
+    """Expand minimal (bit packed) solutions into index arrays
+
+    @param solutions - uint8 array of shape (m, ZC_SOLUTION_LENGTH)
+    @return uint32 array of shape (m, EH_SOLUTION_INDICES)
+    """
+    bits = np.unpackbits(solutions, axis=1).reshape(
+        len(solutions), EH_SOLUTION_INDICES, EH_INDEX_BIT_LENGTH)
+    return bits.astype(np.uint32).dot(_index_bit_weights)
+
+
+def indices_to_solution(indices):
+    """Compress index arrays into the minimal form
+
+    @param indices - array of shape (m, EH_SOLUTION_INDICES)
+    @return uint8 array of shape (m, ZC_SOLUTION_LENGTH)
+    """
+    indices = np.asarray(indices, dtype=np.uint32)
+    bits = (indices[..., np.newaxis] & _index_bit_weights) != 0
+    return np.packbits(bits.reshape(len(indices), -1), axis=1)
+
+
+def verify_indices(header, indices):
+    """Checks that index arrays are valid Equihash solutions of header.
+
+    @param indices - array of shape (m, EH_SOLUTION_INDICES)
+    @return bool array of length m
+    """
+    indices = np.asarray(indices, dtype=np.uint32)
+    m = len(indices)
+    valid = np.ones(m, dtype=bool)
+
+    # All indices of a solution must be distinct
+    sorted_indices = np.sort(indices, axis=1)
+    valid &= (sorted_indices[:, 1:] != sorted_indices[:, :-1]).all(axis=1)
+
+    # Compute each BLAKE2b output only once for all solutions
+    groups, inverse = np.unique(indices // EH_INDICES_PER_HASH_OUTPUT,
+                                return_inverse=True)
+    hashes = generate_hashes(blake2b_state(header), groups)
+    rows = inverse.reshape(indices.shape) * EH_INDICES_PER_HASH_OUTPUT + \
+           indices % EH_INDICES_PER_HASH_OUTPUT
+    bits = np.unpackbits(hashes, axis=1)[rows]
+
+    for level in range(1, EH_K + 1):
+        # Left subtree must start with lower index than the right one
+        subtrees = indices.reshape(m, -1, 2 ** level)
+        valid &= (subtrees[:, :, 0] < subtrees[:, :, 2 ** (level - 1)]).all(axis=1)
+        bits = bits[:, 0::2] ^ bits[:, 1::2]
+        collision_bits = EH_N if level == EH_K else \
+                         level * EH_COLLISION_BIT_LENGTH
+        valid &= ~bits[:, :, :collision_bits].any(axis=(1, 2))
+    return valid
+
+
+def verify_solutions(header, solutions):
+    """Checks minimal solutions (without the length prefix) of header
+
+    @param solutions - sequence of ZC_SOLUTION_LENGTH bytes long
+    buffers
+    @return bool array
+    """
+    assert(len(header) == ZC_BLOCK_HEADER_LENGTH)
+    packed = np.array([np.frombuffer(s, dtype=np.uint8) for s in solutions],
+                      dtype=np.uint8).reshape(-1, ZC_SOLUTION_LENGTH)
+    return verify_indices(header, solution_to_indices(packed))
+
+
+class SolutionVerifier(object):
+    """Guards share submission against invalid and duplicate solutions.
+
+    Duplicates are detected for every share, Equihash verification is
+    performed for a configurable fraction of shares.
+    """
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'SolutionVerifier'))
+
+    VALID = 'valid'
+    INVALID = 'invalid'
+    DUPLICATE = 'duplicate'
+
+    def __init__(self, sample_rate=1.0, cache_size=DEDUP_CACHE_SIZE):
+        """
+        @param sample_rate - fraction of shares to be verified (1.0 =
+        every share)
+        """
+        self.sample_rate = sample_rate
+        self.cache_size = cache_size
+        self.seen = OrderedDict()
+        # solver instance threads of a GPU backend share the verifier
+        self.lock = threading.Lock()
+
+    def is_duplicate(self, header, len_and_solution):
+        key = hashlib.blake2b(header, digest_size=16)
+        key.update(len_and_solution)
+        key = key.digest()
+        with self.lock:
+            if key in self.seen:
+                self.seen.move_to_end(key)
+                return True
+            self.seen[key] = None
+            if len(self.seen) > self.cache_size:
+                self.seen.popitem(last=False)
+        return False
+
+    def check(self, header, len_and_solution):
+        """Checks a length prefixed solution of header
+
+        @return VALID, INVALID or DUPLICATE. Solutions that haven't
+        been sampled for verification are considered VALID
+        """
+        if self.is_duplicate(header, len_and_solution):
+            return self.DUPLICATE
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.VALID
+        solution = memoryview(len_and_solution)[len(ZC_SOLUTION_LENGTH_PREFIX):]
+        if not verify_solutions(header, [solution])[0]:
+            return self.INVALID
+        return self.VALID
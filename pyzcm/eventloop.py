@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Event loop selection
+
+The miner runs on the standard asyncio event loop by default. uvloop
+(a libuv based implementation) is used when selected and installed
+('pip install pyzcm[uvloop]').
+
+'python -m pyzcm.eventloop' compares the available event loops:
+- callbacks - throughput of scheduling callbacks
+- notifications - stratum-like JSON lines received and parsed per
+  second
+- request latency - round trip time of a stratum-like request over a
+  local connection (mean and 99th percentile)
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import argparse
+import asyncio
+import json
+import time
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+EVENT_LOOPS = ('asyncio', 'uvloop')
+DEFAULT_EVENT_LOOP = 'asyncio'
+
+# Size of a mining.notify message, the benchmark sends messages of
+# this size
+NOTIFY_PARAMS = ['0' * 16, '04000000', '0' * 64, '0' * 64, '0' * 64,
+                 '01020304', '0f0f0f1f', True]
+
+
+def available_event_loops():
+    return [name for name in EVENT_LOOPS if name != 'uvloop' or
+            uvloop is not None]
+
+
+def new_event_loop(name=DEFAULT_EVENT_LOOP):
+    """Creates an event loop of the selected implementation and sets it
+    as the current loop"""
+    if name == 'asyncio':
+        loop = asyncio.new_event_loop()
+    elif name == 'uvloop':
+        if uvloop is None:
+            raise ValueError('uvloop is not installed')
+        loop = uvloop.new_event_loop()
+    else:
+        raise ValueError('Unknown event loop: {}'.format(name))
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def measure_callbacks(loop, count):
+    """@return callbacks per second"""
+    done = loop.create_future()
+    remaining = [count]
+
+    def callback():
+        remaining[0] -= 1
+        if remaining[0] > 0:
+            loop.call_soon(callback)
+        else:
+            done.set_result(None)
+
+    t = time.perf_counter()
+    loop.call_soon(callback)
+    loop.run_until_complete(done)
+    return count / (time.perf_counter() - t)
+
+
+async def handle_benchmark_client(reader, writer):
+    """Responds to requests, 'notify' requests a burst of notifications"""
+    while True:
+        data = await reader.readline()
+        if data == b'':
+            break
+        msg = json.loads(data.decode())
+        if msg['method'] == 'notify':
+            notify = '{}\n'.format(json.dumps({
+                'id': None, 'method': 'mining.notify',
+                'params': NOTIFY_PARAMS})).encode()
+            writer.write(notify * msg['params'][0])
+        else:
+            writer.write('{}\n'.format(json.dumps({
+                'id': msg['id'], 'result': True, 'error': None})).encode())
+        await writer.drain()
+    writer.close()
+
+
+async def measure_stratum(count):
+    """@return tuple (notifications per second, mean request latency,
+    99th percentile of request latency)"""
+    finished = asyncio.Event()
+
+    async def handle_client(reader, writer):
+        await handle_benchmark_client(reader, writer)
+        finished.set()
+
+    server = await asyncio.start_server(handle_client, 'localhost', 0)
+    port = server.sockets[0].getsockname()[1]
+    (reader, writer) = await asyncio.open_connection('localhost', port)
+
+    t = time.perf_counter()
+    writer.write('{}\n'.format(json.dumps({
+        'id': 0, 'method': 'notify', 'params': [count]})).encode())
+    for i in range(count):
+        json.loads((await reader.readline()).decode())
+    notify_rate = count / (time.perf_counter() - t)
+
+    latencies = []
+    for i in range(count):
+        t = time.perf_counter()
+        writer.write('{}\n'.format(json.dumps({
+            'id': i, 'method': 'mining.submit', 'params': []})).encode())
+        json.loads((await reader.readline()).decode())
+        latencies.append(time.perf_counter() - t)
+    latencies.sort()
+
+    writer.close()
+    await finished.wait()
+    server.close()
+    await server.wait_closed()
+    return (notify_rate, sum(latencies) / count,
+            latencies[int(0.99 * (count - 1))])
+
+
+def main():
+    """Compare throughput and latency of the available event loops"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('-n', '--messages', default=10000, type=int,
+                        help='Number of messages of each measurement')
+    args = parser.parse_args()
+
+    if uvloop is None:
+        print('uvloop is not installed, measuring asyncio only')
+    for name in available_event_loops():
+        loop = new_event_loop(name)
+        try:
+            callback_rate = measure_callbacks(loop, args.messages * 10)
+            (notify_rate, latency, latency_99) = loop.run_until_complete(
+                measure_stratum(args.messages))
+        finally:
+            loop.close()
+        print('{0}: callbacks: {1:.0f}/s, notifications: {2:.0f}/s, ' \
+              'request latency: {3:.01f} us (99%: {4:.01f} us)'.format(
+                  name, callback_rate, notify_rate, latency * 1e6,
+                  latency_99 * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Resource governor that paces miners
+
+The governor limits the resources used by the miners by setting their
+duty cycle - a fraction of time spent solving (see
+GenericMiner.pace()). The duty cycle of a miner is the lowest of the
+limits imposed by the policies below:
+
+- fixed duty cycle - for all miners or individual ones
+- CPU share - CPU miners use at most the specified fraction of all
+  host CPU's (measured as CPU time of the miner process)
+- hashrate cap - total solution rate of all miners
+- host load - the miners back off when other workloads wait for the
+  CPU. CPU pressure stall information (PSI) is used when available,
+  otherwise load average reduced by the miner's own CPU usage. The
+  limit is halved on overload and recovers in small steps afterwards.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import time
+
+from pyzcm.miner.cpu import CpuMiner
+
+# Period of re-evaluating the limits
+GOVERNOR_PERIOD = 10
+MIN_DUTY_CYCLE = 0.05
+# Host is considered overloaded when some tasks wait for the CPU more
+# than PSI_THRESHOLD % of time...
+PSI_THRESHOLD = 10.0
+PSI_PATH = '/proc/pressure/cpu'
+# ...or when load average per CPU (without the miner) exceeds
+LOAD_THRESHOLD = 1.0
+# Host load limit is multiplied by BACKOFF_FACTOR on overload and
+# increased by RECOVERY_STEP otherwise
+BACKOFF_FACTOR = 0.5
+RECOVERY_STEP = 0.1
+
+
+def read_cpu_pressure(path=PSI_PATH):
+    """Share of time (in %) some tasks waited for the CPU over the last
+    10 seconds
+
+    @return None when PSI is not supported by the kernel
+    """
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    values = dict(x.split('=') for x in fields[1:])
+                    return float(values['avg10'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def clamp_duty_cycle(duty_cycle):
+    return min(max(duty_cycle, MIN_DUTY_CYCLE), 1.0)
+
+
+class Governor(object):
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'Governor'))
+
+    def __init__(self, duty_cycle=1.0, cpu_share=None, max_hash_rate=None,
+                 adaptive=False, cpu_count=None):
+        """
+        @param duty_cycle - fixed duty cycle of all miners
+        @param cpu_share - fraction of all host CPU's available to CPU
+        miners, None = unlimited
+        @param max_hash_rate - cap of the total solution rate, None =
+        unlimited
+        @param adaptive - back off when the host is loaded by other
+        workloads
+        """
+        self.duty_cycle = clamp_duty_cycle(duty_cycle)
+        self.cpu_share = cpu_share
+        self.max_hash_rate = max_hash_rate
+        self.adaptive = adaptive
+        self.cpu_count = cpu_count or multiprocessing.cpu_count()
+        # duty cycles of individual miners
+        self.miner_duty_cycles = {}
+        # limits imposed by the feedback policies
+        self.cpu_limit = None
+        self.rate_limit = 1.0
+        self.load_limit = 1.0
+        # last applied duty cycles and the policies that imposed them
+        self.common_duty_cycle = 1.0
+        self.cpu_duty_cycle = 1.0
+        self.reason = None
+        # measurements over the last period
+        self.last_sample = None
+        self.cpu_usage = 0
+        self.hash_rate = 0
+        self.cpu_pressure = None
+        self.host_load = None
+
+    @property
+    def enabled(self):
+        return self.duty_cycle < 1 or self.cpu_share is not None or \
+            self.max_hash_rate is not None or self.adaptive or \
+            bool(self.miner_duty_cycles)
+
+    def set_miner_duty_cycle(self, miner_id, duty_cycle):
+        """Sets duty cycle of a miner, None removes the setting"""
+        if duty_cycle is None:
+            self.miner_duty_cycles.pop(miner_id, None)
+        else:
+            self.miner_duty_cycles[miner_id] = clamp_duty_cycle(duty_cycle)
+
+    def sample(self, miners):
+        (user, system) = os.times()[:2]
+        return (time.time(), user + system,
+                sum(m.stats.solution_count for m in miners))
+
+    def is_overloaded(self):
+        self.cpu_pressure = read_cpu_pressure()
+        if self.cpu_pressure is not None:
+            return self.cpu_pressure > PSI_THRESHOLD
+        # exclude the miner's own runnable threads
+        self.host_load = max(os.getloadavg()[0] - self.cpu_usage, 0) / \
+                         self.cpu_count
+        return self.host_load > LOAD_THRESHOLD
+
+    def update_limits(self, miners):
+        sample = self.sample(miners)
+        cpu_miner_count = sum(1 for m in miners if isinstance(m, CpuMiner))
+        if self.last_sample is not None and sample[0] > self.last_sample[0]:
+            period = sample[0] - self.last_sample[0]
+            self.cpu_usage = (sample[1] - self.last_sample[1]) / period
+            self.hash_rate = (sample[2] - self.last_sample[2]) / period
+
+            if self.cpu_share is not None and self.cpu_usage > 0:
+                self.cpu_limit = clamp_duty_cycle(
+                    self.cpu_duty_cycle * self.cpu_share * self.cpu_count /
+                    self.cpu_usage)
+            if self.max_hash_rate is not None and self.hash_rate > 0:
+                self.rate_limit = clamp_duty_cycle(
+                    self.common_duty_cycle * self.max_hash_rate /
+                    self.hash_rate)
+            if self.adaptive:
+                if self.is_overloaded():
+                    self.load_limit = clamp_duty_cycle(
+                        self.load_limit * BACKOFF_FACTOR)
+                else:
+                    self.load_limit = clamp_duty_cycle(
+                        self.load_limit + RECOVERY_STEP)
+        self.last_sample = sample
+
+        if self.cpu_share is None:
+            self.cpu_limit = None
+        elif self.cpu_limit is None and cpu_miner_count > 0:
+            # Initial estimate - each CPU miner keeps one CPU busy
+            self.cpu_limit = clamp_duty_cycle(
+                self.cpu_share * self.cpu_count / cpu_miner_count)
+        if self.max_hash_rate is None:
+            self.rate_limit = 1.0
+        if not self.adaptive:
+            self.load_limit = 1.0
+
+    def apply(self, miners):
+        """Sets duty cycles of miners according to the current limits"""
+        limits = [(self.duty_cycle, 'duty cycle'),
+                  (self.rate_limit, 'hashrate cap'),
+                  (self.load_limit, 'host load')]
+        (self.common_duty_cycle, reason) = min(limits, key=lambda l: l[0])
+        self.cpu_duty_cycle = self.common_duty_cycle
+        if self.cpu_limit is not None and self.cpu_limit < self.common_duty_cycle:
+            (self.cpu_duty_cycle, reason) = (self.cpu_limit, 'CPU share')
+        self.reason = reason if self.cpu_duty_cycle < 1 else None
+
+        for m in miners:
+            duty_cycle = self.cpu_duty_cycle if isinstance(m, CpuMiner) \
+                         else self.common_duty_cycle
+            duty_cycle = min(duty_cycle,
+                             self.miner_duty_cycles.get(m.miner_id, 1.0))
+            if duty_cycle != m.duty_cycle:
+                self.log.debug('Setting duty cycle of {0} to {1:.0%}'.format(
+                    m, duty_cycle))
+                m.set_duty_cycle(duty_cycle)
+
+    async def run(self, miner_manager):
+        while True:
+            self.update_limits(miner_manager.miners)
+            self.apply(miner_manager.miners)
+            await asyncio.sleep(GOVERNOR_PERIOD)
+
+    def as_dict(self):
+        return {'enabled': self.enabled,
+                'duty_cycle': self.duty_cycle,
+                'cpu_share': self.cpu_share,
+                'max_hash_rate': self.max_hash_rate,
+                'adaptive': self.adaptive,
+                'throttle': self.reason,
+                'cpu_duty_cycle': self.cpu_duty_cycle,
+                'common_duty_cycle': self.common_duty_cycle,
+                'cpu_usage': self.cpu_usage,
+                'hash_rate': self.hash_rate,
+                'cpu_pressure': self.cpu_pressure,
+                'host_load': self.host_load}
+
+    def __format__(self, format_spec):
+        s = io.StringIO()
+        if self.reason is None:
+            s.write('not throttling')
+        else:
+            s.write('throttling by {0}: CPU miners {1:.0%}, others {2:.0%}'.format(
+                self.reason, self.cpu_duty_cycle, self.common_duty_cycle))
+        s.write(', CPU usage: {0:.02f}/{1}, rate: {2:.02f} Sol/s'.format(
+            self.cpu_usage, self.cpu_count, self.hash_rate))
+        if self.cpu_pressure is not None:
+            s.write(', CPU pressure: {0:.01f}%'.format(self.cpu_pressure))
+        elif self.host_load is not None:
+            s.write(', host load: {0:.02f}'.format(self.host_load))
+        return s.getvalue()
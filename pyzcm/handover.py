@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Handover of the mining session to a new process
+
+A miner started with '--handover PATH' listens on a unix socket. A new
+miner (e.g. after an upgrade) started with '--takeover PATH' first
+starts its own miners and then takes over:
+
+- the new process sends a takeover request
+- the old process stops reading the stratum connection and sends the
+  session state (nonce1, target, the last job, worker names and
+  targets, the message ID counter, ID's of requests waiting for a
+  response, data received but not processed yet) along with the
+  connection socket itself (SCM_RIGHTS). It also sends nonce2 positions
+  of its miners so that miners of the new process with the same solver
+  nonce continue from there instead of repeating the work.
+- the new process resumes the session on the socket without
+  authorizing and subscribing again and acknowledges it
+- the old process drains its miners, shares found by the runs in
+  progress are forwarded to the new process for submission. It exits
+  once all miners have stopped.
+
+TLS connections (their state lives in the old process) and solo mining
+sessions are not handed over, the new process connects on its own
+then.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import array
+import asyncio
+import binascii
+import json
+import logging
+import os
+import socket
+import stat
+
+from pyzcm.stratum import StratumClient
+from pyzcm.version import VERSION
+
+HANDOVER_VERSION = 1
+# Added to nonce2 positions of the old miners, GPU backends report their
+# position with stats (every STATS_REFRESH_PERIOD) and runs in progress
+# advance it further
+HANDOVER_NONCE2_MARGIN = 2 ** 16
+# Time for the old miners to finish their runs
+HANDOVER_DRAIN_TIMEOUT = 30
+HANDOVER_TIMEOUT = 30
+
+
+def send_message(sock, msg, fds=()):
+    """Sends a JSON message along with file descriptors on a blocking
+    unix socket"""
+    data = '{}\n'.format(json.dumps(msg)).encode()
+    ancillary = []
+    if fds:
+        ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                          array.array('i', fds)))
+    sent = sock.sendmsg([data], ancillary)
+    sock.sendall(data[sent:])
+
+
+def receive_message(sock):
+    """Receives a JSON message on a blocking unix socket, the peer
+    doesn't send anything else until the message is responded
+
+    @return tuple (message, received file descriptors)
+    """
+    data = b''
+    fds = array.array('i')
+    while not data.endswith(b'\n'):
+        (chunk, ancdata, _, _) = sock.recvmsg(
+            2 ** 16, socket.CMSG_SPACE(fds.itemsize))
+        if chunk == b'':
+            raise ConnectionError('Handover connection closed')
+        for (level, msg_type, cdata) in ancdata:
+            if level == socket.SOL_SOCKET and msg_type == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+        data += chunk
+    return (json.loads(data.decode()), list(fds))
+
+
+class HandoverServer(object):
+    """Hands the session of the running miner over to a new process"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'HandoverServer'))
+
+    def __init__(self, loop, switcher, path):
+        self.loop = loop
+        self.switcher = switcher
+        self.path = path
+        self.listener = None
+        self.task = None
+
+    def start(self):
+        # remove a stale socket of a previous run (or of the process that
+        # has been taken over)
+        if os.path.exists(self.path) and \
+           stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(1)
+        self.listener.setblocking(False)
+        self.task = self.loop.create_task(self.run())
+        self.log.info('Listening for takeover on {}'.format(self.path))
+
+    async def run(self):
+        while True:
+            (conn, _) = await self.loop.sock_accept(self.listener)
+            try:
+                await self.hand_over(conn)
+                break
+            except Exception as e:
+                self.log.error('Handover failed: {}'.format(e))
+                conn.close()
+        self.listener.close()
+
+    async def hand_over(self, conn):
+        conn.setblocking(True)
+        conn.settimeout(HANDOVER_TIMEOUT)
+        (request, _) = await self.loop.run_in_executor(None, receive_message,
+                                                       conn)
+        if request.get('method') != 'takeover' or \
+           request.get('version') != HANDOVER_VERSION:
+            raise ValueError('Unsupported takeover request: {}'.format(request))
+        self.log.warn('Handing over to pyzcm {}'.format(request.get('pyzcm')))
+
+        shares = asyncio.Queue()
+        (session, nonce2) = self.switcher.hand_over(
+            lambda *share: shares.put_nowait(share))
+        state = {'version': HANDOVER_VERSION, 'session': session,
+                 'nonce2': {miner_id: position + HANDOVER_NONCE2_MARGIN
+                            for miner_id, position in nonce2.items()}}
+        fds = []
+        if session is not None:
+            fds.append(session.pop('socket'))
+        drain = self.loop.create_task(
+            self.switcher.miners.drain(HANDOVER_DRAIN_TIMEOUT))
+        try:
+            await self.loop.run_in_executor(None, send_message, conn, state,
+                                            fds)
+            (ack, _) = await self.loop.run_in_executor(None, receive_message,
+                                                       conn)
+            self.log.info('Session {0}: {1}'.format(
+                'resumed' if session is not None else 'not handed over', ack))
+
+            conn.setblocking(False)
+            (_, writer) = await asyncio.open_unix_connection(sock=conn)
+            while not (drain.done() and shares.empty()):
+                get = self.loop.create_task(shares.get())
+                await asyncio.wait([get, drain],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    continue
+                (name, job, nonce2, len_and_solution) = get.result()
+                self.log.info('Forwarding share of job 0x{}'.format(job.job_id))
+                writer.write('{}\n'.format(json.dumps({
+                    'method': 'share',
+                    'params': [name, job.job_id,
+                               binascii.hexlify(job.ntime).decode(),
+                               binascii.hexlify(nonce2).decode(),
+                               binascii.hexlify(len_and_solution).decode()]
+                })).encode())
+            writer.write('{}\n'.format(json.dumps({'method': 'drained'})).encode())
+            await writer.drain()
+            writer.close()
+        finally:
+            await drain
+            self.switcher.finish_handover()
+        self.log.warn('Miners drained, mining continues in the new process')
+
+
+class Takeover(object):
+    """Takes over the session of another process"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'Takeover'))
+
+    def __init__(self, loop, path):
+        self.loop = loop
+        self.path = path
+        self.task = None
+
+    def request(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(HANDOVER_TIMEOUT)
+        try:
+            sock.connect(self.path)
+            send_message(sock, {'method': 'takeover',
+                                'version': HANDOVER_VERSION,
+                                'pyzcm': VERSION})
+            (state, fds) = receive_message(sock)
+        except:
+            sock.close()
+            raise
+        return (sock, state, fds)
+
+    async def run(self, switcher):
+        """Requests the session of the old process, the old process stops
+        mining then
+
+        @return session to be resumed by StratumClient.connect(), None
+        when the new process has to connect on its own
+        """
+        try:
+            (sock, state, fds) = await self.loop.run_in_executor(None,
+                                                                 self.request)
+        except Exception as e:
+            self.log.error('Takeover from {0} failed: {1}'.format(self.path, e))
+            return None
+        session = state['session']
+        if session is not None and fds:
+            session['socket'] = socket.socket(fileno=fds[0])
+        else:
+            session = None
+            for fd in fds:
+                os.close(fd)
+        switcher.miners.set_nonce2_positions(
+            {int(miner_id): position
+             for miner_id, position in state['nonce2'].items()})
+        self.log.warn('Took over from {0}, session {1}'.format(
+            self.path, 'handed over' if session is not None else
+            'not available'))
+        await self.loop.run_in_executor(None, send_message, sock,
+                                        {'method': 'resumed'})
+        sock.setblocking(False)
+        self.task = self.loop.create_task(self.receive_shares(sock, switcher))
+        return session
+
+    async def receive_shares(self, sock, switcher):
+        """Submits shares forwarded while the old process drains its
+        miners"""
+        (reader, writer) = await asyncio.open_unix_connection(sock=sock)
+        try:
+            while True:
+                data = await reader.readline()
+                if data == b'':
+                    self.log.warn('Previous process closed the handover ' \
+                                  'connection')
+                    break
+                msg = json.loads(data.decode())
+                if msg['method'] == 'drained':
+                    self.log.info('Previous process has drained its miners')
+                    break
+                client = switcher.client
+                if not isinstance(client, StratumClient) or \
+                   not client.connected:
+                    self.log.warn('Dropping forwarded share, not connected')
+                    continue
+                self.loop.create_task(client.submit_forwarded(*msg['params']))
+        finally:
+            writer.close()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Pool health checks
+
+A pool may keep the connection open while being of no use - not
+sending new jobs, rejecting most of the shares or responding to
+submits after many seconds. The monitor watches the session with the
+active server against the policies:
+
+- job age - time since the last job (or since the session has started)
+  exceeds max_job_age
+- reject ratio - fraction of rejected shares (stale ones included) among
+  the last HEALTH_WINDOW responses exceeds max_reject_ratio
+- submit latency - HEALTH_LATENCY_PERCENTILE of the last HEALTH_WINDOW
+  submit latencies exceeds max_submit_latency, submits without a
+  response count as LOST_SUBMIT_LATENCY
+
+The ratio and the latency are evaluated once there are at least
+HEALTH_MIN_RESPONSES samples. A breach fails the server over, the
+server is quarantined for HEALTH_QUARANTINE_TIME.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import asyncio
+import collections
+import logging
+import time
+
+HEALTH_CHECK_PERIOD = 5
+HEALTH_WINDOW = 50
+HEALTH_MIN_RESPONSES = 20
+HEALTH_LATENCY_PERCENTILE = 0.9
+HEALTH_QUARANTINE_TIME = 600
+# Default policies
+MAX_JOB_AGE = 600
+MAX_REJECT_RATIO = 0.5
+MAX_SUBMIT_LATENCY = 10
+# Timeout of stratum requests
+LOST_SUBMIT_LATENCY = 30
+
+
+class SessionHealth(object):
+    """Jobs and share responses of a single session"""
+    def __init__(self):
+        self.start_time = time.time()
+        self.last_job_time = None
+        # True for each rejected share of the last responses
+        self.rejects = collections.deque(maxlen=HEALTH_WINDOW)
+        self.latencies = collections.deque(maxlen=HEALTH_WINDOW)
+
+    def record_job(self):
+        self.last_job_time = time.time()
+
+    def record_response(self, latency, accepted):
+        self.rejects.append(not accepted)
+        self.latencies.append(latency)
+
+    def record_lost(self):
+        self.latencies.append(LOST_SUBMIT_LATENCY)
+
+    @property
+    def job_age(self):
+        return time.time() - (self.last_job_time or self.start_time)
+
+    @property
+    def reject_ratio(self):
+        if len(self.rejects) < HEALTH_MIN_RESPONSES:
+            return None
+        return sum(self.rejects) / len(self.rejects)
+
+    @property
+    def submit_latency(self):
+        """HEALTH_LATENCY_PERCENTILE of the submit latencies"""
+        if len(self.latencies) < HEALTH_MIN_RESPONSES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(HEALTH_LATENCY_PERCENTILE * len(latencies)),
+                             len(latencies) - 1)]
+
+    def __format__(self, format_spec):
+        s = ['job age {:.0f} s'.format(self.job_age)]
+        if self.reject_ratio is not None:
+            s.append('rejected {0:.0%} of {1}'.format(self.reject_ratio,
+                                                     len(self.rejects)))
+        if self.submit_latency is not None:
+            s.append('submit latency p{0:.0f} {1:.02f} s'.format(
+                HEALTH_LATENCY_PERCENTILE * 100, self.submit_latency))
+        return ', '.join(s)
+
+
+class PoolHealth(object):
+    """Health policies of the active server"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'PoolHealth'))
+
+    def __init__(self, max_job_age=MAX_JOB_AGE,
+                 max_reject_ratio=MAX_REJECT_RATIO,
+                 max_submit_latency=MAX_SUBMIT_LATENCY,
+                 period=HEALTH_CHECK_PERIOD):
+        """
+        @param max_job_age - seconds, None disables the policy
+        @param max_reject_ratio - None disables the policy
+        @param max_submit_latency - seconds, None disables the policy
+        """
+        self.max_job_age = max_job_age
+        self.max_reject_ratio = max_reject_ratio
+        self.max_submit_latency = max_submit_latency
+        self.period = period
+        self.session = SessionHealth()
+
+    def start_session(self):
+        """@return SessionHealth to be updated by the client of the new
+        session, responses to requests of the previous sessions don't
+        count"""
+        self.session = SessionHealth()
+        return self.session
+
+    def check(self):
+        """@return descriptions of the breached policies"""
+        problems = []
+        session = self.session
+        job_age = session.job_age
+        if self.max_job_age is not None and job_age > self.max_job_age:
+            problems.append('no job for {:.0f} s'.format(job_age))
+        reject_ratio = session.reject_ratio
+        if self.max_reject_ratio is not None and reject_ratio is not None and \
+           reject_ratio > self.max_reject_ratio:
+            problems.append('{0:.0%} of the last {1} shares rejected'.format(
+                reject_ratio, len(session.rejects)))
+        submit_latency = session.submit_latency
+        if self.max_submit_latency is not None and \
+           submit_latency is not None and \
+           submit_latency > self.max_submit_latency:
+            problems.append('submit latency p{0:.0f} {1:.02f} s'.format(
+                HEALTH_LATENCY_PERCENTILE * 100, submit_latency))
+        return problems
+
+    async def run(self, switcher):
+        """Fails the active server over when it breaches a policy"""
+        while True:
+            await asyncio.sleep(self.period)
+            client = switcher.client
+            if client is None or not client.connected or \
+               getattr(client, 'detached', False):
+                continue
+            problems = self.check()
+            if problems:
+                switcher.fail_unhealthy(problems)
+
+    def as_dict(self):
+        return {'job_age': self.session.job_age,
+                'reject_ratio': self.session.reject_ratio,
+                'submit_latency': self.session.submit_latency,
+                'max_job_age': self.max_job_age,
+                'max_reject_ratio': self.max_reject_ratio,
+                'max_submit_latency': self.max_submit_latency}
+
+    def __format__(self, format_spec):
+        return format(self.session)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""Stats history
+
+The miner started with '--stats-history FILE' samples the statistics
+of each miner every HISTORY_PERIOD seconds into a fixed-size ring file.
+The file is memory-mapped, a sample is a single struct written into
+the mapping, there are no syscalls on the mining path. The file layout:
+
+- header - magic, format version, record size, capacity (number of
+  records) and the count of records written so far
+- capacity records - the record of sample N is stored in slot
+  N % capacity
+
+Records contain cumulative counters of the miner (solutions, solving
+time, accepted/rejected/stale/lost shares and the total submission
+time), rates are computed from the differences of subsequent records.
+The counters restart from zero when the miner restarts, the history
+itself is kept (the interval of the restart is left out).
+
+'pyzcm stats FILE' (or 'python -m pyzcm.history FILE') reads the
+file without touching the running miner and prints the history
+downsampled to the requested resolution.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import argparse
+import collections
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+
+HISTORY_MAGIC = b'PZCMHIST'
+HISTORY_VERSION = 1
+# magic, version, record size, capacity, records written
+HISTORY_HEADER = struct.Struct('<8sIIIQ')
+# time, miner name, solutions, solving time, accepted, rejected, stale
+# and lost shares, total submission time
+HISTORY_RECORD = struct.Struct('<d16sQdIIIId')
+HISTORY_PERIOD = 10
+# Default size of the file in MB
+HISTORY_SIZE = 16
+# Durations accepted by the query: 90, 90s, 15m, 2h, 7d
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+HistoryRecord = collections.namedtuple('HistoryRecord', [
+    'time', 'miner', 'solution_count', 'solving_time', 'accepted', 'rejected',
+    'stale', 'lost', 'submission_time'])
+
+
+class HistoryFile(object):
+    """Memory-mapped ring of records"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'HistoryFile'))
+
+    def __init__(self, path, size_mb=HISTORY_SIZE, writable=True):
+        """Opens the history file, a writable file is created (or
+        recreated when it doesn't match the requested size)
+
+        @param size_mb - size of the file in MB
+        """
+        self.path = path
+        self.writable = writable
+        if writable:
+            self.capacity = (size_mb * 2 ** 20 - HISTORY_HEADER.size) // \
+                            HISTORY_RECORD.size
+            self.open_writable()
+        else:
+            with open(path, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, version, record_size, self.capacity, _) = \
+                HISTORY_HEADER.unpack_from(self.mmap, 0)
+            if magic != HISTORY_MAGIC or version != HISTORY_VERSION or \
+               record_size != HISTORY_RECORD.size:
+                raise ValueError('{} is not a stats history file'.format(path))
+
+    @property
+    def file_size(self):
+        return HISTORY_HEADER.size + self.capacity * HISTORY_RECORD.size
+
+    def open_writable(self):
+        count = 0
+        try:
+            with open(self.path, 'rb') as f:
+                (magic, version, record_size, capacity, count) = \
+                    HISTORY_HEADER.unpack(f.read(HISTORY_HEADER.size))
+            if (magic, version, record_size, capacity) != \
+               (HISTORY_MAGIC, HISTORY_VERSION, HISTORY_RECORD.size,
+                self.capacity):
+                self.log.warn('Recreating stats history {}'.format(self.path))
+                count = 0
+        except (OSError, struct.error):
+            count = 0
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a+b') as f:
+            f.truncate(self.file_size)
+            self.mmap = mmap.mmap(f.fileno(), self.file_size)
+        HISTORY_HEADER.pack_into(self.mmap, 0, HISTORY_MAGIC, HISTORY_VERSION,
+                                 HISTORY_RECORD.size, self.capacity, count)
+
+    @property
+    def count(self):
+        """Number of records written since the file was created"""
+        return HISTORY_HEADER.unpack_from(self.mmap, 0)[4]
+
+    def append(self, record):
+        count = self.count
+        HISTORY_RECORD.pack_into(
+            self.mmap, HISTORY_HEADER.size +
+            (count % self.capacity) * HISTORY_RECORD.size,
+            record.time, record.miner.encode()[:16], *record[2:])
+        # the record is complete before the count makes it visible
+        struct.pack_into('<Q', self.mmap, HISTORY_HEADER.size - 8, count + 1)
+
+    def read(self):
+        """@return records in the order of writing"""
+        count = self.count
+        data = self.mmap[HISTORY_HEADER.size:]
+        # records that may have been overwritten while copying (including
+        # the one being written) are dropped
+        first = max(self.count - self.capacity + 1, 0)
+        records = []
+        for i in range(first, count):
+            values = HISTORY_RECORD.unpack_from(
+                data, (i % self.capacity) * HISTORY_RECORD.size)
+            records.append(HistoryRecord(values[0],
+                                         values[1].rstrip(b'\0').decode(),
+                                         *values[2:]))
+        return records
+
+    def close(self):
+        if self.writable:
+            self.mmap.flush()
+        self.mmap.close()
+
+
+class HistoryRecorder(object):
+    """Samples the miner statistics into the history file"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'HistoryRecorder'))
+
+    def __init__(self, path, size_mb=HISTORY_SIZE, period=HISTORY_PERIOD):
+        self.file = HistoryFile(path, size_mb)
+        self.period = period
+        self.last_time = 0
+
+    def sample(self, miners):
+        """Records the miners if the period has elapsed"""
+        now = time.time()
+        if now - self.last_time < self.period:
+            return
+        self.last_time = now
+        for m in miners:
+            s = m.stats
+            self.file.append(HistoryRecord(
+                now, format(m, 's'), s.solution_count, s.solving_time,
+                s.accepted_share_count, s.rejected_share_count,
+                s.stale_share_count, s.lost_share_count,
+                s.accepted_share_submission_time +
+                s.rejected_share_submission_time))
+
+    def close(self):
+        self.file.close()
+
+
+def parse_duration(duration):
+    x = re.match(r'^(\d+(\.\d*)?)([smhd]?)$', duration)
+    if x is None:
+        raise argparse.ArgumentTypeError(
+            'Invalid duration: {}'.format(duration))
+    return float(x.group(1)) * DURATION_UNITS[x.group(3)]
+
+
+def downsample(records, resolution):
+    """Aggregates differences of subsequent records of each miner into
+    intervals of the resolution
+
+    @return list of dictionaries ordered by interval start and miner
+    """
+    last = {}
+    buckets = collections.OrderedDict()
+    for r in records:
+        previous = last.get(r.miner)
+        last[r.miner] = r
+        # counters restart from zero when the miner restarts, the
+        # downtime is not accounted
+        if previous is None or r.time <= previous.time or \
+           r.solution_count < previous.solution_count:
+            continue
+        start = r.time - r.time % resolution
+        b = buckets.setdefault((start, r.miner), {
+            'time': start, 'miner': r.miner, 'duration': 0, 'solutions': 0,
+            'solving_time': 0, 'accepted': 0, 'rejected': 0, 'stale': 0,
+            'lost': 0, 'submission_time': 0})
+        b['duration'] += r.time - previous.time
+        for (key, field) in (('solutions', 'solution_count'),
+                             ('solving_time', 'solving_time'),
+                             ('accepted', 'accepted'),
+                             ('rejected', 'rejected'),
+                             ('stale', 'stale'), ('lost', 'lost'),
+                             ('submission_time', 'submission_time')):
+            b[key] += getattr(r, field) - getattr(previous, field)
+    result = []
+    for b in sorted(buckets.values(), key=lambda b: (b['time'], b['miner'])):
+        responses = b['accepted'] + b['rejected']
+        result.append({
+            'time': b['time'],
+            'miner': b['miner'],
+            'hash_rate': b['solutions'] / b['duration'],
+            'solving': min(b['solving_time'] / b['duration'], 1),
+            'accepted': b['accepted'],
+            'rejected': b['rejected'],
+            'stale': b['stale'],
+            'lost': b['lost'],
+            'submit_latency': b['submission_time'] / responses if responses
+                              else None})
+    return result
+
+
+def format_interval(i):
+    s = '{0} {1:16} {2:8.02f} Sol/s solving {3:4.0%} ACC[{4}] REJ[{5}] ' \
+        'STALE[{6}] LOST[{7}]'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(i['time'])),
+            i['miner'], i['hash_rate'], i['solving'], i['accepted'],
+            i['rejected'], i['stale'], i['lost'])
+    if i['submit_latency'] is not None:
+        s += ' submit: {:.0f} ms'.format(i['submit_latency'] * 1e3)
+    return s
+
+
+def main(argv=None):
+    """Query the stats history of a miner"""
+    parser = argparse.ArgumentParser(prog='pyzcm stats',
+                                     description=main.__doc__)
+    parser.add_argument('history', help='File written by pyzcm --stats-history')
+    parser.add_argument('-s', '--since', dest='since', default=None,
+                        type=parse_duration,
+                        help='Show the last DURATION only (e.g. 90s, 15m, 2h, 7d)')
+    parser.add_argument('-r', '--resolution', dest='resolution', default='5m',
+                        type=parse_duration,
+                        help='Length of the aggregated intervals')
+    parser.add_argument('-m', '--miner', dest='miners', action='append',
+                        default=[], help='Show the miner only (e.g. CPU[0])')
+    parser.add_argument('--json', dest='json', action='store_true',
+                        help='Print the intervals as JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        history = HistoryFile(args.history, writable=False)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    records = history.read()
+    history.close()
+    if args.since is not None:
+        t_since = time.time() - args.since
+        records = [r for r in records if r.time >= t_since]
+    if args.miners:
+        records = [r for r in records if r.miner in args.miners]
+    intervals = downsample(records, args.resolution)
+    if args.json:
+        print(json.dumps(intervals, indent=2))
+    else:
+        for i in intervals:
+            print(format_interval(i))
+
+
+if __name__ == '__main__':
+    main()
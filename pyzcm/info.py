@@ -9,16 +9,33 @@ MIT license
 from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
 import logging
-import pyopencl as cl
 import os
 
+from pyzcm.solver.registry import DEVICE_GPU
+
 class _MinerInfo(object):
     def __init__(self, solver_class):
         self.log.debug('Setting solver class: {}'.format(solver_class))
         self.solver_class = solver_class
+        # solver classes selected for individual devices
+        self.device_solver_classes = {}
+
+    def set_device_solver_class(self, device_id, solver_class):
+        self.log.debug('Setting solver class: {0} for device: {1}'.format(
+            solver_class, device_id))
+        self.device_solver_classes[device_id] = solver_class
+
+    def get_solver_class(self, device_id=None):
+        return self.device_solver_classes.get(device_id, self.solver_class)
+
+    def get_miner_options(self):
+        """Additional keyword arguments for miners of this kind"""
+        return {}
 
-    def get_solver_class(self):
-        return self.solver_class
+    def get_device_model(self, device_id):
+        """Model of the device, miners of the same model are expected to
+        perform alike"""
+        return None
 
 
 class CpuMinerInfo(_MinerInfo):
@@ -78,13 +95,24 @@ class GpuMinerInfo(_MinerInfo):
     by each miner as a subprocess.
     """
     log = logging.getLogger('{0}.{1}'.format(__name__, 'GpuMinerInfo'))
-    def __init__(self, gpus, eh_per_gpu, solver_class):
+    def __init__(self, gpus, eh_per_gpu, solver_class, backend_selector=None,
+                 threaded=False):
+        """
+        @param backend_selector - optional BackendSelector that
+        chooses the solver for each detected device, solver_class is
+        used for all devices otherwise
+        @param threaded - run eh_per_gpu solver instances as threads of
+        a single backend process per device instead of running a
+        separate miner for each instance
+        """
         super(GpuMinerInfo, self).__init__(solver_class)
         self.detected_gpu_platforms = []
         self.requested_gpus = gpus
         self.eh_per_gpu = eh_per_gpu
+        self.backend_selector = backend_selector
+        self.threaded = threaded
 
-    def detect_devices(self, loop):
+    async def detect_devices(self, loop):
         """Detection is run in a separate process.
 
         This is to prevent any interference with OpenCL instances
@@ -94,16 +122,42 @@ class GpuMinerInfo(_MinerInfo):
         parent process touched OpenCL e.g. just by listing platforms.
         """
         proc_executor = ProcessPoolExecutor(max_workers=1)
-        self.detected_gpu_platforms = yield from \
+        self.detected_gpu_platforms = await \
                            loop.run_in_executor(proc_executor,
                                                 self.detect_devices_process)
         self.log.info("Detected GPU's: {}".format(self.detected_gpu_platforms))
         if self.requested_gpus is None:
             self.log.info("Add all GPU's to request list")
             self.requested_gpus = [(p_id, []) for p_id, p in enumerate(self.detected_gpu_platforms)]
+        if self.backend_selector is not None:
+            # Selection may run benchmarks, keep it off the event loop
+            await loop.run_in_executor(None, self.select_backends)
+
+    def get_device_model(self, device_id):
+        """Vendor/codename/CL version as provided by persistent_unique_id"""
+        (platform, device) = device_id
+        return '/'.join(str(x) for x in
+                        self.detected_gpu_platforms[platform].devices[device])
+
+    def select_backends(self):
+        for (platform, device) in sorted(set(self.get_device_ids())):
+            model = self.get_device_model((platform, device))
+            backend = self.backend_selector.select(
+                DEVICE_GPU, '{0}:{1}'.format(platform, device),
+                (platform, device), model)
+            if backend is not None:
+                self.set_device_solver_class((platform, device),
+                                             backend.solver_class)
 
     @classmethod
     def detect_devices_process(cls):
+        # pyopencl is optional (pip install pyzcm[gpu]), CPU mining
+        # works without it
+        try:
+            import pyopencl as cl
+        except ImportError:
+            cls.log.warning("pyopencl is not installed, GPU's are not used")
+            return []
         cls.log.debug('Detecting OpenCL platforms')
         platforms = cl.get_platforms()
         platform_descriptors = []
@@ -152,12 +206,17 @@ class GpuMinerInfo(_MinerInfo):
                 for d in used_devices:
                     # yield the platform/id pair eh_per_gpu times so
                     # that multiple solver instances are run on one
-                    # GPU
-                    for eh in range(self.eh_per_gpu):
+                    # GPU, threaded miners run all instances themselves
+                    for eh in range(1 if self.threaded else self.eh_per_gpu):
                         yield (platform, d)
             except IndexError as e:
                 self.log.debug("Platform {0} doesn't exist!".format(platform))
 
+    def get_miner_options(self):
+        if self.threaded:
+            return {'instances': self.eh_per_gpu}
+        return {}
+
     def __format__(self, format_spec):
         return 'GPU count:{0} solver: {1}'.format(self.gpu_count,
                                                   self.solver_class)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Logging pipeline shared by the miner processes
+
+Loggers of all processes (the main process and GPU backend processes)
+only put their records into a multiprocessing queue, the records are
+written by a single listener thread of the main process. Logging
+therefore doesn't block the event loop or the solver threads even in
+debug mode.
+
+The listener rate limits repetitive messages - records from the same
+logger and call site exceeding RATE_LIMIT_BURST within
+RATE_LIMIT_PERIOD are dropped and their count is reported with the
+next message passed. Besides the console output, the records can be
+written as JSON objects (one per line) into a rotating log file.
+
+Levels can be set per subsystem (a logger below 'pyzcm', e.g.
+'stratum' or 'miner'), the backend processes are given the
+configuration of the main process (see get_backend_config()) when
+they are started, regardless of the multiprocessing start method.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import json
+import logging
+import logging.handlers
+import multiprocessing
+
+LOG_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+# Records of a call site beyond the burst within the period are dropped
+RATE_LIMIT_PERIOD = 10
+RATE_LIMIT_BURST = 50
+# Size of the JSON log file before rotation and number of the backups
+LOG_FILE_SIZE = 10 * 2 ** 20
+LOG_FILE_BACKUP_COUNT = 5
+
+# Pipeline of the main process
+_pipeline = None
+
+
+def subsystem_logger_name(subsystem):
+    """Full name of the logger of the subsystem"""
+    if subsystem == 'pyzcm' or subsystem.startswith('pyzcm.'):
+        return subsystem
+    return 'pyzcm.{}'.format(subsystem)
+
+
+class RateLimiter(object):
+    """Limits the number of records from a single call site"""
+    def __init__(self, burst=RATE_LIMIT_BURST, period=RATE_LIMIT_PERIOD):
+        self.burst = burst
+        self.period = period
+        # (logger, call site) -> [start of the period, count of records]
+        self.windows = {}
+
+    def check(self, record):
+        """
+        @return True if the record passes, its message is extended with
+        the count of records suppressed in the previous period
+        """
+        key = (record.name, record.pathname, record.lineno)
+        window = self.windows.get(key)
+        if window is not None and record.created - window[0] < self.period:
+            window[1] += 1
+            return window[1] <= self.burst
+        if window is not None and window[1] > self.burst:
+            record.msg = '{0} ({1} similar messages suppressed)'.format(
+                record.getMessage(), window[1] - self.burst)
+            record.args = None
+        self.windows[key] = [record.created, 1]
+        if len(self.windows) > 10000:
+            self.windows = {k: w for k, w in self.windows.items()
+                            if record.created - w[0] < self.period}
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects"""
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'process': record.process,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class LogListener(logging.handlers.QueueListener):
+    """Queue listener that rate limits the records"""
+    def __init__(self, queue, handlers, rate_limiter=None):
+        super(LogListener, self).__init__(queue, *handlers,
+                                          respect_handler_level=True)
+        self.rate_limiter = rate_limiter
+
+    def handle(self, record):
+        if self.rate_limiter is None or self.rate_limiter.check(record):
+            super(LogListener, self).handle(record)
+
+
+class LogPipeline(object):
+    def __init__(self, level, subsystem_levels=(), log_file=None,
+                 rate_limit=RATE_LIMIT_BURST):
+        """
+        @param level - level of the root logger
+        @param subsystem_levels - list of (subsystem, level) pairs
+        @param log_file - path of the JSON log file, None = console only
+        @param rate_limit - records per call site within
+        RATE_LIMIT_PERIOD, 0 = unlimited
+        """
+        self.level = level
+        self.subsystem_levels = [(subsystem_logger_name(s), l)
+                                 for (s, l) in subsystem_levels]
+        self.log_file = log_file
+        self.rate_limit = rate_limit
+        self.queue = None
+        self.listener = None
+
+    def create_handlers(self):
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers = [console]
+        if self.log_file is not None:
+            log_file = logging.handlers.RotatingFileHandler(
+                self.log_file, maxBytes=LOG_FILE_SIZE,
+                backupCount=LOG_FILE_BACKUP_COUNT)
+            log_file.setFormatter(JsonFormatter())
+            handlers.append(log_file)
+        return handlers
+
+    @property
+    def backend_config(self):
+        return (self.queue, self.level, self.subsystem_levels)
+
+    def configure_process(self):
+        """Routes records of the current process into the queue"""
+        configure_backend_process(self.backend_config)
+
+    def start(self):
+        global _pipeline
+        self.queue = multiprocessing.Queue()
+        rate_limiter = RateLimiter(self.rate_limit) if self.rate_limit > 0 \
+                       else None
+        self.listener = LogListener(self.queue, self.create_handlers(),
+                                    rate_limiter)
+        self.listener.start()
+        self.configure_process()
+        _pipeline = self
+
+    def stop(self):
+        """Writes the pending records and restores direct logging"""
+        global _pipeline
+        _pipeline = None
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        self.listener.stop()
+        for h in self.listener.handlers:
+            root.addHandler(h)
+
+
+def set_level(level, logger=None):
+    """Sets level of a logger (root logger by default) in the main
+    process, backend processes started later are configured with it.
+
+    Running backend processes have to be notified by their miners.
+    """
+    logging.getLogger(logger).setLevel(level)
+    if _pipeline is None:
+        return
+    if logger is None:
+        _pipeline.level = level
+    else:
+        _pipeline.subsystem_levels.append((logger, level))
+
+
+def get_backend_config():
+    """Configuration to be passed to a new backend process, see
+    configure_backend_process()
+
+    The queue can only be passed when the process is being created, e.g.
+    via initargs of ProcessPoolExecutor.
+
+    @return the configuration or None when there is no pipeline
+    """
+    if _pipeline is None:
+        return None
+    return _pipeline.backend_config
+
+
+def configure_backend_process(config):
+    """Attaches a backend process to the pipeline of the main process.
+
+    @param config - see get_backend_config(), the process keeps the
+    default configuration when None
+    """
+    if config is None:
+        return
+    (queue, level, subsystem_levels) = config
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    root.setLevel(level)
+    for (name, level) in subsystem_levels:
+        logging.getLogger(name).setLevel(level)
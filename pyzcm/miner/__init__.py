@@ -12,13 +12,72 @@ import logging
 import abc
 import binascii
 import time
-import asyncio
 
 from pyzcm.miner.params import *
-from pyzcm.stats import MinerStats
+from pyzcm.stats import MinerStats, NEAR_SHARE_FACTOR
+from pyzcm.equihash import SolutionVerifier
 
 # Miner statistics are refreshed/submitted every 2 seconds
 STATS_REFRESH_PERIOD = 2
+# Number of headers passed at once to solvers that support batching
+# and don't specify their preferred batch size
+POW_BATCH_SIZE = 4
+
+
+def solver_supports_batch(solver):
+    """Checks whether the solver implements the batched protocol.
+
+    Besides find_solutions()/get_solution(), a batching solver provides:
+    - find_solutions_batch(headers) - solves a list of headers in one
+      call and returns a sequence of header indices, one for each
+      solution found. Solution i belongs to headers[indices[i]] and is
+      retrieved by get_solution(i) as in the single header case.
+    - batch_size - (optional) preferred number of headers per call
+
+    Solutions of a batch can be read out by get_solution_buffer() as
+    well, see solver_supports_buffer().
+    """
+    return callable(getattr(solver, 'find_solutions_batch', None))
+
+
+def solver_supports_buffer(solver):
+    """Checks whether the solver provides zero-copy solution readout.
+
+    Such solver implements get_solution_buffer() that returns an object
+    supporting the buffer protocol (bytearray, memoryview, NumPy
+    array...) with all solutions of the last run. Each solution is
+    stored in ZC_LEN_AND_SOLUTION_LENGTH bytes long record that
+    starts with ZC_SOLUTION_LENGTH_PREFIX, i.e. in the form required by
+    the block header. The buffer may be reused by the next run.
+    """
+    return callable(getattr(solver, 'get_solution_buffer', None))
+
+
+def solver_supports_shared_context(solver_class):
+    """Checks whether instances of a GPU solver class can share one
+    device context.
+
+    Such class provides create_context(gpu_id) class method, the
+    context is passed to the solver as 'context' keyword argument.
+    """
+    return callable(getattr(solver_class, 'create_context', None))
+
+
+def iter_len_and_solutions(solver, sol_cnt):
+    """Provides length prefixed solutions of the last solver run.
+
+    Solutions of zero-copy solvers are slices of the solver buffer
+    that are only valid until the next run of the solver.
+    """
+    if solver_supports_buffer(solver):
+        buf = memoryview(solver.get_solution_buffer()).cast('B')
+        for i in range(sol_cnt):
+            yield buf[i * ZC_LEN_AND_SOLUTION_LENGTH:
+                      (i + 1) * ZC_LEN_AND_SOLUTION_LENGTH]
+    else:
+        for i in range(sol_cnt):
+            yield ZC_SOLUTION_LENGTH_PREFIX + solver.get_solution(i)
+
 
 class GenericMiner(object):
     def __init__(self, solver_nonce):
@@ -31,6 +90,11 @@ class GenericMiner(object):
         self.nonce2_int = 0
         self._log = None
         self.stats = MinerStats()
+        # fraction of shares verified locally before submission
+        self.verify_rate = 0
+        self.verifier = None
+        # fraction of time spent solving, see pace()
+        self.duty_cycle = 1.0
 
     @property
     def log(self):
@@ -66,16 +130,61 @@ class GenericMiner(object):
 
         return nonce2_bytes
 
+    def set_nonce2_position(self, nonce2_int):
+        """Continues the nonce2 sequence from the position unless it is
+        already further"""
+        self.nonce2_int = max(self.nonce2_int, nonce2_int)
+
+    def set_verify_rate(self, verify_rate):
+        """Enables local verification of the specified fraction of shares,
+        duplicate shares are filtered out whenever verification is enabled.
+        """
+        self.verify_rate = verify_rate
+        if verify_rate > 0:
+            self.verifier = SolutionVerifier(verify_rate)
+        else:
+            self.verifier = None
+
+    def verify_share(self, header, len_and_solution):
+        """Checks that a share is a valid and not yet submitted solution
+        """
+        if self.verifier is None:
+            return True
+        result = self.verifier.check(header, len_and_solution)
+        if result == self.verifier.DUPLICATE:
+            self.stats.update_duplicate_solutions(1)
+            self.log.warn('Dropping duplicate solution')
+            return False
+        if result == self.verifier.INVALID:
+            self.stats.update_invalid_solutions(1)
+            self.log.error('Dropping INVALID solution - solver may be broken')
+            return False
+        return True
+
+    def set_duty_cycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def pace(self, solving_time):
+        """Sleeps after a solver run so that solving takes only duty_cycle
+        fraction of the time
+        """
+        duty_cycle = self.duty_cycle
+        if duty_cycle < 1:
+            time.sleep(solving_time * (1 - duty_cycle) / duty_cycle)
+
     def submit_stats(self, stats):
         """Updates the current miner stats.
         """
         self.stats += stats
 
-    def update_accepted_stats(self, delta_time):
-        self.stats.update_accepted_shares(delta_time, 1)
+    def update_accepted_stats(self, delta_time, work=0):
+        self.stats.update_accepted_shares(delta_time, 1, work)
 
-    def update_rejected_stats(self, delta_time):
-        self.stats.update_rejected_shares(delta_time, 1)
+    def update_rejected_stats(self, delta_time, stale=False):
+        self.stats.update_rejected_shares(delta_time, 1, stale)
+
+    def update_lost_stats(self):
+        self.stats.update_lost_shares(1)
 
     @abc.abstractmethod
     def submit_solution(self, job, nonce2, len_and_solution):
@@ -85,34 +194,70 @@ class GenericMiner(object):
         """
         return
 
+    def run_solver(self, solver, headers, batch):
+        """Calls the solver, the profiler attributes the time spent here to
+        the solver (see pyzcm.profiler.SOLVER_FRAME)
+
+        @return index of the header of each solution
+        """
+        if batch:
+            return solver.find_solutions_batch(headers)
+        return [0] * solver.find_solutions(headers[0])
+
     def do_pow(self, solver, job):
         """Performs proof of work, delegating solution finding to
-        implementation specific solver
+        implementation specific solver.
+
+        Solvers that support batching (see solver_supports_batch())
+        are given several consecutive nonce2 headers at once.
         """
-        nonce2 = self.next_nonce2()
+        batch = solver_supports_batch(solver)
+        batch_size = getattr(solver, 'batch_size', POW_BATCH_SIZE) if batch else 1
+        nonce2s = [self.next_nonce2() for i in range(batch_size)]
 
-        self.log.debug('Solving nonce1:{0}, solver_nonce:{1}, nonce2:{2}'.format(
-            binascii.hexlify(self.nonce1),
-            binascii.hexlify(self.solver_nonce),
-            binascii.hexlify(nonce2)))
-        header = job.build_header(self.nonce1 + self.solver_nonce + nonce2)
+        # skip formatting of the debug messages on the hot path
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.log.debug('Solving nonce1:{0}, solver_nonce:{1}, nonce2:{2}'.format(
+                binascii.hexlify(self.nonce1),
+                binascii.hexlify(self.solver_nonce),
+                ','.join(binascii.hexlify(n).decode() for n in nonce2s)))
+        headers = [job.build_header(self.nonce1 + self.solver_nonce + n)
+                   for n in nonce2s]
         t1 = time.time()
-        sol_cnt = solver.find_solutions(header)
+        header_indices = self.run_solver(solver, headers, batch)
+        sol_cnt = len(header_indices)
         t2 = time.time()
+        if debug:
+            self.log.debug('Validating {0} solutions against target:{1:#066x}'.format(
+                sol_cnt, job.target))
+        near_target = job.target * NEAR_SHARE_FACTOR
+        found_cnt = 0
+        near_cnt = 0
+        for h, len_and_solution in zip(header_indices,
+                                       iter_len_and_solutions(solver, sol_cnt)):
+            hash_int = job.get_hash_int(headers[h], len_and_solution)
+            if hash_int < near_target:
+                near_cnt += 1
+            if hash_int < job.target:
+                found_cnt += 1
+                # Copy is needed only for valid shares - the solver
+                # buffer is overwritten by the next run
+                len_and_solution = bytes(len_and_solution)
+                if not self.verify_share(headers[h], len_and_solution):
+                    continue
+                self.log.info('FOUND VALID SOLUTION!')
+                self.submit_solution(job, nonce2s[h], len_and_solution)
         new_stats = MinerStats(sol_cnt, t2 - t1)
+        new_stats.update_solve_time(t2 - t1)
+        new_stats.update_solution_hashes(job.target, sol_cnt, found_cnt, near_cnt)
         self.submit_stats(new_stats)
-        self.log.debug('Validating {0} solutions against target:{1:#066x}'.format(
-            sol_cnt, job.target))
-        for i in range(sol_cnt):
-            # len_and_solution = job.get_len_and_solution(solver.get_solution(i)
-            len_and_solution = b'\xfd\x40\x05' + solver.get_solution(i)
-            if job.is_valid(header, len_and_solution):
-                self.log.info('FOUND VALID SOLUTION!')
-                self.submit_solution(job, nonce2, len_and_solution)
         t3 = time.time()
-        self.log.debug('{0} solutions found in {1} us, validated in {2} us, TOTAL: {3} us'.format(
-            sol_cnt,
-            *[int(1000000*x) for x in [t2 - t1, t3 - t2, t3 - t1]]))
+        if debug:
+            self.log.debug('{0} solutions found in {1} us, validated in {2} us, TOTAL: {3} us'.format(
+                sol_cnt,
+                *[int(1000000*x) for x in [t2 - t1, t3 - t2, t3 - t1]]))
+        self.pace(t2 - t1)
 
 
 class AsyncMiner(GenericMiner):
@@ -126,15 +271,31 @@ class AsyncMiner(GenericMiner):
         """
         super(AsyncMiner, self).__init__(solver_nonce)
         self._stop = False
+        self.paused = False
+        # start of mining (the first job)
+        self.time_start = None
         self.loop = loop
         self.on_share = None
         self.last_received_job = None
+        # model of the device (see _MinerInfo.get_device_model()), set by
+        # the MinerManager
+        self.device_model = None
 
-    def register_new_job(self, job, on_share):
+    @property
+    def miner_id(self):
+        """Identifies the miner, the solver nonce is unique among the
+        running miners"""
+        return int.from_bytes(self.solver_nonce, 'little')
+
+    def register_new_job(self, job, on_share, delta=None):
         """
         @param on_share - callback that accepts the found nonce and
         solution combined with the length prefix
+        @param delta - optional JobDelta of the job against the previous
+        job, miners with a backend process ship the delta only
         """
+        if self.time_start is None:
+            self.time_start = time.time()
         self.last_received_job = job
         self.on_share = on_share
 
@@ -147,6 +308,43 @@ class AsyncMiner(GenericMiner):
             job.job_id, binascii.hexlify(nonce2)))
         self.on_share(self, job, self.solver_nonce + nonce2, len_and_solution)
 
+    async def shutdown(self):
+        """Stops the miner before it is replaced, the current solver run
+        of a CPU miner can't be interrupted"""
+        self.stop()
+
+    def set_log_level(self, level, logger=None):
+        """Sets level of a logger in the processes of the miner, CPU
+        miners run in the main process"""
+        pass
+
+    def pause(self):
+        """Suspends solving after the current run, the miner keeps its
+        solvers and receives jobs while paused."""
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
     def stop(self):
-        raise Exception('FIXME')
+        """Stops the miner after the current run"""
         self._stop = True
+
+    @property
+    def worker_suffix(self):
+        """Device part of the worker name the miner submits under when
+        workers are per device, e.g. cpu0 or gpu0_1"""
+        device_id = self.device_id
+        if not isinstance(device_id, (tuple, list)):
+            device_id = (device_id,)
+        return '{0}{1}'.format(self.device_type,
+                               '_'.join(str(i) for i in device_id))
+
+    def get_resource_pids(self):
+        """Processes owned by the miner (their descendants included), see
+        pyzcm.resources"""
+        return []
+
+    def get_resource_thread_ids(self):
+        """Native ID's of threads of the main process owned by the miner"""
+        return []
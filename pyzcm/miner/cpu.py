@@ -9,23 +9,77 @@ MIT license
 """
 
 import asyncio
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 from pyzcm.miner import AsyncMiner
 
 class CpuMiner(AsyncMiner):
     """A CPU miner class - runs in a separate thread. """
+    device_type = 'cpu'
+
     def __init__(self, solver_nonce, loop, cpu_id, solver_class):
         super(CpuMiner, self).__init__(solver_nonce, loop)
         self.cpu_id = cpu_id
+        self.solver_class = solver_class
         self.solver = solver_class(verbose=self.is_logger_verbose())
+        # native ID of the solver thread for resource accounting
+        self.thread_id = None
+        # cleared while the miner is paused
+        self.resumed = threading.Event()
+        self.resumed.set()
+        # set once both the first job and nonce1 are available
+        self.job_ready = asyncio.Event()
 
     def __format__(self, format_spec):
         return 'CPU[{}]'.format(self.cpu_id)
 
+    @property
+    def device_id(self):
+        return self.cpu_id
+
     def run_cpu_solver(self):
-        while not self._stop:
+        get_native_id = getattr(threading, 'get_native_id', None)
+        if get_native_id is not None:
+            self.thread_id = get_native_id()
+        # identifies the miner in profiles
+        threading.current_thread().name = format(self)
+        while True:
+            self.resumed.wait()
+            if self._stop:
+                break
             self.do_pow(self.solver, self.last_received_job)
+        self.log.info('Stopped')
+
+    def get_resource_thread_ids(self):
+        return [self.thread_id] if self.thread_id is not None else []
+
+    def set_nonce1(self, nonce1):
+        super(CpuMiner, self).set_nonce1(nonce1)
+        self.check_job_ready()
+
+    def register_new_job(self, job, on_share, delta=None):
+        super(CpuMiner, self).register_new_job(job, on_share, delta)
+        self.check_job_ready()
+
+    def check_job_ready(self):
+        if self.last_received_job is not None and self.nonce1 is not None:
+            self.job_ready.set()
+
+    def pause(self):
+        super(CpuMiner, self).pause()
+        self.resumed.clear()
+
+    def resume(self):
+        super(CpuMiner, self).resume()
+        self.resumed.set()
+
+    def stop(self):
+        super(CpuMiner, self).stop()
+        # wake up a paused solver thread or a miner waiting for the
+        # first job so that it can finish
+        self.resumed.set()
+        self.job_ready.set()
 
     def submit_solution(self, job, nonce2, len_and_solution):
         """Override the default submission mechanism since the solution is
@@ -35,12 +89,9 @@ class CpuMiner(AsyncMiner):
         self.loop.call_soon_threadsafe(super(CpuMiner, self).submit_solution,
                                        job, nonce2, len_and_solution)
 
-    @asyncio.coroutine
-    def run(self):
+    async def run(self):
         self.log.info('Waiting for first mining job')
-        while self.last_received_job == None or self.nonce1 == None:
-            yield from asyncio.sleep(2)
-            self.log.debug('.')
+        await self.job_ready.wait()
         self.log.info('First job received')
         executor = ThreadPoolExecutor(max_workers=1)
-        yield from self.loop.run_in_executor(executor, self.run_cpu_solver)
+        await self.loop.run_in_executor(executor, self.run_cpu_solver)
@@ -11,8 +11,10 @@ MIT license
 """
 
 import asyncio
+import copy
 import multiprocessing
 import queue
+import threading
 import os
 import binascii
 import logging
@@ -21,16 +23,38 @@ import traceback
 import time
 
 from pyzcm.miner import GenericMiner, AsyncMiner, MinerStats
+from pyzcm.miner import solver_supports_shared_context
 from pyzcm.miner import STATS_REFRESH_PERIOD
+from pyzcm.logs import configure_backend_process
+from pyzcm.logs import get_backend_config as get_log_config
+from pyzcm.profiler import start_backend_profiler
+from pyzcm.profiler import get_backend_config as get_profile_config
+
+# Time the backend process has to finish its solver runs after stop()
+BACKEND_STOP_TIMEOUT = 30
 
 class _GpuMinerStats(MinerStats):
     """GPU Miner statistics is also a kind of result received from the
     mining process. Therefore, the class complies with the result interface.
     """
+    def __init__(self):
+        super(_GpuMinerStats, self).__init__()
+        # identifies the backend process for resource accounting
+        self.pid = os.getpid()
+        # nonce2 position of the backend process
+        self.nonce2_int = 0
+
     def submit(self, subscriber):
         subscriber.submit_stats(self)
 
 
+class _GpuMinerBackendTerminated(object):
+    """Wakes up the frontend after its backend process has been
+    killed"""
+    def submit(self, subscriber):
+        pass
+
+
 class _GpuMinerSolutionPack(object):
     """Solution pack that is to be submitted to the asynchronous part of
     the miner.
@@ -54,15 +78,97 @@ class _GpuMinerSolutionPack(object):
                                                      binascii.hexlify(self.nonce2))
 
 
+class _GpuMinerJob(object):
+    """Mining job for the backend process along with the nonce parts"""
+    def __init__(self, job, nonce1, solver_nonce):
+        self.job = job
+        self.nonce1 = nonce1
+        self.solver_nonce = solver_nonce
+
+    def apply(self, miner_process):
+        miner_process.set_job(self.job, self.nonce1, self.solver_nonce)
+
+
+class _GpuMinerJobUpdate(object):
+    """Changes of the current mining job of the backend process (see
+    JobDelta)"""
+    def __init__(self, delta):
+        # the base job stays in the frontend
+        self.job_id = delta.job_id
+        self.changes = delta.changes
+
+    def apply(self, miner_process):
+        miner_process.update_job(self)
+
+
+class _GpuMinerNonce2Position(object):
+    """Request for continuing the nonce2 sequence from a position"""
+    def __init__(self, nonce2_int):
+        self.nonce2_int = nonce2_int
+
+    def apply(self, miner_process):
+        miner_process.set_nonce2_position(self.nonce2_int)
+
+
+class _GpuMinerInstances(object):
+    """Request for changing the number of solver instances of the backend
+    process"""
+    def __init__(self, count):
+        self.count = count
+
+    def apply(self, miner_process):
+        miner_process.set_instances(self.count)
+
+
+class _GpuMinerPause(object):
+    """Request for suspending or resuming the solver instances"""
+    def __init__(self, paused):
+        self.paused = paused
+
+    def apply(self, miner_process):
+        miner_process.set_paused(self.paused)
+
+
+class _GpuMinerDutyCycle(object):
+    """Request for pacing the solver instances"""
+    def __init__(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def apply(self, miner_process):
+        miner_process.set_duty_cycle(self.duty_cycle)
+
+
+class _GpuMinerLogLevel(object):
+    """Request for changing level of a logger in the backend process"""
+    def __init__(self, level, logger):
+        self.level = level
+        self.logger = logger
+
+    def apply(self, miner_process):
+        logging.getLogger(self.logger).setLevel(self.level)
+
+
+class _GpuMinerStop(object):
+    """Request for terminating the backend process"""
+    def apply(self, miner_process):
+        miner_process.stop()
+
+
 class _GpuMinerProcess(GenericMiner):
     """This class represents a backend GPU miner that is run in a
     separate process. Typically 1-2 processes per GPU depending on how
     optimized the actual GPU solver is.
 
+    The process runs one or more solver instances in threads. The
+    instances share the device context (if supported by the solver,
+    see solver_supports_shared_context()), the nonce2 sequence and
+    the queues. The main thread processes messages from the work
+    queue and submits statistics.
+
     This class should not be instantiated, it used by GpuMiner asyncio
     aware implementation.
     """
-    def __init__(self, solver_nonce, gpu_id, solver_class):
+    def __init__(self, solver_nonce, gpu_id, solver_class, instances=1):
         self.solver_class = solver_class
         self.solution_count = 0
         self.gpu_id = gpu_id
@@ -73,60 +179,166 @@ class _GpuMinerProcess(GenericMiner):
         # overwrite the status with GPU specific stats
         self.stats = _GpuMinerStats()
         self.last_stats_processing = time.time()
+        self.instances = instances
+        self.instance_threads = []
+        self.context = None
+        self.job = None
+        self.job_ready = threading.Event()
+        # cleared while the miner is paused
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.running = True
+        # protects nonce2 and stats shared by the instances
+        self.lock = threading.Lock()
 
     def __format__(self, format_spec):
         return 'GPU[{0}:{1}](pid={2})'.format(self.gpu_id[0], self.gpu_id[1],
                                               os.getpid())
 
+    def next_nonce2(self):
+        with self.lock:
+            return super(_GpuMinerProcess, self).next_nonce2()
+
+    def submit_stats(self, stats):
+        with self.lock:
+            super(_GpuMinerProcess, self).submit_stats(stats)
+
+    def set_nonce2_position(self, nonce2_int):
+        with self.lock:
+            super(_GpuMinerProcess, self).set_nonce2_position(nonce2_int)
+
     def submit_solution(self, job, nonce2, len_and_solution):
         assert(self.result_queue is not None)
         self.result_queue.put(_GpuMinerSolutionPack(job, nonce2, len_and_solution))
 
+    def set_job(self, job, nonce1, solver_nonce):
+        self.log.info('received mining job_id:{0}, nonce1:{1}, solver_nonce:{2}'.
+                      format(job.job_id, binascii.hexlify(nonce1),
+                             binascii.hexlify(solver_nonce)))
+        self.nonce1 = nonce1
+        self.solver_nonce = solver_nonce
+        self.job = job
+        self.job_ready.set()
+
+    def update_job(self, update):
+        """Patches a copy of the current job, solver runs in progress keep
+        the job they have started with. The nonce2 sequence continues."""
+        self.log.info('received update of mining job to job_id:{0}, '
+                      'changes: {1}'.format(update.job_id,
+                                            ', '.join(sorted(update.changes))))
+        job = copy.copy(self.job)
+        vars(job).update(update.changes)
+        self.job = job
+
+    def set_instances(self, count):
+        """Starts missing instances, surplus instances stop after finishing
+        their current run"""
+        self.log.info('Running {} solver instances'.format(count))
+        self.instances = count
+        for i in range(count):
+            if i < len(self.instance_threads) and self.instance_threads[i].is_alive():
+                continue
+            t = threading.Thread(target=self.run_instance, args=(i,),
+                                 name='{0}-solver-{1}'.format(self, i),
+                                 daemon=True)
+            if i < len(self.instance_threads):
+                self.instance_threads[i] = t
+            else:
+                self.instance_threads.append(t)
+            t.start()
+
+    def set_paused(self, paused):
+        self.log.info('Pausing solver instances' if paused else
+                      'Resuming solver instances')
+        if paused:
+            self.resumed.clear()
+        else:
+            self.resumed.set()
+
+    def stop(self):
+        """Retires all instances and terminates the message loop"""
+        self.log.info('Stopping')
+        self.running = False
+        self.instances = 0
+        # wake up instances waiting for a job or resume
+        self.job_ready.set()
+        self.resumed.set()
+
+    def create_solver(self):
+        self.log.debug('Instantiating GPU solver {0}, verbose={1}, shared context={2}'.format(
+            self.solver_class, self.is_logger_verbose(), self.context is not None))
+        if self.context is not None:
+            return self.solver_class(self.gpu_id, verbose=self.is_logger_verbose(),
+                                     context=self.context)
+        return self.solver_class(self.gpu_id, verbose=self.is_logger_verbose())
+
+    def run_instance(self, index):
+        try:
+            solver = self.create_solver()
+            self.log.debug('Instance {0} waiting for the first job'.format(index))
+            self.job_ready.wait()
+            while True:
+                self.resumed.wait()
+                if index >= self.instances:
+                    break
+                self.do_pow(solver, self.job)
+            self.log.info('Instance {0} stopped'.format(index))
+        except Exception as e:
+            self.log.error('FATAL:{0}{1}'.format(e, traceback.format_exc()))
+
     def run(self, result_queue, work_queue):
-        self.log.debug('Instantiating GPU solver process {0}, verbose={1}'.format(
-            self.solver_class, self.is_logger_verbose()))
-        solver = self.solver_class(self.gpu_id, verbose=self.is_logger_verbose())
-        self.log.debug('Instantiated GPU solver {0}, verbose={1}'.format(
-            self.solver_class, self.is_logger_verbose()))
         self.result_queue = result_queue
-        job = None
-        while True:
-            # TODO: rewrite, no need for waiting on nonce1 and job
-            # Fetch a new job if available
+        if solver_supports_shared_context(self.solver_class):
+            self.log.debug('Creating shared device context')
+            self.context = self.solver_class.create_context(self.gpu_id)
+        self.set_instances(self.instances)
+        while self.running:
             try:
-                # non-blocking read from the queue
-                (job, self.nonce1, self.solver_nonce) = work_queue.get(False)
-                self.log.info('received mining job_id:{0}, nonce1:{1}, solver_nonce:{2}'.
-                              format(job.job_id, binascii.hexlify(self.nonce1),
-                                     binascii.hexlify(self.solver_nonce)))
+                message = work_queue.get(timeout=STATS_REFRESH_PERIOD)
+                message.apply(self)
             except queue.Empty:
-                if job == None or self.nonce1 == None:
-                    self.log.debug('No nonce1, waiting')
-                    time.sleep(2)
-                    print('.', end='', flush=True)
-                    continue
-                else:
-                    self.log.debug('No new job, running POW on old job')
-            self.do_pow(solver, job)
+                pass
             self.process_new_stats(result_queue)
+        # the final stats also wake up the frontend so that it can stop
+        self.process_new_stats(result_queue, force=True)
 
-    def process_new_stats(self, result_queue):
+    def process_new_stats(self, result_queue, force=False):
         """
         Processes new statistics by submitting them via the result queue if the refresh period has elapsed already
         """
         now = time.time()
-        if (time.time() - self.last_stats_processing) > STATS_REFRESH_PERIOD:
-            result_queue.put(self.stats)
-            self.stats = _GpuMinerStats()
+        if force or (time.time() - self.last_stats_processing) > STATS_REFRESH_PERIOD:
+            with self.lock:
+                stats = self.stats
+                stats.nonce2_int = self.nonce2_int
+                self.stats = _GpuMinerStats()
+            result_queue.put(stats)
             self.last_stats_processing = now
 
-def run_miner_process(solver_nonce, gpu_id, solver_class, result_queue, work_queue):
+def run_miner_process(solver_nonce, gpu_id, solver_class, verify_rate,
+                      instances, duty_cycle, result_queue, work_queue,
+                      profile_config=None):
+    """Backend process entry point, the logging of the process has to be
+    configured by configure_backend_process() when the process is
+    started (the log queue cannot be passed as an argument)
+
+    @param profile_config - see pyzcm.profiler.get_backend_config()
+    """
+    profiler = None
     try:
-        miner_process = _GpuMinerProcess(solver_nonce, gpu_id, solver_class)
+        miner_process = _GpuMinerProcess(solver_nonce, gpu_id, solver_class,
+                                         instances)
+        profiler = start_backend_profiler(profile_config,
+                                          format(miner_process))
+        miner_process.set_verify_rate(verify_rate)
+        miner_process.set_duty_cycle(duty_cycle)
         logging.debug('Instantiated MinerProcess')
         miner_process.run(result_queue, work_queue)
     except Exception as e:
         logging.error('FATAL:{0}{1}'.format(e, traceback.format_exc()))
+    finally:
+        if profiler is not None:
+            profiler.stop()
 
 
 class GpuMiner(AsyncMiner):
@@ -134,14 +346,26 @@ class GpuMiner(AsyncMiner):
     asyncio framework and controls and instance of GpuMinerProcess()
     The miner communicates with the backend process via queues.
     """
-    def __init__(self, solver_nonce, loop, gpu_id, solver_class):
+    device_type = 'gpu'
+
+    def __init__(self, solver_nonce, loop, gpu_id, solver_class, instances=1):
         """
         @param gpu_id - a tuple, that contains: platform_id and device_id
+        @param instances - number of solver instances run by the backend
+        process
         """
         self.solver_class = solver_class
-        mgr = multiprocessing.Manager()
-        self.work_queue = mgr.Queue()
-        self.result_queue = mgr.Queue()
+        self.instances = instances
+        self.mgr = multiprocessing.Manager()
+        self.work_queue = self.mgr.Queue()
+        self.result_queue = self.mgr.Queue()
+        # reported by the backend process along with its stats
+        self.backend_pid = None
+        self.proc_executor = None
+        # resolved when the backend process finishes
+        self.backend = None
+        # the job the backend process is working on
+        self.backend_job = None
 #        self.miner_process = GpuMinerProcess(gpu_id, self.solver_class)
         self.gpu_id = gpu_id
         super(GpuMiner, self).__init__(solver_nonce, loop)
@@ -163,14 +387,92 @@ class GpuMiner(AsyncMiner):
         if self.last_received_job is not None and self.nonce1 is not None:
             self.log.info('Queueing new job: 0x{}'.format(
                 self.last_received_job.job_id))
-            self.work_queue.put((self.last_received_job, self.nonce1, self.solver_nonce))
+            self.work_queue.put(_GpuMinerJob(self.last_received_job, self.nonce1,
+                                             self.solver_nonce))
+            self.backend_job = self.last_received_job
 
-    def register_new_job(self, job, on_share):
-        super(GpuMiner, self).register_new_job(job, on_share)
-        self._enqueue_last_mining_job()
+    def set_instances(self, count):
+        """Changes the number of solver instances without restarting the
+        backend process"""
+        self.instances = count
+        self.work_queue.put(_GpuMinerInstances(count))
+
+    def pause(self):
+        super(GpuMiner, self).pause()
+        self.work_queue.put(_GpuMinerPause(True))
+
+    def resume(self):
+        super(GpuMiner, self).resume()
+        self.work_queue.put(_GpuMinerPause(False))
+
+    def set_duty_cycle(self, duty_cycle):
+        if duty_cycle != self.duty_cycle:
+            super(GpuMiner, self).set_duty_cycle(duty_cycle)
+            self.work_queue.put(_GpuMinerDutyCycle(duty_cycle))
+
+    def set_log_level(self, level, logger=None):
+        self.work_queue.put(_GpuMinerLogLevel(level, logger))
+
+    def stop(self):
+        super(GpuMiner, self).stop()
+        self.work_queue.put(_GpuMinerStop())
+
+    async def shutdown(self, timeout=BACKEND_STOP_TIMEOUT):
+        """Stops the miner and waits for the backend process, the process
+        is killed when it doesn't finish within the timeout (e.g. a solver
+        call hung in the driver)"""
+        self.stop()
+        if self.backend is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self.backend), timeout)
+        except asyncio.TimeoutError:
+            self.log.warn('Backend process did not stop within {} s, ' \
+                          'killing it'.format(timeout))
+            # the future fails with BrokenProcessPool
+            self.backend.add_done_callback(lambda f: f.exception())
+            # ProcessPoolExecutor has no public way to kill its workers
+            for p in list(self.proc_executor._processes.values()):
+                p.kill()
+            self.result_queue.put(_GpuMinerBackendTerminated())
+        self.proc_executor.shutdown(wait=False)
+
+    def register_new_job(self, job, on_share, delta=None):
+        """Ships only the changes of a job that refreshes the job of the
+        backend process"""
+        super(GpuMiner, self).register_new_job(job, on_share, delta)
+        if delta is not None and delta.base is self.backend_job:
+            self.log.info('Queueing update of job: 0x{0} -> 0x{1}'.format(
+                delta.base.job_id, job.job_id))
+            self.work_queue.put(_GpuMinerJobUpdate(delta))
+            self.backend_job = job
+        else:
+            self._enqueue_last_mining_job()
+
+    def submit_stats(self, stats):
+        super(GpuMiner, self).submit_stats(stats)
+        self.backend_pid = stats.pid
+        self.nonce2_int = max(self.nonce2_int, stats.nonce2_int)
+
+    def set_nonce2_position(self, nonce2_int):
+        super(GpuMiner, self).set_nonce2_position(nonce2_int)
+        self.work_queue.put(_GpuMinerNonce2Position(nonce2_int))
+
+    @property
+    def device_id(self):
+        return self.gpu_id
+
+    def get_resource_pids(self):
+        """The backend process (with all its solver instances) and the
+        process of the queue manager"""
+        pids = [getattr(getattr(self.mgr, '_process', None), 'pid', None),
+                self.backend_pid]
+        return [pid for pid in pids if pid is not None]
 
     def __format__(self, format_spec):
         gpu_str = 'GPU[{0}:{1}-{2}]'.format(self.gpu_id[0], self.gpu_id[1], int.from_bytes(self.solver_nonce, 'little'))
+        if self.instances > 1:
+            gpu_str += 'x{}'.format(self.instances)
         # short version omits the prefix
         if format_spec.endswith('s'):
             prefix = ''
@@ -179,21 +481,24 @@ class GpuMiner(AsyncMiner):
 
         return prefix + gpu_str
 
-    @asyncio.coroutine
-    def run(self):
+    async def run(self):
         self.log.debug('Starting process backend')
-        proc_executor = ProcessPoolExecutor(max_workers=1)
-        self.loop.run_in_executor(proc_executor,
-                                  run_miner_process, self.solver_nonce,
-                                  self.gpu_id, self.solver_class,
-                                  self.result_queue, self.work_queue)
+        self.proc_executor = ProcessPoolExecutor(
+            max_workers=1, initializer=configure_backend_process,
+            initargs=(get_log_config(),))
+        self.backend = self.loop.run_in_executor(
+            self.proc_executor, run_miner_process, self.solver_nonce,
+            self.gpu_id, self.solver_class, self.verify_rate, self.instances,
+            self.duty_cycle, self.result_queue, self.work_queue,
+            get_profile_config())
 #        self.loop.run_in_executor(ProcessPoolExecutor(max_workers=1),
 #                                  self.miner_process.run, self.result_queue, self.work_queue)
 
         executor = ThreadPoolExecutor(max_workers=1)
         while not self._stop:
-            result = yield from self.loop.run_in_executor(executor,
+            result = await self.loop.run_in_executor(executor,
                                                           self.result_queue.get)
             self.log.debug('Received result: {0} from GPU process, submitting'.
                            format(result))
             result.submit(self)
+        self.log.info('Backend process stopped')
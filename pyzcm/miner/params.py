@@ -9,3 +9,6 @@ MIT license
 ZC_BLOCK_HEADER_LENGTH = 140
 ZC_NONCE_LENGTH = 32
 ZC_SOLUTION_LENGTH = 1344
+# compact size prefix of the solution (1344 bytes) in the block header
+ZC_SOLUTION_LENGTH_PREFIX = b'\xfd\x40\x05'
+ZC_LEN_AND_SOLUTION_LENGTH = len(ZC_SOLUTION_LENGTH_PREFIX) + ZC_SOLUTION_LENGTH
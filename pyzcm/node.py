@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""Stand-in zcash node for testing solo mining
+
+'python -m pyzcm.node' serves the JSON-RPC subset used by GbtClient:
+- getblocktemplate - templates with a coinbase transaction and a few
+  random transactions, longpoll requests are held until a new block
+  arrives
+- submitblock - the block is checked (previous block, transactions,
+  merkle root, target and optionally the Equihash solution) and
+  becomes the new tip when accepted
+
+Blocks found by the 'network' arrive at random with the mean interval
+of '--block-time'. The node reports submitted blocks and how fast the
+pending longpoll requests were notified about new blocks.
+
+The transactions are not valid zcash transactions, the node only
+checks that the miner includes them unchanged. The FakeSolver backend
+finds blocks without solving Equihash:
+
+    pyzcm -g -1 -c 1 -s cpu=fake --verify-solutions 0 http://user:x@localhost:8232
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import random
+import struct
+import time
+
+from pyzcm.miner.params import *
+from pyzcm.equihash import verify_solutions
+from pyzcm.eventloop import new_event_loop, available_event_loops, \
+    DEFAULT_EVENT_LOOP
+from pyzcm.gbt import sha256d, compact_size, merkle_root, GBT_DEFAULT_PORT
+from pyzcm.stats import HASH_SPACE
+
+BLOCK_VERSION = 4
+# Mean interval between blocks of the network (zcash target spacing)
+BLOCK_TIME = 75
+# Expected number of solutions per block
+DIFFICULTY = 64
+TEMPLATE_TRANSACTIONS = 3
+TRANSACTION_SIZE = 250
+
+
+def target_to_bits(target):
+    """Compact representation of the target as in the block header"""
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << 8 * (3 - size)
+    else:
+        mantissa = target >> 8 * (size - 3)
+    if mantissa & 0x800000:
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+
+def bits_to_target(bits):
+    size = bits >> 24
+    mantissa = bits & 0x7fffff
+    if size <= 3:
+        return mantissa >> 8 * (3 - size)
+    return mantissa << 8 * (size - 3)
+
+
+def to_display_hex(h):
+    """Hash in the internal byte order as displayed by the node"""
+    return binascii.hexlify(h[::-1]).decode()
+
+
+def random_transaction():
+    data = os.urandom(TRANSACTION_SIZE)
+    return {'data': binascii.hexlify(data).decode(),
+            'hash': to_display_hex(sha256d(data))}
+
+
+class BlockTemplate(object):
+    """Template for mining on top of the current tip"""
+    def __init__(self, height, prev_hash, bits, longpollid):
+        self.height = height
+        self.prev_hash = prev_hash
+        self.bits = bits
+        self.longpollid = longpollid
+        self.coinbase = random_transaction()
+        self.transactions = [random_transaction()
+                             for i in range(TEMPLATE_TRANSACTIONS)]
+        self.tx_data = b''.join(binascii.unhexlify(t['data'])
+                                for t in [self.coinbase] + self.transactions)
+        self.merkle_root = merkle_root([
+            binascii.unhexlify(t['hash'])[::-1]
+            for t in [self.coinbase] + self.transactions])
+        self.block_commitments = os.urandom(32)
+        self.curtime = int(time.time())
+
+    def as_dict(self):
+        return {'version': BLOCK_VERSION,
+                'previousblockhash': to_display_hex(self.prev_hash),
+                'coinbasetxn': self.coinbase,
+                'transactions': self.transactions,
+                'defaultroots': {
+                    'merkleroot': to_display_hex(self.merkle_root),
+                    'blockcommitmentshash': to_display_hex(
+                        self.block_commitments)},
+                'longpollid': self.longpollid,
+                'target': '{:064x}'.format(bits_to_target(self.bits)),
+                'curtime': self.curtime,
+                'bits': '{:08x}'.format(self.bits),
+                'height': self.height}
+
+
+class NodeStats(object):
+    def __init__(self):
+        self.accepted = 0
+        self.stale = 0
+        self.rejected = 0
+        self.network_blocks = 0
+        # time between a new block and notifying the longpoll requests
+        self.notify_latencies = []
+
+    def __format__(self, format_spec):
+        s = 'mined: {0}, network: {1}, stale: {2}, rejected: {3}'.format(
+            self.accepted, self.network_blocks, self.stale, self.rejected)
+        if self.notify_latencies:
+            s += ', longpoll notification: {0:.01f} ms (max {1:.01f} ms)'.format(
+                sum(self.notify_latencies) / len(self.notify_latencies) * 1e3,
+                max(self.notify_latencies) * 1e3)
+        return s
+
+
+class StandInNode(object):
+    """JSON-RPC server that serves block templates"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'StandInNode'))
+
+    def __init__(self, loop, block_time=BLOCK_TIME, difficulty=DIFFICULTY,
+                 auth=None, verify=False):
+        """
+        @param auth - required 'user:password', None = any
+        @param verify - verify Equihash solutions of submitted blocks
+        """
+        self.loop = loop
+        self.block_time = block_time
+        self.bits = target_to_bits(HASH_SPACE // difficulty)
+        self.auth = auth
+        self.verify = verify
+        self.stats = NodeStats()
+        self.height = 1
+        self.tip = os.urandom(32)
+        self.template_count = 0
+        # templates of the current tip by merkle root
+        self.templates = {}
+        self.new_block = asyncio.Event()
+        self.t_new_block = None
+        self.longpoll_count = 0
+
+    def new_template(self):
+        self.template_count += 1
+        template = BlockTemplate(self.height, self.tip, self.bits,
+                                 '{0}{1}'.format(to_display_hex(self.tip),
+                                                 self.template_count))
+        self.templates[template.merkle_root] = template
+        return template
+
+    def set_tip(self, block_hash):
+        self.tip = block_hash
+        self.height += 1
+        self.templates = {}
+        self.t_new_block = time.time()
+        # wake up the longpoll requests
+        self.new_block.set()
+        self.new_block = asyncio.Event()
+
+    async def generate_blocks(self):
+        """Blocks found by the rest of the network"""
+        while True:
+            await asyncio.sleep(random.expovariate(1.0 / self.block_time))
+            self.stats.network_blocks += 1
+            self.set_tip(os.urandom(32))
+            print('Network block at height {0}, {1}'.format(self.height - 1,
+                                                             self.stats))
+
+    async def getblocktemplate(self, request=None):
+        longpollid = (request or {}).get('longpollid')
+        template = None
+        if longpollid is not None and \
+           longpollid.startswith(to_display_hex(self.tip)):
+            self.longpoll_count += 1
+            await self.new_block.wait()
+            template = self.new_template()
+            self.stats.notify_latencies.append(time.time() - self.t_new_block)
+        return (template or self.new_template()).as_dict()
+
+    async def submitblock(self, block_hex):
+        block = binascii.unhexlify(block_hex)
+        header = block[:ZC_BLOCK_HEADER_LENGTH]
+        len_and_solution = block[ZC_BLOCK_HEADER_LENGTH:
+                                 ZC_BLOCK_HEADER_LENGTH +
+                                 ZC_LEN_AND_SOLUTION_LENGTH]
+        block_hash = sha256d(header + len_and_solution)
+        result = self.check_block(header, len_and_solution,
+                                  block[ZC_BLOCK_HEADER_LENGTH +
+                                        ZC_LEN_AND_SOLUTION_LENGTH:],
+                                  block_hash)
+        if result is None:
+            self.stats.accepted += 1
+            self.set_tip(block_hash)
+            print('Block {0} accepted at height {1}, {2}'.format(
+                to_display_hex(block_hash), self.height - 1, self.stats))
+        else:
+            if result.startswith('stale'):
+                self.stats.stale += 1
+            else:
+                self.stats.rejected += 1
+            print('Block {0} rejected: {1}, {2}'.format(
+                to_display_hex(block_hash), result, self.stats))
+        return result
+
+    def check_block(self, header, len_and_solution, tx_part, block_hash):
+        """@return None if the block is accepted, reason of rejection
+        otherwise"""
+        if len(header) != ZC_BLOCK_HEADER_LENGTH or \
+           len(len_and_solution) != ZC_LEN_AND_SOLUTION_LENGTH or \
+           not len_and_solution.startswith(ZC_SOLUTION_LENGTH_PREFIX):
+            return 'bad-block-length'
+        if header[4:36] != self.tip:
+            return 'stale-prevblk'
+        template = self.templates.get(header[36:68])
+        if template is None:
+            return 'bad-txnmrklroot'
+        if tx_part != compact_size(len(template.transactions) + 1) + \
+           template.tx_data:
+            return 'bad-txns'
+        if header[68:100] != template.block_commitments or \
+           struct.unpack('<I', header[104:108])[0] != self.bits:
+            return 'bad-header'
+        if int.from_bytes(block_hash, 'little') >= bits_to_target(self.bits):
+            return 'high-hash'
+        if self.verify and not verify_solutions(
+                header, [len_and_solution[len(ZC_SOLUTION_LENGTH_PREFIX):]])[0]:
+            return 'invalid-solution'
+        return None
+
+    async def handle_client(self, reader, writer):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            headers = {}
+            for line in head.decode().split('\r\n')[1:]:
+                if ':' in line:
+                    (name, value) = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(
+                int(headers.get('content-length', 0)))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError):
+            writer.close()
+            return
+        if self.auth is not None and headers.get('authorization') != \
+           'Basic {}'.format(base64.b64encode(self.auth.encode()).decode()):
+            self.respond(writer, 401, b'')
+            return
+        msg = json.loads(body.decode())
+        self.log.info('Request: {}'.format(msg['method']))
+        response = {'id': msg['id'], 'result': None, 'error': None}
+        if msg['method'] == 'getblocktemplate':
+            response['result'] = await self.getblocktemplate(*msg['params'])
+        elif msg['method'] == 'submitblock':
+            response['result'] = await self.submitblock(*msg['params'])
+        else:
+            response['error'] = {'code': -32601, 'message': 'Method not found'}
+        self.respond(writer, 200, json.dumps(response).encode())
+
+    def respond(self, writer, status, body):
+        writer.write('HTTP/1.1 {0} {1}\r\n' \
+                     'Content-Type: application/json\r\n' \
+                     'Content-Length: {2}\r\n' \
+                     'Connection: close\r\n\r\n'.format(
+                         status, 'OK' if status == 200 else 'Unauthorized',
+                         len(body)).encode() + body)
+        writer.close()
+
+
+def main():
+    """Serve block templates to a solo miner"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('-p', '--port', dest='port', default=GBT_DEFAULT_PORT,
+                        type=int, help='Port to listen on')
+    parser.add_argument('-b', '--block-time', dest='block_time',
+                        default=BLOCK_TIME, type=float,
+                        help='Mean interval of network blocks in seconds')
+    parser.add_argument('-d', '--difficulty', dest='difficulty',
+                        default=DIFFICULTY, type=int,
+                        help='Expected number of solutions per block')
+    parser.add_argument('--rpc-auth', dest='auth', default=None,
+                        help='Required USER:PASSWORD')
+    parser.add_argument('--verify-solutions', dest='verify',
+                        action='store_true',
+                        help='Verify Equihash solutions of submitted blocks')
+    parser.add_argument('--event-loop', dest='event_loop',
+                        default=DEFAULT_EVENT_LOOP,
+                        choices=available_event_loops())
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
+
+    loop = new_event_loop(args.event_loop)
+    node = StandInNode(loop, args.block_time, args.difficulty, args.auth,
+                       args.verify)
+    listener = loop.run_until_complete(asyncio.start_server(
+        node.handle_client, 'localhost', args.port))
+    blocks = loop.create_task(node.generate_blocks())
+    print('Listening on localhost:{}'.format(args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    blocks.cancel()
+    listener.close()
+    loop.run_until_complete(asyncio.wait([blocks, loop.create_task(
+        listener.wait_closed())]))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
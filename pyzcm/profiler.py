@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""Sampling profiler of the miner processes
+
+Each process of the miner (the main process with the event loop and
+the CPU solver threads, GPU backend processes with their solver
+instances) runs a sampler thread that takes stacks of all other
+threads PROFILE_RATE times per second. A sample is weighted by the CPU
+time the thread has consumed since the previous sample so that threads
+waiting for work don't distort the profile (the weight is the sampling
+period where per thread CPU clocks are not available). The wall-clock
+time since the previous sample is recorded as well - GPU solver calls
+spend most of the time waiting for the device and consume little CPU
+time.
+
+The sampler is a thread rather than a SIGPROF handler - Python runs
+signal handlers in the main thread between bytecodes only and the
+signal would interrupt system calls of the solver drivers.
+
+Stacks are aggregated per process and thread (solver threads are named
+after their miner) and written in the collapsed stack format (one
+'frame;frame;... weight' line per stack, see flamegraph.pl or
+speedscope) into DIR/pyzcm-PID.folded (CPU time) and
+DIR/pyzcm-PID-wall.folded (wall-clock time) when the process exits or when
+the main process receives PROFILE_DUMP_SIGNAL. The main process then
+touches DIR/PROFILE_DUMP_REQUEST, which the backend processes check
+every PROFILE_DUMP_CHECK_PERIOD seconds. A signal is not forwarded, because
+processes started by 'spawn' don't have the handler until they run
+their code. 'pyzcm profile DIR' merges the files and summarizes the
+time spent in solver calls (SOLVER_FRAME) and in the Python code
+around them.
+
+The backend processes are given the settings of the main process (see
+get_backend_config()) as an argument, regardless of the
+multiprocessing start method.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import argparse
+import collections
+import glob
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+# Samples per second, not a divisor of common timer periods
+PROFILE_RATE = 97
+PROFILE_DUMP_SIGNAL = getattr(signal, 'SIGUSR1', None)
+# Touched by the main process to make the backends write their profiles
+PROFILE_DUMP_REQUEST = 'dump-request'
+# Seconds between checks of the dump request file by the backends
+PROFILE_DUMP_CHECK_PERIOD = 1
+# Frame of GenericMiner that calls the solver
+SOLVER_FRAME = 'pyzcm.miner:run_solver'
+# Weight of a sample in the files (microseconds)
+WEIGHT_UNIT = 1e-6
+WALL_SUFFIX = '-wall'
+
+# Profiler of the current process
+_profiler = None
+
+
+def get_frame_name(frame):
+    return '{0}:{1}'.format(frame.f_globals.get('__name__', '?'),
+                            frame.f_code.co_name)
+
+
+def get_thread_cpu_time(thread_id):
+    """@return CPU time of the thread or None where not supported"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError):
+        return None
+
+
+class SamplingProfiler(object):
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'SamplingProfiler'))
+
+    def __init__(self, path, rate=PROFILE_RATE, label=None, backend=False):
+        """
+        @param path - directory of the collapsed stack files
+        @param label - root frame of the stacks of this process
+        @param backend - profiler of a backend process, it follows the dump
+        requests of the main process
+        """
+        self.path = path
+        self.rate = rate
+        self.label = label or 'main(pid={})'.format(os.getpid())
+        self.backend = backend
+        # (thread name, frame names) -> weight
+        self.samples = collections.Counter()
+        self.wall_samples = collections.Counter()
+        self.cpu_times = {}
+        self.last_sample_time = None
+        self.thread = None
+        self.running = False
+        self.dump_requested = threading.Event()
+        # modification time of the dump request file when last checked
+        self.last_request = None
+
+    def get_filename(self, suffix=''):
+        return os.path.join(self.path, 'pyzcm-{0}{1}.folded'.format(
+            os.getpid(), suffix))
+
+    @property
+    def request_filename(self):
+        return os.path.join(self.path, PROFILE_DUMP_REQUEST)
+
+    def get_request_time(self):
+        try:
+            return os.stat(self.request_filename).st_mtime
+        except OSError:
+            return None
+
+    def request_backend_dump(self):
+        try:
+            with open(self.request_filename, 'w') as f:
+                f.write('{}\n'.format(time.time()))
+        except OSError as e:
+            self.log.error('Cannot request profiles of backends: {}'.format(e))
+
+    def check_dump_request(self):
+        request_time = self.get_request_time()
+        if request_time != self.last_request:
+            self.last_request = request_time
+            self.dump_requested.set()
+
+    def sample(self):
+        threads = {t.ident: t.name for t in threading.enumerate()}
+        now = time.time()
+        wall_time = 1 / self.rate if self.last_sample_time is None else \
+                    now - self.last_sample_time
+        self.last_sample_time = now
+        cpu_times = {}
+        for (thread_id, frame) in sys._current_frames().items():
+            if thread_id == self.thread.ident:
+                continue
+            weight = wall_time
+            cpu_time = get_thread_cpu_time(thread_id)
+            if cpu_time is not None:
+                cpu_times[thread_id] = cpu_time
+                weight = cpu_time - self.cpu_times.get(thread_id, cpu_time)
+            stack = []
+            while frame is not None:
+                stack.append(get_frame_name(frame))
+                frame = frame.f_back
+            key = (threads.get(thread_id, str(thread_id)),
+                   tuple(reversed(stack)))
+            self.wall_samples[key] += int(wall_time / WEIGHT_UNIT)
+            weight = int(weight / WEIGHT_UNIT)
+            if weight > 0:
+                self.samples[key] += weight
+        # forget threads that have finished
+        self.cpu_times = cpu_times
+
+    def run(self):
+        period = 1 / self.rate
+        last_check = time.time()
+        while self.running:
+            time.sleep(period)
+            self.sample()
+            if self.backend and \
+               time.time() - last_check > PROFILE_DUMP_CHECK_PERIOD:
+                last_check = time.time()
+                self.check_dump_request()
+            if self.dump_requested.is_set():
+                self.dump_requested.clear()
+                if not self.backend:
+                    self.request_backend_dump()
+                self.dump()
+
+    def write(self, filename, samples):
+        tmp_filename = '{}.tmp'.format(filename)
+        with open(tmp_filename, 'w') as f:
+            for ((thread_name, stack), weight) in samples.items():
+                f.write('{0};{1};{2} {3}\n'.format(
+                    self.label, thread_name.replace(';', ','),
+                    ';'.join(stack), weight))
+        os.replace(tmp_filename, filename)
+
+    def dump(self):
+        try:
+            self.write(self.get_filename(), self.samples)
+            self.write(self.get_filename(WALL_SUFFIX), self.wall_samples)
+        except OSError as e:
+            self.log.error('Cannot write profile: {}'.format(e))
+            return
+        self.log.info('Profile written into {}'.format(self.get_filename()))
+
+    def start(self):
+        global _profiler
+        os.makedirs(self.path, exist_ok=True)
+        # requests made before the start don't apply
+        self.last_request = self.get_request_time()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='profiler',
+                                       daemon=True)
+        self.thread.start()
+        if PROFILE_DUMP_SIGNAL is not None and \
+           threading.current_thread() is threading.main_thread():
+            signal.signal(PROFILE_DUMP_SIGNAL, _request_dump)
+        _profiler = self
+        self.log.info('Sampling {0} at {1} Hz'.format(self.label, self.rate))
+
+    def stop(self):
+        """Stops sampling and writes the profile"""
+        self.running = False
+        self.thread.join()
+        self.dump()
+
+
+def _request_dump(signum, frame):
+    if _profiler is not None:
+        _profiler.dump_requested.set()
+
+
+def get_backend_config():
+    """Settings to be passed to a new backend process, see
+    start_backend_profiler()
+
+    @return the settings or None when the main process is not profiled
+    """
+    if _profiler is None:
+        return None
+    return (_profiler.path, _profiler.rate)
+
+
+def start_backend_profiler(config, label):
+    """Starts profiling of a backend process when the main process is
+    profiled.
+
+    @param config - see get_backend_config()
+    @return the profiler to be stopped when the process exits or None
+    """
+    if config is None:
+        return None
+    (path, rate) = config
+    profiler = SamplingProfiler(path, rate, label, backend=True)
+    profiler.start()
+    return profiler
+
+
+class ProfileSummary(object):
+    """Time spent in solver calls vs. the rest of the code per thread"""
+    def __init__(self):
+        self.samples = collections.Counter()
+        self.wall_samples = collections.Counter()
+        # (process, thread) -> [CPU total, CPU solver, wall total,
+        # wall solver]
+        self.threads = collections.OrderedDict()
+        # frame -> weight of samples where the frame is on top
+        self.self_weights = collections.Counter()
+
+    def add(self, line, wall=False):
+        (stack, _, weight) = line.rstrip('\n').rpartition(' ')
+        weight = int(weight)
+        frames = stack.split(';')
+        totals = self.threads.setdefault(tuple(frames[:2]), [0, 0, 0, 0])
+        i = 2 if wall else 0
+        totals[i] += weight
+        if SOLVER_FRAME in frames[2:]:
+            totals[i + 1] += weight
+        if wall:
+            self.wall_samples[stack] += weight
+        else:
+            self.samples[stack] += weight
+            self.self_weights[frames[-1]] += weight
+
+    def read(self, path):
+        for filename in sorted(glob.glob(os.path.join(path, 'pyzcm-*.folded'))):
+            wall = filename.endswith('{}.folded'.format(WALL_SUFFIX))
+            with open(filename) as f:
+                for line in f:
+                    if line.strip():
+                        self.add(line, wall)
+        return self
+
+    def write(self, filename, wall=False):
+        with open(filename, 'w') as f:
+            samples = self.wall_samples if wall else self.samples
+            for (stack, weight) in samples.items():
+                f.write('{0} {1}\n'.format(stack, weight))
+
+    @staticmethod
+    def format_split(total, solver):
+        if total == 0:
+            return '{0:>10} {1:>7} {2:>7}'.format('--', '--', '--')
+        return '{0:>10.2f} {1:>7.1%} {2:>7.1%}'.format(
+            total * WEIGHT_UNIT, solver / total, 1 - solver / total)
+
+    def __format__(self, format_spec):
+        names = ['{0} {1}'.format(process, thread)
+                 for (process, thread) in self.threads]
+        width = max([len(n) for n in names] + [len('Thread')])
+        s = ['{0:<{w}} {1:>10} {2:>7} {3:>7} {4:>10} {5:>7} {6:>7}'.format(
+            'Thread', 'CPU [s]', 'solver', 'glue', 'wall [s]', 'solver',
+            'glue', w=width)]
+        for (name, (cpu, cpu_solver, wall, wall_solver)) in \
+                zip(names, self.threads.values()):
+            s.append('{0:<{w}} {1} {2}'.format(
+                name, self.format_split(cpu, cpu_solver),
+                self.format_split(wall, wall_solver), w=width))
+        total = sum(self.self_weights.values())
+        if total:
+            s.append('')
+            s.append('Top frames by self CPU time:')
+            for (frame, weight) in self.self_weights.most_common(10):
+                s.append('{0:>7.1%} {1}'.format(weight / total, frame))
+        return '\n'.join(s)
+
+
+def main(argv=None):
+    """Summarize profiles written by pyzcm --profile"""
+    parser = argparse.ArgumentParser(prog='pyzcm profile',
+                                     description=main.__doc__)
+    parser.add_argument('path', help='Directory of the profiles')
+    parser.add_argument('-o', '--output', dest='output', default=None,
+                        help='Write the merged collapsed stacks into OUTPUT')
+    parser.add_argument('-w', '--wall-output', dest='wall_output',
+                        default=None, help='Write the merged wall-clock ' \
+                        'collapsed stacks into WALL_OUTPUT')
+    args = parser.parse_args(argv)
+
+    summary = ProfileSummary().read(args.path)
+    if not summary.threads:
+        parser.error('No profiles found in {}'.format(args.path))
+    if args.output is not None:
+        summary.write(args.output)
+    if args.wall_output is not None:
+        summary.write(args.wall_output, wall=True)
+    print(format(summary))
+
+
+if __name__ == '__main__':
+    main()
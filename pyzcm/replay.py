@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""Recording and replaying of stratum sessions
+
+The miner records its stratum traffic when started with '--record
+FILE'. The capture is a gzipped file with one JSON entry per line:
+
+    {"t": 12.345, "k": ">", "d": "<line received from the server>"}
+
+where 't' is time since the start of recording and 'k' is one of:
+- 'connect' - connection to the server 'd' (host:port) established
+- '<' - request sent by the miner (passwords are not recorded)
+- '>' - message received from the server
+- 'disconnect' - connection closed with reason 'd'
+
+'python -m pyzcm.replay FILE' starts a stratum server that replays
+the recorded sessions - one for each connection of the miner. Server
+notifications are sent at the original times (optionally accelerated),
+responses to the miner's requests are taken from the recorded
+responses and connections are closed where the recorded ones were.
+The server reports job notifications, submitted shares, stale shares
+and job switch latency of each session.
+
+The FakeSolver backend ('--solver cpu=fake') turns the recorded jobs
+into shares at the rate of a real solver without solving Equihash.
+Its solutions don't pass local verification, use it with
+'--verify-solutions 0'. At the start of each run, it sends the header
+without the nonce in a UDP datagram to PYZCM_FAKE_SOLVER_REPORT
+(127.0.0.1:SOLVER_REPORT_PORT by default). The job switch latency is
+the time from a clean job notification to the first solver run on the
+header of that job, so it doesn't depend on how long the solver takes
+to find a share. It is only measured with the FakeSolver backend.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import logging
+import os
+import random
+import socket
+import time
+
+from pyzcm.miner.params import *
+from pyzcm.eventloop import new_event_loop, available_event_loops, \
+    DEFAULT_EVENT_LOOP
+
+# Time a fake solver run takes and number of solutions it provides
+FAKE_SOLVE_TIME = float(os.environ.get('PYZCM_FAKE_SOLVE_TIME', 0.5))
+FAKE_SOLUTIONS = int(os.environ.get('PYZCM_FAKE_SOLUTIONS', 2))
+# How long the replay waits for a request that the recorded miner sent
+REQUEST_TIMEOUT = 30
+# Port where the replay server receives solver runs of the FakeSolver
+SOLVER_REPORT_PORT = 3335
+FAKE_SOLVER_REPORT = os.environ.get('PYZCM_FAKE_SOLVER_REPORT',
+                                    '127.0.0.1:{}'.format(SOLVER_REPORT_PORT))
+# Part of the header that identifies the job (the nonce is per miner)
+JOB_HEADER_LENGTH = ZC_BLOCK_HEADER_LENGTH - ZC_NONCE_LENGTH
+
+
+class SessionRecorder(object):
+    """Records the stratum traffic into a capture file"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'SessionRecorder'))
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wt')
+        self.t_start = time.time()
+
+    def record(self, kind, data=None):
+        entry = {'t': round(time.time() - self.t_start, 6), 'k': kind}
+        if data is not None:
+            entry['d'] = data
+        self.file.write('{}\n'.format(json.dumps(entry)))
+
+    def connected(self, server):
+        self.record('connect', '{0}:{1}'.format(server.host, server.port))
+
+    def sent(self, msg):
+        if msg['method'] == 'mining.authorize':
+            msg = dict(msg, params=[msg['params'][0], ''])
+        self.record('<', json.dumps(msg))
+
+    def received(self, data):
+        self.record('>', data.decode().rstrip('\n'))
+
+    def disconnected(self, reason):
+        self.record('disconnect', reason)
+        self.file.flush()
+
+    def close(self):
+        self.log.info('Stratum session recorded to {}'.format(self.path))
+        self.file.close()
+
+
+def load_sessions(path):
+    """Reads the capture file
+
+    @return list of sessions, each session is a list of entries with
+    time relative to the connect
+    """
+    sessions = []
+    session = None
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['k'] == 'connect':
+                t_connect = entry['t']
+                session = []
+                sessions.append(session)
+            elif session is not None:
+                entry['t'] -= t_connect
+                session.append(entry)
+    return sessions
+
+
+class FakeSolver(object):
+    """Solver that provides random solutions at the rate of a real solver.
+
+    Solutions are generated deterministically from the header so that
+    replays are repeatable. Each run is reported to the replay server
+    (see FAKE_SOLVER_REPORT).
+    """
+    memory_per_instance = 0
+    max_auto_instances = 1
+
+    def __init__(self, verbose=False):
+        self.solutions = []
+        (host, _, port) = FAKE_SOLVER_REPORT.rpartition(':')
+        self.report_address = (host, int(port))
+        self.report_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def report_run(self, header):
+        try:
+            self.report_socket.sendto(header[:JOB_HEADER_LENGTH],
+                                      self.report_address)
+        except OSError:
+            # no replay server listening
+            pass
+
+    def find_solutions(self, header):
+        self.report_run(header)
+        time.sleep(FAKE_SOLVE_TIME)
+        rnd = random.Random(header)
+        self.solutions = [rnd.getrandbits(8 * ZC_SOLUTION_LENGTH).to_bytes(
+            ZC_SOLUTION_LENGTH, 'little') for i in range(FAKE_SOLUTIONS)]
+        return len(self.solutions)
+
+    def get_solution(self, i):
+        return self.solutions[i]
+
+
+class ReplayStats(object):
+    def __init__(self):
+        self.notify_count = 0
+        self.clean_job_count = 0
+        self.submit_count = 0
+        self.stale_count = 0
+        self.job_switch_latencies = []
+
+    def __format__(self, format_spec):
+        stale_perc = 100 * self.stale_count / max(self.submit_count, 1)
+        latencies = self.job_switch_latencies
+        latency_str = '{0:.03f} s'.format(sum(latencies) / len(latencies)) \
+                      if latencies else '--'
+        return 'notifications: {0} ({1} clean jobs), shares: {2}, ' \
+            'stale: {3} ({4:.02f} %), job switch latency: {5}'.format(
+                self.notify_count, self.clean_job_count, self.submit_count,
+                self.stale_count, stale_perc, latency_str)
+
+
+class ReplaySession(object):
+    """Replays one recorded session to a connected miner"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'ReplaySession'))
+
+    def __init__(self, loop, entries, speed, reader, writer):
+        self.loop = loop
+        self.entries = entries
+        self.speed = speed
+        self.reader = reader
+        self.writer = writer
+        self.stats = ReplayStats()
+        # recorded responses by the method of the request
+        self.responses = collections.defaultdict(collections.deque)
+        methods = {}
+        for entry in entries:
+            msg = json.loads(entry['d']) if entry['k'] in ('<', '>') else None
+            if entry['k'] == '<':
+                methods[msg['id']] = msg['method']
+            elif entry['k'] == '>' and msg['id'] is not None and \
+                 msg['id'] in methods:
+                self.responses[methods[msg['id']]].append(msg)
+        # live requests that the recorded sequence hasn't reached yet
+        self.pending_requests = collections.Counter()
+        self.request_received = asyncio.Event()
+        # jobs that are valid for submission
+        self.valid_jobs = set()
+        # header of the last clean job that no solver run has started on
+        # yet and the time of its notification
+        self.clean_job_header = None
+        self.clean_job_time = None
+
+    def send(self, msg):
+        self.writer.write('{}\n'.format(json.dumps(msg)).encode())
+
+    def on_notify(self, msg):
+        self.stats.notify_count += 1
+        if msg['method'] != 'mining.notify':
+            return
+        job_id = msg['params'][0]
+        if msg['params'][7]:
+            self.stats.clean_job_count += 1
+            self.valid_jobs = set()
+            self.clean_job_header = bytes.fromhex(''.join(msg['params'][1:7]))
+            self.clean_job_time = self.loop.time()
+        self.valid_jobs.add(job_id)
+
+    def on_solver_run(self, header):
+        """A solver run of the FakeSolver has started on the header"""
+        if header == self.clean_job_header:
+            self.stats.job_switch_latencies.append(
+                self.loop.time() - self.clean_job_time)
+            self.clean_job_header = None
+
+    def on_submit(self, msg):
+        self.stats.submit_count += 1
+        job_id = msg['params'][1]
+        if job_id not in self.valid_jobs:
+            self.stats.stale_count += 1
+        # keep the recorded acceptance of shares
+        recorded = self.responses['mining.submit']
+        result = recorded.popleft()['result'] if recorded else True
+        self.send({'id': msg['id'], 'result': result, 'error': None})
+
+    async def serve_requests(self):
+        while True:
+            data = await self.reader.readline()
+            if data == b'':
+                break
+            msg = json.loads(data.decode())
+            if msg['method'] == 'mining.submit':
+                self.on_submit(msg)
+                continue
+            recorded = self.responses[msg['method']]
+            if recorded:
+                self.send(dict(recorded.popleft(), id=msg['id']))
+            else:
+                self.send({'id': msg['id'], 'result': None,
+                           'error': 'No recorded response'})
+            self.pending_requests[msg['method']] += 1
+            self.request_received.set()
+
+    async def wait_request(self, method):
+        t_end = self.loop.time() + REQUEST_TIMEOUT
+        while self.pending_requests[method] == 0:
+            self.request_received.clear()
+            await asyncio.wait_for(self.request_received.wait(),
+                                   t_end - self.loop.time())
+        self.pending_requests[method] -= 1
+
+    async def sleep_until(self, t_start, entry):
+        delay = t_start + entry['t'] / self.speed - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def play(self):
+        requests = self.loop.create_task(self.serve_requests())
+        t_start = self.loop.time()
+        try:
+            for entry in self.entries:
+                if requests.done():
+                    self.log.info('Miner closed the connection')
+                    break
+                if entry['k'] == '<':
+                    method = json.loads(entry['d'])['method']
+                    # shares of the miner differ from the recorded ones
+                    if method != 'mining.submit':
+                        await self.wait_request(method)
+                elif entry['k'] == '>':
+                    msg = json.loads(entry['d'])
+                    if msg['id'] is None:
+                        await self.sleep_until(t_start, entry)
+                        self.send(msg)
+                        self.on_notify(msg)
+                elif entry['k'] == 'disconnect':
+                    await self.sleep_until(t_start, entry)
+                    self.log.info('Recorded disconnect: {}'.format(entry['d']))
+                    break
+        finally:
+            requests.cancel()
+            self.writer.close()
+        return self.stats
+
+
+class ReplayServer(asyncio.DatagramProtocol):
+    """Stratum server that replays recorded sessions, it also receives
+    the solver runs reported by the FakeSolver"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'ReplayServer'))
+
+    def __init__(self, loop, sessions, speed=1.0):
+        self.loop = loop
+        self.sessions = collections.deque(sessions)
+        self.speed = speed
+        self.session_count = 0
+        self.active_sessions = set()
+
+    def datagram_received(self, data, addr):
+        for session in self.active_sessions:
+            session.on_solver_run(data)
+
+    async def handle_client(self, reader, writer):
+        if not self.sessions:
+            self.log.info('All sessions replayed, refusing connection')
+            writer.close()
+            return
+        self.session_count += 1
+        session_id = self.session_count
+        self.log.info('Replaying session {0} ({1} left)'.format(
+            session_id, len(self.sessions) - 1))
+        session = ReplaySession(self.loop, self.sessions.popleft(), self.speed,
+                                reader, writer)
+        self.active_sessions.add(session)
+        try:
+            stats = await session.play()
+        except asyncio.TimeoutError:
+            self.log.warn('Miner did not send the recorded request')
+            stats = session.stats
+        finally:
+            self.active_sessions.discard(session)
+        print('Session {0}: {1}'.format(session_id, stats))
+
+
+def main():
+    """Replay a recorded stratum session"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('capture', help='File recorded by pyzcm --record')
+    parser.add_argument('-p', '--port', dest='port', default=3333, type=int,
+                        help='Port to listen on')
+    parser.add_argument('-s', '--speed', dest='speed', default=1.0, type=float,
+                        help='Replay speed, 2 = twice as fast as recorded')
+    parser.add_argument('--solver-report-port', dest='solver_report_port',
+                        default=SOLVER_REPORT_PORT, type=int,
+                        help='UDP port for solver runs reported by the fake '
+                        'solver (PYZCM_FAKE_SOLVER_REPORT of the miner)')
+    parser.add_argument('--event-loop', dest='event_loop',
+                        default=DEFAULT_EVENT_LOOP,
+                        choices=available_event_loops())
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
+
+    sessions = load_sessions(args.capture)
+    print('Loaded {0} sessions from {1}'.format(len(sessions), args.capture))
+    loop = new_event_loop(args.event_loop)
+    server = ReplayServer(loop, sessions, args.speed)
+    listener = loop.run_until_complete(asyncio.start_server(
+        server.handle_client, 'localhost', args.port))
+    (solver_reports, _) = loop.run_until_complete(
+        loop.create_datagram_endpoint(
+            lambda: server, local_addr=('127.0.0.1', args.solver_report_port)))
+    print('Listening on localhost:{}'.format(args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    listener.close()
+    solver_reports.close()
+    loop.run_until_complete(listener.wait_closed())
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
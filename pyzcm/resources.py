@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Resource accounting of the miner process tree
+
+The sampler periodically walks the tree of processes started by the
+miner via /proc (Linux only) and attributes their resident memory, CPU
+time, context switches and threads to:
+- individual miners - GPU miners own their backend process (including
+  memory of all solver instances) and its queue manager process, CPU
+  miners own their solver thread (CPU time only, the memory of a
+  thread is estimated by memory_per_instance of the solver class)
+- the main process (without the CPU miner threads)
+- other processes (device detection, benchmarks...)
+
+Warnings are raised when a miner exceeds the configured memory limit
+or when the memory of a miner keeps growing (possible leak).
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+from collections import OrderedDict
+
+RESOURCE_SAMPLE_PERIOD = 10
+# Memory growth after the baseline is taken is reported as a possible
+# leak - the baseline is taken once the miners have warmed up
+LEAK_BASELINE_DELAY = 600
+LEAK_THRESHOLD = 100 * 2 ** 20
+# Warn about thread count of the whole tree
+THREAD_WARNING_COUNT = 500
+
+PROC_PATH = '/proc'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+class ResourceSample(object):
+    """Resource usage of a process, a thread or their group"""
+    def __init__(self, rss=0, cpu_time=0, threads=0, ctx_switches=0,
+                 processes=0):
+        self.rss = rss
+        self.cpu_time = cpu_time
+        self.threads = threads
+        self.ctx_switches = ctx_switches
+        self.processes = processes
+        # not measured, estimated from the solver
+        self.rss_estimated = False
+        # CPU usage (1 = one CPU) since the previous sample
+        self.cpu_usage = None
+
+    def __iadd__(self, other):
+        self.rss += other.rss
+        self.cpu_time += other.cpu_time
+        self.threads += other.threads
+        self.ctx_switches += other.ctx_switches
+        self.processes += other.processes
+        return self
+
+    def as_dict(self):
+        return {'rss': self.rss,
+                'rss_estimated': self.rss_estimated,
+                'cpu_time': self.cpu_time,
+                'cpu_usage': self.cpu_usage,
+                'threads': self.threads,
+                'ctx_switches': self.ctx_switches,
+                'processes': self.processes}
+
+    def __format__(self, format_spec):
+        s = '{0}{1:.0f} MB'.format('~' if self.rss_estimated else '',
+                                   self.rss / 2 ** 20)
+        if self.cpu_usage is not None:
+            s += ' {0:.0%} CPU'.format(self.cpu_usage)
+        return s + ' {0} thr'.format(self.threads)
+
+
+def read_stat(path):
+    """Parses /proc/<pid>[/task/<tid>]/stat
+
+    @return tuple (ppid, CPU time in seconds, thread count)
+    """
+    with open(os.path.join(path, 'stat')) as f:
+        data = f.read()
+    # command name may contain spaces, fields follow the last ')'
+    fields = data[data.rindex(')') + 2:].split()
+    return (int(fields[1]),
+            (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+            int(fields[17]))
+
+
+def read_status(path):
+    """Parses /proc/<pid>[/task/<tid>]/status
+
+    @return tuple (resident memory in bytes, context switches)
+    """
+    rss = 0
+    ctx_switches = 0
+    with open(os.path.join(path, 'status')) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith(('voluntary_ctxt_switches:',
+                                  'nonvoluntary_ctxt_switches:')):
+                ctx_switches += int(line.split()[1])
+    return (rss, ctx_switches)
+
+
+def sample_process(pid):
+    path = os.path.join(PROC_PATH, str(pid))
+    (ppid, cpu_time, threads) = read_stat(path)
+    (rss, ctx_switches) = read_status(path)
+    return (ppid, ResourceSample(rss, cpu_time, threads, ctx_switches, 1))
+
+
+def sample_thread(pid, tid):
+    path = os.path.join(PROC_PATH, str(pid), 'task', str(tid))
+    (_, cpu_time, _) = read_stat(path)
+    (_, ctx_switches) = read_status(path)
+    return ResourceSample(0, cpu_time, 1, ctx_switches)
+
+
+def sample_process_tree(root_pid):
+    """Samples the process and all its descendants
+
+    @return dictionary pid -> (ppid, ResourceSample)
+    """
+    processes = {}
+    for name in os.listdir(PROC_PATH):
+        if name.isdigit():
+            try:
+                processes[int(name)] = sample_process(int(name))
+            except (OSError, ValueError, IndexError):
+                # the process has just exited
+                pass
+    children = {}
+    for pid, (ppid, _) in processes.items():
+        children.setdefault(ppid, []).append(pid)
+    tree = {}
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        if pid in processes:
+            tree[pid] = processes[pid]
+            pending.extend(children.get(pid, []))
+    return tree
+
+
+def descendants(tree, pids):
+    """Specified processes of the tree and their descendants"""
+    result = set()
+    pending = [pid for pid in pids if pid in tree]
+    while pending:
+        pid = pending.pop()
+        result.add(pid)
+        pending.extend(p for p, (ppid, _) in tree.items() if ppid == pid)
+    return result
+
+
+class ResourceSampler(object):
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'ResourceSampler'))
+
+    def __init__(self, period=RESOURCE_SAMPLE_PERIOD, rss_limit=None):
+        """
+        @param period - sampling period in seconds
+        @param rss_limit - warn when a miner uses more memory (bytes),
+        None = no limit
+        """
+        self.period = period
+        self.rss_limit = rss_limit
+        self.pid = os.getpid()
+        self.t_start = time.time()
+        self.last_time = None
+        # usage by group name: miners, 'main', 'other' and 'total'
+        self.usage = OrderedDict()
+        self.baseline_rss = None
+        self.warnings = []
+
+    @classmethod
+    def is_supported(cls):
+        return os.path.isdir(os.path.join(PROC_PATH, 'self', 'task'))
+
+    def sample_miner(self, miner, tree):
+        usage = ResourceSample()
+        for pid in descendants(tree, miner.get_resource_pids()):
+            usage += tree[pid][1]
+        for tid in miner.get_resource_thread_ids():
+            try:
+                usage += sample_thread(self.pid, tid)
+            except (OSError, ValueError, IndexError):
+                pass
+        if usage.processes == 0:
+            # threads share the memory of the main process
+            usage.rss = (getattr(miner.solver_class, 'memory_per_instance',
+                                 None) or 0) * 2 ** 20
+            usage.rss_estimated = True
+        return usage
+
+    def sample(self, miners):
+        tree = sample_process_tree(self.pid)
+        usage = OrderedDict()
+        assigned = set([self.pid])
+        main = ResourceSample()
+        main += tree[self.pid][1]
+        for m in miners:
+            miner_usage = self.sample_miner(m, tree)
+            usage[format(m, 's')] = miner_usage
+            assigned.update(descendants(tree, m.get_resource_pids()))
+            if miner_usage.processes == 0:
+                # don't account CPU time of the miner threads twice
+                # (context switches of a process are those of its main
+                # thread only)
+                main.cpu_time -= miner_usage.cpu_time
+        usage['main'] = main
+        other = ResourceSample()
+        for pid in set(tree) - assigned:
+            other += tree[pid][1]
+        usage['other'] = other
+        total = ResourceSample()
+        for pid in tree:
+            total += tree[pid][1]
+        usage['total'] = total
+        return usage
+
+    def update(self, miners):
+        now = time.time()
+        usage = self.sample(miners)
+        if self.last_time is not None:
+            for name, u in usage.items():
+                if name in self.usage:
+                    u.cpu_usage = max(u.cpu_time - self.usage[name].cpu_time,
+                                      0) / (now - self.last_time)
+        self.last_time = now
+        self.usage = usage
+        if self.baseline_rss is None and \
+           now - self.t_start > LEAK_BASELINE_DELAY:
+            self.baseline_rss = {name: u.rss for name, u in usage.items()
+                                 if not u.rss_estimated}
+        self.check_thresholds()
+
+    def check_thresholds(self):
+        warnings = []
+        for name, u in self.usage.items():
+            if name in ('main', 'other', 'total') or u.rss_estimated:
+                continue
+            if self.rss_limit is not None and u.rss > self.rss_limit:
+                warnings.append('{0} uses {1:.0f} MB (limit {2:.0f} MB)'.format(
+                    name, u.rss / 2 ** 20, self.rss_limit / 2 ** 20))
+        for name, rss in (self.baseline_rss or {}).items():
+            if name in self.usage and \
+               self.usage[name].rss - rss > LEAK_THRESHOLD:
+                warnings.append('{0} memory grew by {1:.0f} MB - possible ' \
+                                'leak'.format(
+                                    name, (self.usage[name].rss - rss) / 2 ** 20))
+        if self.usage['total'].threads > THREAD_WARNING_COUNT:
+            warnings.append('{} threads running'.format(
+                self.usage['total'].threads))
+        for w in warnings:
+            if w not in self.warnings:
+                self.log.warn(w)
+        self.warnings = warnings
+
+    async def run(self, miner_manager):
+        while True:
+            try:
+                self.update(miner_manager.miners)
+            except Exception as e:
+                self.log.error('Resource sampling failed: {}'.format(e))
+            await asyncio.sleep(self.period)
+
+    def as_dict(self):
+        return {'usage': {name: u.as_dict() for name, u in self.usage.items()},
+                'warnings': self.warnings}
+
+    def __format__(self, format_spec):
+        s = io.StringIO()
+        s.write(' | '.join('{0}: {1}'.format(name, u)
+                           for name, u in self.usage.items()
+                           if name != 'other' or u.processes > 0))
+        for w in self.warnings:
+            s.write('\nWARNING: {}'.format(w))
+        return s.getvalue()
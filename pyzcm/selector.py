@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Stratum endpoint selection module
+
+Provides latency aware selection of the primary stratum server and a
+'happy eyeballs' (RFC 8305) connect that races all resolved addresses
+of a server.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import asyncio
+import logging
+import socket
+import time
+import io
+
+# Delay before starting a connection attempt to the next address
+HAPPY_EYEBALLS_DELAY = 0.25
+# How often all endpoints are probed for their RTT
+PROBE_PERIOD = 60
+# Timeout of a single probe
+PROBE_TIMEOUT = 10
+# Failed endpoint is not selected for QUARANTINE_TIME * consecutive
+# failures (capped by QUARANTINE_TIME_MAX)
+QUARANTINE_TIME = 30
+QUARANTINE_TIME_MAX = 600
+# A better endpoint replaces the current one only if it is faster
+# by both the relative and absolute margin...
+SWITCH_HYSTERESIS = 0.3
+SWITCH_MIN_GAIN = 0.02
+# ...and the current endpoint has been in use for at least:
+SWITCH_MIN_DWELL_TIME = 300
+
+
+def _interleave_families(addr_infos):
+    """Alternate address families as recommended by RFC 8305, the first
+    address family is kept first
+    """
+    by_family = {}
+    families = []
+    for info in addr_infos:
+        if info[0] not in by_family:
+            by_family[info[0]] = []
+            families.append(info[0])
+        by_family[info[0]].append(info)
+    result = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                result.append(by_family[family].pop(0))
+    return result
+
+
+async def _connect_address(loop, addr_info):
+    family, type, proto, _, address = addr_info
+    sock = socket.socket(family, type, proto)
+    sock.setblocking(False)
+    try:
+        t = time.time()
+        await loop.sock_connect(sock, address)
+        return (sock, time.time() - t)
+    except:
+        # includes cancellation by a faster attempt
+        sock.close()
+        raise
+
+
+async def open_happy_eyeballs(loop, host, port, delay=HAPPY_EYEBALLS_DELAY):
+    """Resolve all addresses of host and race connection attempts to them.
+
+    Attempts are started in intervals of 'delay' seconds or
+    immediately after the previous attempt has failed. The first
+    established connection wins, the remaining attempts are cancelled.
+
+    @return tuple (connected non-blocking socket, duration of the
+    winning connect attempt)
+    """
+    addr_infos = await loop.getaddrinfo(host, port,
+                                             type=socket.SOCK_STREAM)
+    addr_infos = _interleave_families(addr_infos)
+    pending = set()
+    winner = None
+    last_exc = None
+    try:
+        while winner is None and (addr_infos or pending):
+            if addr_infos:
+                pending.add(loop.create_task(
+                    _connect_address(loop, addr_infos.pop(0))))
+            done, pending = await asyncio.wait(
+                pending, timeout=delay if addr_infos else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is not None:
+                    last_exc = f.exception()
+                elif winner is None:
+                    winner = f.result()
+                else:
+                    f.result()[0].close()
+    finally:
+        for f in pending:
+            if f.done() and not f.cancelled() and f.exception() is None:
+                f.result()[0].close()
+            else:
+                f.cancel()
+
+    if winner is None:
+        raise last_exc or OSError('No address found for {}'.format(host))
+    return winner
+
+
+class EndpointSelector(object):
+    """Selects the lowest latency healthy stratum server.
+
+    Endpoints are ranked by their network RTT that is measured the
+    same way for all of them - as duration of the TCP connect. The
+    RTT is sampled by each real connection and by periodic probes of
+    all endpoints. Stratum level RTT (request round trip including
+    the pool processing) is collected by the stratum client for the
+    active endpoint and reported along with the network RTT.
+
+    Failed endpoints are quarantined for a period that grows with
+    consecutive failures.
+    """
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'EndpointSelector'))
+
+    def __init__(self, loop, servers, on_better_endpoint=None):
+        """
+        @param on_better_endpoint - callback invoked when there is a
+        healthy endpoint that is sufficiently faster than the active one
+        """
+        self.loop = loop
+        self.servers = servers
+        self.on_better_endpoint = on_better_endpoint
+        self.active = None
+        self.active_since = 0
+
+    def is_healthy(self, server, now=None):
+        stats = server.stats
+        now = now or time.time()
+        if now < stats.quarantine_until:
+            return False
+        if stats.failure_count == 0:
+            return True
+        quarantine = min(QUARANTINE_TIME * stats.failure_count,
+                         QUARANTINE_TIME_MAX)
+        return now - stats.last_failure_time > quarantine
+
+    def _rank(self, server):
+        # endpoints without any measurement are tried after the measured ones
+        rtt = server.stats.rtt
+        return (rtt is None, rtt or 0)
+
+    def best(self):
+        """Lowest latency healthy endpoint, endpoints that failed least
+        recently are used when none of them is healthy.
+        """
+        now = time.time()
+        healthy = [s for s in self.servers if self.is_healthy(s, now)]
+        if healthy:
+            # sort is stable - command line order is kept for equal ranks
+            return sorted(healthy, key=self._rank)[0]
+        return sorted(self.servers,
+                      key=lambda s: (s.stats.quarantine_until,
+                                     s.stats.last_failure_time))[0]
+
+    def is_better(self, candidate, current):
+        """Hysteresis - candidate has to be faster by a sufficient margin"""
+        if candidate is current or candidate.stats.rtt is None:
+            return False
+        if current.stats.rtt is None:
+            return True
+        gain = current.stats.rtt - candidate.stats.rtt
+        return gain > SWITCH_MIN_GAIN and \
+            gain > SWITCH_HYSTERESIS * current.stats.rtt
+
+    def select(self):
+        """Selects the endpoint for the next connection"""
+        server = self.best()
+        if server is not self.active:
+            self.log.info('Selected endpoint {0} (RTT: {1})'.format(
+                server, server.stats.format_rtt(server.stats.rtt)))
+            self.active = server
+            self.active_since = time.time()
+        return server
+
+    def record_failure(self, server):
+        server.stats.record_failure()
+        self.log.warn('Endpoint {0} failed {1} times in a row'.format(
+            server, server.stats.failure_count))
+
+    def quarantine(self, server, period):
+        """Keeps a server that is reachable but misbehaves from being
+        selected for the period"""
+        server.stats.quarantine_until = time.time() + period
+        self.log.warn('Endpoint {0} quarantined for {1} s'.format(server,
+                                                                 period))
+
+    async def probe(self, server):
+        try:
+            (sock, rtt) = await asyncio.wait_for(
+                open_happy_eyeballs(self.loop, server.host, server.port),
+                PROBE_TIMEOUT)
+            sock.close()
+            server.stats.update_rtt(rtt)
+            # the active server is judged by its stratum session, a
+            # reachable port doesn't make a failing session healthy
+            if server is not self.active and server.stats.failure_count:
+                self.log.info('Endpoint {0} is reachable again'.format(
+                    server))
+                server.stats.record_success()
+            self.log.debug('Probed {0}, RTT: {1}'.format(
+                server, server.stats.format_rtt(rtt)))
+        except Exception as e:
+            self.log.info('Probing {0} failed: {1}'.format(server, e))
+            if server is not self.active:
+                self.record_failure(server)
+
+    async def run(self):
+        """Periodically probes all endpoints and notifies about a better
+        endpoint
+        """
+        while True:
+            await asyncio.wait([self.loop.create_task(self.probe(s))
+                                for s in self.servers])
+            candidate = self.best()
+            if self.active is not None and \
+               time.time() - self.active_since > SWITCH_MIN_DWELL_TIME and \
+               self.is_better(candidate, self.active):
+                self.log.info('Endpoint {0} is faster than {1}'.format(
+                    candidate, self.active))
+                if self.on_better_endpoint is not None:
+                    self.on_better_endpoint(candidate)
+            await asyncio.sleep(PROBE_PERIOD)
+
+    def __format__(self, format_spec):
+        s = io.StringIO()
+        now = time.time()
+        for server in sorted(self.servers, key=self._rank):
+            s.write('{0}:{1}{2}{3} '.format(
+                server.tag, server.stats.format_rtt(server.stats.rtt),
+                '' if self.is_healthy(server, now) else '(quarantined)',
+                '*' if server is self.active else ''))
+        return s.getvalue().rstrip()
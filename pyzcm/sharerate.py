@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Share rate control
+
+The controller estimates the total solution rate of the miners and
+computes the target at which the miners would find the configured
+number of shares per minute. The target is suggested to the pool:
+- 'suggest_target' - via mining.suggest_target whenever the ideal
+  target departs from the suggested one by more than
+  SHARE_RATE_TOLERANCE
+- 'password' - as difficulty appended to the password
+  ('x' -> 'x,d=0.5'), the pool applies it to the next connection. The
+  miner reconnects when the ideal target departs from the one in the
+  password by more than SHARE_RATE_TOLERANCE, connections younger than
+  PASSWORD_MIN_AGE are kept.
+
+The pool is free to ignore the suggestion. Independently, shares
+easier than the minimum difficulty are never submitted - the job
+target is lowered to the floor target locally.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import asyncio
+import logging
+import time
+
+from pyzcm.stats import HASH_SPACE, ewma
+
+SUGGEST_METHODS = ('suggest_target', 'password')
+# Period of re-evaluating the ideal target
+SHARE_RATE_PERIOD = 30
+# The target is suggested again when the ideal one is this many times
+# harder or easier
+SHARE_RATE_TOLERANCE = 2.0
+# Seconds a connection is kept before reconnecting with a new password
+PASSWORD_MIN_AGE = 300
+# Smoothing factor of the solution rate average
+SOLUTION_RATE_ALPHA = 0.3
+# Target of difficulty 1 as used by zcash pools
+POOL_DIFF1_TARGET = 0x0007ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
+
+
+def difficulty_to_target(difficulty):
+    return min(int(POOL_DIFF1_TARGET / difficulty), HASH_SPACE - 1)
+
+
+def target_to_difficulty(target):
+    return POOL_DIFF1_TARGET / target
+
+
+class ShareRateController(object):
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'ShareRateController'))
+
+    def __init__(self, share_rate=None, method='suggest_target',
+                 min_difficulty=None):
+        """
+        @param share_rate - desired shares per minute, None = accept the
+        pool target
+        @param method - one of SUGGEST_METHODS
+        @param min_difficulty - shares below this difficulty are not
+        submitted, None = no floor
+        """
+        self.share_rate = share_rate
+        self.method = method
+        self.floor_target = difficulty_to_target(min_difficulty) \
+                            if min_difficulty else None
+        # solution rate of all miners (Sol/s) and the last sample of
+        # their solution count
+        self.solution_rate = None
+        self.last_sample = None
+        # target suggested on the current connection
+        self.suggested_target = None
+        # time the password of the current connection has been built
+        self.password_time = None
+
+    @property
+    def enabled(self):
+        return self.share_rate is not None
+
+    def update(self, miners):
+        """Samples the solution count of the miners"""
+        now = time.time()
+        solution_count = sum(m.stats.solution_count for m in miners)
+        if self.last_sample is not None and now > self.last_sample[0]:
+            rate = max(solution_count - self.last_sample[1], 0) / \
+                   (now - self.last_sample[0])
+            self.solution_rate = ewma(self.solution_rate, rate,
+                                      SOLUTION_RATE_ALPHA)
+        self.last_sample = (now, solution_count)
+
+    def get_target(self):
+        """Target that yields the configured share rate, None while the
+        solution rate is unknown"""
+        if not self.enabled or not self.solution_rate:
+            return None
+        target = int(self.share_rate / 60 / self.solution_rate * HASH_SPACE)
+        return min(self.limit_target(target), HASH_SPACE - 1)
+
+    def departs(self, target):
+        """The target departs from the suggested one"""
+        if self.suggested_target is None:
+            return True
+        ratio = target / self.suggested_target
+        return ratio > SHARE_RATE_TOLERANCE or ratio < 1 / SHARE_RATE_TOLERANCE
+
+    def needs_suggestion(self, target):
+        if target is None or self.method != 'suggest_target':
+            return False
+        return self.departs(target)
+
+    def needs_reconnect(self, target):
+        """The password of the current connection has to be changed"""
+        if target is None or self.method != 'password' or \
+           self.password_time is None:
+            return False
+        return time.time() - self.password_time >= PASSWORD_MIN_AGE and \
+            self.departs(target)
+
+    def get_password(self, password):
+        """Password of the next connection with the suggested difficulty"""
+        self.suggested_target = None
+        self.password_time = time.time()
+        target = self.get_target()
+        if self.method != 'password' or target is None:
+            return password
+        self.suggested_target = target
+        return '{0}{1}d={2:.4g}'.format(password, ',' if password else '',
+                                        target_to_difficulty(target))
+
+    async def run(self, switcher):
+        """Reconnects to the pool when the difficulty in the password
+        has to be changed"""
+        while True:
+            await asyncio.sleep(SHARE_RATE_PERIOD)
+            client = switcher.client
+            if client is None or not client.connected or \
+               getattr(client, 'detached', False) or client.server.solo:
+                continue
+            target = self.get_target()
+            if self.needs_reconnect(target):
+                self.log.info('Reconnecting with difficulty {:.4g}'.format(
+                    target_to_difficulty(target)))
+                switcher.switch()
+
+    def limit_target(self, target):
+        """The target lowered to the floor"""
+        if self.floor_target is None or target is None:
+            return target
+        return min(target, self.floor_target)
+
+    def __format__(self, format_spec):
+        s = []
+        if self.solution_rate is not None:
+            s.append('solution rate: {:.02f} Sol/s'.format(self.solution_rate))
+        if self.suggested_target is not None:
+            s.append('suggested difficulty: {:.4g}'.format(
+                target_to_difficulty(self.suggested_target)))
+        if self.floor_target is not None:
+            s.append('min difficulty: {:.4g}'.format(
+                target_to_difficulty(self.floor_target)))
+        return ', '.join(s)
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""Equihash solver backends bundled with the miner
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Reference Equihash (200,9) solver implemented in NumPy
+
+The solver implements Wagner's algorithm with sort based collision
+rounds. It is much slower than the native solvers, but it runs
+anywhere NumPy is available and its results are deterministic. This
+makes it a portable fallback for CPU mining and a backend for
+exercising the rest of the mining pipeline without native builds.
+
+Run 'python -m pyzcm.solver.reference' to measure its performance.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import argparse
+import logging
+import resource
+import time
+
+import numpy as np
+
+from pyzcm.miner.params import *
+from pyzcm.equihash import EH_K, EH_COLLISION_BIT_LENGTH, \
+    EH_INDICES_PER_HASH_OUTPUT, EH_INDEX_BIT_LENGTH, blake2b_state, generate_hashes, indices_to_solution
+
+EH_DIGITS = EH_K + 1
+EH_DIGIT_MASK = (1 << EH_COLLISION_BIT_LENGTH) - 1
+EH_INITIAL_HASHES = 2 ** EH_INDEX_BIT_LENGTH
+# Rows with the same collision digit are only paired with up to
+# MAX_BUCKET_PAIR_DISTANCE following rows, this bounds the work on
+# rare large buckets
+MAX_BUCKET_PAIR_DISTANCE = 16
+
+
+def hashes_to_digits(hashes):
+    """Splits hashes into EH_DIGITS collision digits
+
+    @param hashes - uint8 array of shape (m, EH_HASH_LENGTH)
+    @return uint32 array of shape (m, EH_DIGITS)
+    """
+    # Every 5 bytes hold 2 digits
+    chunks = hashes.reshape(len(hashes), EH_DIGITS // 2, 5)
+    values = np.zeros(chunks.shape[:2], dtype=np.uint64)
+    for i in range(5):
+        values <<= np.uint64(8)
+        values |= chunks[:, :, i]
+    digits = np.empty((len(hashes), EH_DIGITS), dtype=np.uint32)
+    digits[:, 0::2] = values >> np.uint64(EH_COLLISION_BIT_LENGTH)
+    digits[:, 1::2] = values & np.uint64(EH_DIGIT_MASK)
+    return digits
+
+
+def find_collisions(keys):
+    """Finds all pairs of rows with equal keys
+
+    @return tuple of row index arrays (left, right)
+    """
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    left = []
+    right = []
+    for distance in range(1, MAX_BUCKET_PAIR_DISTANCE + 1):
+        same = sorted_keys[distance:] == sorted_keys[:-distance]
+        if not same.any():
+            break
+        left.append(order[:-distance][same])
+        right.append(order[distance:][same])
+    if not left:
+        empty = np.empty(0, dtype=order.dtype)
+        return (empty, empty)
+    return (np.concatenate(left), np.concatenate(right))
+
+
+def order_subtrees(indices):
+    """Swaps subtrees so that the left one starts with a lower index
+    (required by the solution encoding)
+    """
+    count = len(indices)
+    for level in range(1, EH_K + 1):
+        half = 2 ** (level - 1)
+        trees = indices.reshape(count, -1, 2, half)
+        swap = trees[:, :, 0, 0] > trees[:, :, 1, 0]
+        trees[swap] = trees[swap][:, ::-1]
+    return indices
+
+
+def solve(header):
+    """Finds all solutions of header
+
+    @return index arrays of shape (solution count, 2 ** EH_K)
+    """
+    hashes = generate_hashes(blake2b_state(header),
+                             range(EH_INITIAL_HASHES // EH_INDICES_PER_HASH_OUTPUT))
+    digits = hashes_to_digits(hashes)
+    del hashes
+
+    parents = []
+    for r in range(EH_K - 1):
+        left, right = find_collisions(digits[:, 0])
+        digits = digits[left, 1:] ^ digits[right, 1:]
+        # Rows that are entirely zero come from duplicate indices
+        nonzero = digits.any(axis=1)
+        parents.append((left[nonzero].astype(np.uint32),
+                        right[nonzero].astype(np.uint32)))
+        digits = digits[nonzero]
+
+    # The last round collides on both remaining digits
+    keys = (digits[:, 0].astype(np.uint64) << np.uint64(EH_COLLISION_BIT_LENGTH)) | \
+           digits[:, 1]
+    left, right = find_collisions(keys)
+    trees = np.stack((left, right), axis=1).astype(np.uint32)
+    for (parent_left, parent_right) in reversed(parents):
+        trees = np.stack((parent_left[trees], parent_right[trees]),
+                         axis=-1).reshape(len(trees), -1)
+    # rows were numbered in the order of generated hashes
+    indices = trees
+
+    sorted_indices = np.sort(indices, axis=1)
+    distinct = (sorted_indices[:, 1:] != sorted_indices[:, :-1]).all(axis=1)
+    indices = order_subtrees(indices[distinct])
+    # The same solution may be found via different collision orders
+    return np.unique(indices, axis=0)
+
+
+class Solver(object):
+    """Solver that complies with the solver contract of the miner
+    including the batched and zero-copy extensions
+    """
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'Solver'))
+    batch_size = 1
+    # peak memory in MB as measured by 'python -m pyzcm.solver.reference'
+    memory_per_instance = 400
+    max_auto_instances = 1
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.solutions = bytearray()
+        self.solution_count = 0
+
+    def find_solutions(self, header):
+        return len(self.find_solutions_batch([header]))
+
+    def find_solutions_batch(self, headers):
+        header_indices = []
+        solutions = []
+        for h, header in enumerate(headers):
+            t = time.time()
+            indices = solve(header)
+            header_indices.extend([h] * len(indices))
+            solutions.append(indices_to_solution(indices))
+            if self.verbose:
+                self.log.debug('Found {0} solutions in {1:.02f} s'.format(
+                    len(indices), time.time() - t))
+        self.solution_count = len(header_indices)
+        # Solutions are stored in the length prefixed form
+        records = np.empty((self.solution_count, ZC_LEN_AND_SOLUTION_LENGTH),
+                           dtype=np.uint8)
+        records[:, :len(ZC_SOLUTION_LENGTH_PREFIX)] = \
+            np.frombuffer(ZC_SOLUTION_LENGTH_PREFIX, dtype=np.uint8)
+        if self.solution_count > 0:
+            records[:, len(ZC_SOLUTION_LENGTH_PREFIX):] = np.concatenate(solutions)
+        self.solutions = records
+        return header_indices
+
+    def get_solution(self, i):
+        return self.solutions[i, len(ZC_SOLUTION_LENGTH_PREFIX):].tobytes()
+
+    def get_solution_buffer(self):
+        return self.solutions
+
+
+def main():
+    """Measure performance and memory use of the solver"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('-r', '--runs', default=5, type=int,
+                        help='Number of headers to solve')
+    args = parser.parse_args()
+
+    solver = Solver()
+    total_solutions = 0
+    t_start = time.time()
+    for nonce in range(args.runs):
+        header = bytes(ZC_BLOCK_HEADER_LENGTH - 4) + nonce.to_bytes(4, 'little')
+        t = time.time()
+        sol_cnt = solver.find_solutions(header)
+        total_solutions += sol_cnt
+        print('Run {0}: {1} solutions in {2:.02f} s'.format(
+            nonce, sol_cnt, time.time() - t))
+    elapsed = time.time() - t_start
+    # ru_maxrss is in kB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('{0:.03f} Sol/s, {1:.02f} s/run, peak RSS: {2:.0f} MB'.format(
+        total_solutions / elapsed, elapsed / args.runs, max_rss))
+
+
+if __name__ == '__main__':
+    main()
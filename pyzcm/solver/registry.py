@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""Solver backend registry
+
+The registry knows all solver backends - the bundled ones and those
+that are provided by other packages via the 'pyzcm.solvers' entry
+point group. Entry point value has to refer to a solver class, e.g.:
+
+    entry_points={
+        'pyzcm.solvers': ['mysolver = mypackage.solver:Solver'],
+    }
+
+A solver class complies with the solver contract of the miner (see
+pyzcm.miner) and may declare the following class attributes:
+- device_type - DEVICE_CPU (default) or DEVICE_GPU
+- memory_per_instance - memory needed by one instance in MB
+- max_auto_instances - maximum number of CPU instances started when the
+  CPU count is left to the miner
+
+The backend for each device is chosen by the BackendSelector: a user
+override takes precedence, then the recorded choice for the device,
+otherwise all compatible backends are briefly benchmarked and the
+fastest one is recorded.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import json
+import logging
+import os
+import resource
+import time
+
+from pyzcm.miner import solver_supports_batch, solver_supports_buffer, \
+    solver_supports_shared_context
+from pyzcm.miner.params import *
+
+ENTRY_POINT_GROUP = 'pyzcm.solvers'
+
+DEVICE_CPU = 'cpu'
+DEVICE_GPU = 'gpu'
+
+# Backends known to the miner in the order of preference
+BUILTIN_BACKENDS = (
+    ('zceq', DEVICE_CPU, 'pyzceqsolver.solver:Solver'),
+    ('silentarmy', DEVICE_GPU, 'pysa.solver:Solver'),
+    ('reference', DEVICE_CPU, 'pyzcm.solver.reference:Solver'),
+)
+# Backends for testing that are used only when requested by an override
+TEST_BACKENDS = (
+    ('fake', DEVICE_CPU, 'pyzcm.replay:FakeSolver'),
+)
+
+# Minimum duration of benchmarking a backend (at least one header is
+# always solved)
+BENCHMARK_DURATION = 10
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache',
+                                  'pyzcm', 'solvers.json')
+
+
+def load_object(target):
+    """Loads an object specified as 'module:attribute'"""
+    (module_name, attr) = target.split(':')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def create_solver(solver_class, device_type, device_id, verbose=False):
+    """Instantiates the solver according to its device type"""
+    if device_type == DEVICE_GPU:
+        return solver_class(device_id, verbose=verbose)
+    return solver_class(verbose=verbose)
+
+
+def benchmark_backend(target, device_type, device_id, duration):
+    """Measures solution rate and memory use of a backend.
+
+    This is to be run in a separate process - GPU solvers must not be
+    instantiated in the main process and the process memory
+    measurement needs to be isolated.
+    """
+    solver_class = load_object(target)
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    solver = create_solver(solver_class, device_type, device_id)
+    solution_count = 0
+    runs = 0
+    t_start = time.time()
+    while runs == 0 or time.time() - t_start < duration:
+        header = bytes(ZC_BLOCK_HEADER_LENGTH - 4) + runs.to_bytes(4, 'little')
+        solution_count += solver.find_solutions(header)
+        runs += 1
+    elapsed = time.time() - t_start
+    # ru_maxrss is in kB on Linux
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'rate': solution_count / elapsed,
+            'runs': runs,
+            'memory': (rss_end - rss_start) / 1024}
+
+
+class SolverBackend(object):
+    """Describes a solver implementation and its capabilities"""
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'SolverBackend'))
+
+    def __init__(self, name, target, device_type=None, selectable=True):
+        """
+        @param target - solver class specified as 'module:attribute'
+        @param device_type - overrides device_type of the solver class
+        @param selectable - backend may be selected automatically,
+        otherwise it has to be requested by an override
+        """
+        self.name = name
+        self.target = target
+        self.selectable = selectable
+        self._device_type = device_type
+        self._solver_class = None
+        self.load_error = None
+
+    @property
+    def solver_class(self):
+        if self._solver_class is None:
+            self._solver_class = load_object(self.target)
+        return self._solver_class
+
+    def is_available(self):
+        try:
+            self.solver_class
+            return True
+        except Exception as e:
+            # broken plugins must not prevent the miner from starting
+            self.load_error = e
+            self.log.debug('Solver backend {0} is not available: {1}'.format(
+                self.name, e))
+            return False
+
+    @property
+    def device_type(self):
+        if self._device_type is not None:
+            return self._device_type
+        return getattr(self.solver_class, 'device_type', DEVICE_CPU)
+
+    @property
+    def capabilities(self):
+        cls = self.solver_class
+        return OrderedDict((
+            ('batch', solver_supports_batch(cls)),
+            ('zero_copy', solver_supports_buffer(cls)),
+            ('shared_context', solver_supports_shared_context(cls)),
+            ('memory_per_instance', getattr(cls, 'memory_per_instance', None)),
+        ))
+
+    def __format__(self, format_spec):
+        if not self.is_available():
+            return '{0} ({1}): not available'.format(self.name, self.target)
+        return '{0} ({1}): {2} {3}{4}'.format(
+            self.name, self.target, self.device_type,
+            ' '.join('{0}={1}'.format(k, v)
+                     for k, v in self.capabilities.items()),
+            '' if self.selectable else ' (override only)')
+
+
+class SolverRegistry(object):
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'SolverRegistry'))
+
+    def __init__(self):
+        self.backends = OrderedDict()
+
+    def register(self, backend):
+        if backend.name in self.backends:
+            self.log.warn('Solver backend {} registered twice, ignoring'.format(
+                backend.name))
+            return
+        self.backends[backend.name] = backend
+
+    def discover(self):
+        """Registers the builtin backends and backends advertised by entry
+        points
+        """
+        for name, device_type, target in BUILTIN_BACKENDS:
+            self.register(SolverBackend(name, target, device_type))
+        for name, device_type, target in TEST_BACKENDS:
+            self.register(SolverBackend(name, target, device_type,
+                                        selectable=False))
+        for entry_point in self._entry_points():
+            self.log.debug('Discovered solver entry point: {}'.format(
+                entry_point))
+            self.register(SolverBackend(entry_point.name, entry_point.value))
+        return self
+
+    @staticmethod
+    def _entry_points():
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            return []
+        eps = entry_points()
+        if hasattr(eps, 'select'):
+            return eps.select(group=ENTRY_POINT_GROUP)
+        return eps.get(ENTRY_POINT_GROUP, [])
+
+    def get(self, name):
+        return self.backends.get(name)
+
+    def available(self, device_type):
+        """Available backends for the device type in order of preference,
+        only backends that may be selected automatically are included"""
+        return [b for b in self.backends.values()
+                if b.selectable and b.is_available() and
+                b.device_type == device_type]
+
+    def __format__(self, format_spec):
+        return '\n'.join(format(b, '') for b in self.backends.values())
+
+
+class BackendSelector(object):
+    """Chooses the solver backend for each device and records the choice.
+
+    Devices are identified by a key - 'cpu' for CPU solvers and
+    'platform:device' for GPU's. Overrides may be specified by the
+    device key or by the device type ('gpu' applies to all GPU's).
+    """
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'BackendSelector'))
+
+    def __init__(self, registry, overrides=(), cache_path=DEFAULT_CACHE_PATH,
+                 force_benchmark=False, benchmark_duration=BENCHMARK_DURATION):
+        """
+        @param overrides - sequence of (device key or type, backend name)
+        @param cache_path - file that records the choices, None disables
+        recording
+        """
+        self.registry = registry
+        self.overrides = dict(overrides)
+        self.cache_path = cache_path
+        self.force_benchmark = force_benchmark
+        self.benchmark_duration = benchmark_duration
+        self.choices = self._load_choices()
+
+    def _load_choices(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            self.log.warn('Cannot read solver choices from {0}: {1}'.format(
+                self.cache_path, e))
+            return {}
+
+    def _save_choices(self):
+        if self.cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path, 'w') as f:
+                json.dump(self.choices, f, indent=2, sort_keys=True)
+        except OSError as e:
+            self.log.warn('Cannot record solver choices to {0}: {1}'.format(
+                self.cache_path, e))
+
+    def _override(self, device_type, device_key):
+        name = self.overrides.get(device_key, self.overrides.get(device_type))
+        if name is None:
+            return None
+        backend = self.registry.get(name)
+        if backend is None or not backend.is_available() or \
+           backend.device_type != device_type:
+            raise ValueError('Solver backend {0} is not available for {1}'.format(
+                name, device_key))
+        return backend
+
+    def benchmark(self, backends, device_type, device_id):
+        results = OrderedDict()
+        for backend in backends:
+            self.log.info('Benchmarking solver {0} on {1}:{2}'.format(
+                backend.name, device_type, device_id))
+            executor = ProcessPoolExecutor(max_workers=1)
+            try:
+                results[backend.name] = executor.submit(
+                    benchmark_backend, backend.target, device_type, device_id,
+                    self.benchmark_duration).result()
+            except Exception as e:
+                self.log.warn('Benchmark of {0} failed: {1}'.format(
+                    backend.name, e))
+            finally:
+                executor.shutdown()
+        return results
+
+    def select(self, device_type, device_key, device_id=None, model=''):
+        """Selects the backend for a device
+
+        @param device_id - device ID passed to the solver (GPU's)
+        @param model - device model, the recorded choice is discarded
+        when the model changes
+        @return SolverBackend or None if there is no compatible backend
+        """
+        backend = self._override(device_type, device_key)
+        if backend is not None:
+            self.log.info('Using solver {0} for {1} (override)'.format(
+                backend.name, device_key))
+            return backend
+
+        backends = self.registry.available(device_type)
+        if len(backends) <= 1:
+            return backends[0] if backends else None
+
+        choice = self.choices.get(device_key)
+        if choice is not None and not self.force_benchmark and \
+           choice['model'] == model and \
+           choice['backend'] in [b.name for b in backends]:
+            self.log.info('Using solver {0} for {1} (recorded)'.format(
+                choice['backend'], device_key))
+            return self.registry.get(choice['backend'])
+
+        results = self.benchmark(backends, device_type, device_id)
+        if not results:
+            return backends[0]
+        best = max(results, key=lambda name: results[name]['rate'])
+        self.log.info('Using solver {0} for {1} (benchmark: {2})'.format(
+            best, device_key, json.dumps(results)))
+        self.choices[device_key] = {'model': model,
+                                    'backend': best,
+                                    'results': results,
+                                    'time': time.time()}
+        self._save_choices()
+        return self.registry.get(best)
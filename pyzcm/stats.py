@@ -5,9 +5,87 @@
 
 MIT license
 """
+import asyncio
+import math
 import sys
+import time
 
 STATS_DISPLAY_PERIOD = 2
+# Smoothing factor of round trip time averages
+RTT_EWMA_ALPHA = 0.3
+
+# Solution hashes are compared to the target as 256-bit integers, a
+# solution is a share with probability target / HASH_SPACE
+HASH_SPACE = 2 ** 256
+# Solutions with hash below NEAR_SHARE_FACTOR * target are counted as
+# near shares - a larger sample for checking the solver output
+NEAR_SHARE_FACTOR = 16
+# z-scores of the reported confidence intervals (95 %) and of the
+# discrepancy alarms
+CONFIDENCE_Z = 1.96
+ALARM_Z = 3.0
+# Minimum expected count before counts are compared
+MIN_EXPECTED_COUNT = 10
+# Alarm when more responses than this fraction are rejects
+REJECT_ALARM_RATIO = 0.05
+MIN_SHARE_RESPONSES = 20
+# Solve times of solver runs are counted in a histogram with
+# logarithmic bins, SOLVE_TIME_BINS_PER_OCTAVE bins per doubling
+SOLVE_TIME_BINS_PER_OCTAVE = 8
+
+
+def ewma(average, sample, alpha=RTT_EWMA_ALPHA):
+    """Exponentially weighted moving average, the first sample
+    initializes the average"""
+    if average is None:
+        return sample
+    return alpha * sample + (1 - alpha) * average
+
+
+def poisson_interval(count, z=CONFIDENCE_Z):
+    """Approximate confidence interval of the mean of a Poisson
+    distributed count (square root transformation)
+    """
+    lower = max(math.sqrt(count) - z / 2, 0) ** 2
+    upper = (math.sqrt(count + 1) + z / 2) ** 2
+    return (lower, upper)
+
+
+def solve_time_bin(solve_time):
+    return int(math.floor(math.log2(max(solve_time, 1e-6)) *
+                          SOLVE_TIME_BINS_PER_OCTAVE))
+
+
+def bin_solve_time(solve_time_bin):
+    """Solve time in the middle of the bin"""
+    return 2 ** ((solve_time_bin + 0.5) / SOLVE_TIME_BINS_PER_OCTAVE)
+
+
+def histogram_count(histogram, min_bin=None):
+    """Runs in the histogram, only those in bins from min_bin up when
+    specified"""
+    return sum(count for b, count in histogram.items()
+               if min_bin is None or b >= min_bin)
+
+
+def histogram_quantile(histogram, q):
+    """Solve time of the quantile q, None for an empty histogram"""
+    total = histogram_count(histogram)
+    if total == 0:
+        return None
+    remaining = q * total
+    for b in sorted(histogram):
+        remaining -= histogram[b]
+        if remaining <= 0:
+            return bin_solve_time(b)
+    return bin_solve_time(max(histogram))
+
+
+def histogram_difference(histogram, previous):
+    """Runs counted in histogram since previous"""
+    return {b: count - previous.get(b, 0) for b, count in histogram.items()
+            if count > previous.get(b, 0)}
+
 
 class MinerStats(object):
     """
@@ -20,6 +98,21 @@ class MinerStats(object):
         self.rejected_share_count = 0
         self.accepted_share_submission_time = 0
         self.rejected_share_submission_time = 0
+        # solutions rejected locally by the verifier
+        self.invalid_solution_count = 0
+        self.duplicate_solution_count = 0
+        # shares expected from the solution count (sum of share
+        # probabilities), found shares and near shares
+        self.expected_share_count = 0
+        self.found_share_count = 0
+        self.near_share_count = 0
+        # rejected shares that were stale, submissions without a response
+        self.stale_share_count = 0
+        self.lost_share_count = 0
+        # solutions represented by the accepted shares
+        self.accepted_work = 0
+        # solver runs by solve time bin (see solve_time_bin())
+        self.solve_time_histogram = {}
 
     def __iadd__(self, other):
         self.solution_count += other.solution_count
@@ -28,6 +121,17 @@ class MinerStats(object):
         self.rejected_share_count += other.rejected_share_count
         self.accepted_share_submission_time += other.accepted_share_submission_time
         self.rejected_share_submission_time += other.rejected_share_submission_time
+        self.invalid_solution_count += other.invalid_solution_count
+        self.duplicate_solution_count += other.duplicate_solution_count
+        self.expected_share_count += other.expected_share_count
+        self.found_share_count += other.found_share_count
+        self.near_share_count += other.near_share_count
+        self.stale_share_count += other.stale_share_count
+        self.lost_share_count += other.lost_share_count
+        self.accepted_work += other.accepted_work
+        for b, count in other.solve_time_histogram.items():
+            self.solve_time_histogram[b] = \
+                self.solve_time_histogram.get(b, 0) + count
         return self
 
     def __format__(self, format_spec):
@@ -41,19 +145,159 @@ class MinerStats(object):
         else:
             return self.solution_count / self.solving_time
 
-    def update_accepted_shares(self, submission_time, count):
+    def update_accepted_shares(self, submission_time, count, work=0):
+        """
+        @param work - number of solutions the shares represent at their
+        target
+        """
         self.accepted_share_count += count
         self.accepted_share_submission_time += submission_time
+        self.accepted_work += work
 
-    def update_rejected_shares(self, submission_time, count):
+    def update_rejected_shares(self, submission_time, count, stale=False):
         self.rejected_share_count += count
         self.rejected_share_submission_time += submission_time
+        if stale:
+            self.stale_share_count += count
+
+    def update_lost_shares(self, count):
+        self.lost_share_count += count
+
+    def update_solve_time(self, solve_time):
+        """Accounts a solver run"""
+        b = solve_time_bin(solve_time)
+        self.solve_time_histogram[b] = self.solve_time_histogram.get(b, 0) + 1
+
+    def update_solution_hashes(self, target, solution_count, found_count,
+                               near_count):
+        """Accounts solutions checked against the target"""
+        self.expected_share_count += solution_count * target / HASH_SPACE
+        self.found_share_count += found_count
+        self.near_share_count += near_count
+
+    def effective_hash_rate(self, elapsed, z=CONFIDENCE_Z):
+        """Solution rate credited by the pool estimated from the accepted
+        shares
+
+        @return tuple (rate, lower bound, upper bound), bounds are None
+        without accepted shares
+        """
+        if elapsed <= 0 or self.accepted_share_count == 0:
+            return (0, None, None)
+        work_per_share = self.accepted_work / self.accepted_share_count
+        (lower, upper) = poisson_interval(self.accepted_share_count, z)
+        return (self.accepted_work / elapsed,
+                lower * work_per_share / elapsed,
+                upper * work_per_share / elapsed)
+
+    def discrepancies(self):
+        """Checks the share statistics for anomalies
+
+        @return list of alarm messages
+        """
+        alarms = []
+        # near shares are a larger sample of the solution hash
+        # distribution than shares
+        expected_near = self.expected_share_count * NEAR_SHARE_FACTOR
+        if expected_near >= MIN_EXPECTED_COUNT:
+            (lower, upper) = poisson_interval(self.near_share_count, ALARM_Z)
+            if not lower <= expected_near <= upper:
+                alarms.append('near shares {0} vs. {1:.0f} expected - solver ' \
+                              'output is suspicious'.format(
+                                  self.near_share_count, expected_near))
+        if self.expected_share_count >= MIN_EXPECTED_COUNT:
+            (lower, upper) = poisson_interval(self.accepted_share_count, ALARM_Z)
+            if self.expected_share_count > upper:
+                alarms.append('pool credited {0} shares vs. {1:.0f} ' \
+                              'expected'.format(self.accepted_share_count,
+                                                self.expected_share_count))
+        responses = self.accepted_share_count + self.rejected_share_count
+        if responses >= MIN_SHARE_RESPONSES and \
+           self.rejected_share_count > REJECT_ALARM_RATIO * responses:
+            alarms.append('{0} of {1} shares rejected ({2} stale)'.format(
+                self.rejected_share_count, responses, self.stale_share_count))
+        if self.lost_share_count != 0:
+            alarms.append('{} shares lost without a response'.format(
+                self.lost_share_count))
+        return alarms
+
+    def update_invalid_solutions(self, count):
+        self.invalid_solution_count += count
+
+    def update_duplicate_solutions(self, count):
+        self.duplicate_solution_count += count
 
     def reset(self):
         self.accepted_share_count = 0
         self.rejected_share_count = 0
         self.accepted_share_submission_time = 0
         self.rejected_share_submission_time = 0
+        self.invalid_solution_count = 0
+        self.duplicate_solution_count = 0
+        self.expected_share_count = 0
+        self.found_share_count = 0
+        self.near_share_count = 0
+        self.stale_share_count = 0
+        self.lost_share_count = 0
+        self.accepted_work = 0
+
+
+class ConnectionStats(object):
+    """
+    Statistics of connections to a single stratum server
+    """
+    def __init__(self):
+        self.connection_count = 0
+        self.resumed_count = 0
+        # duration of the last TCP connect and TLS handshake
+        self.connect_time = 0
+        self.handshake_time = 0
+        self.tls_resumed = False
+        # averaged network RTT (TCP connect) and stratum request RTT
+        self.rtt = None
+        self.stratum_rtt = None
+        # consecutive failures
+        self.failure_count = 0
+        self.last_failure_time = 0
+        # the server isn't selected until then (see
+        # EndpointSelector.quarantine())
+        self.quarantine_until = 0
+
+    def update(self, connect_time, handshake_time=0, tls_resumed=False):
+        self.connection_count += 1
+        self.connect_time = connect_time
+        self.handshake_time = handshake_time
+        self.tls_resumed = tls_resumed
+        if tls_resumed:
+            self.resumed_count += 1
+
+    def update_rtt(self, rtt):
+        self.rtt = ewma(self.rtt, rtt)
+
+    def update_stratum_rtt(self, rtt):
+        self.stratum_rtt = ewma(self.stratum_rtt, rtt)
+
+    def record_failure(self):
+        self.failure_count += 1
+        self.last_failure_time = time.time()
+
+    def record_success(self):
+        self.failure_count = 0
+
+    @staticmethod
+    def format_rtt(rtt):
+        return '--' if rtt is None else '{0:.01f} ms'.format(1000 * rtt)
+
+    def __format__(self, format_spec):
+        s = 'connect: {0:.01f} ms, RTT: {1}, stratum RTT: {2}'.format(
+            1000 * self.connect_time, self.format_rtt(self.rtt),
+            self.format_rtt(self.stratum_rtt))
+        if self.handshake_time != 0:
+            s += ', TLS handshake: {0:.01f} ms ({1}), resumed {2}/{3}'.format(
+                1000 * self.handshake_time,
+                'resumed' if self.tls_resumed else 'full',
+                self.resumed_count, self.connection_count)
+        return s
 
 
 class StatsManager(object):
@@ -66,15 +310,41 @@ class StatsManager(object):
     def __init__(self):
         self.stratum_client = None
         self.miner_manager = None
+        self.selector = None
+        self.share_rate = None
+        # optional PoolHealth of the active server
+        self.health = None
+        # optional HistoryRecorder of the miner stats
+        self.history = None
+
+    async def run(self):
+        while True:
+            self.display()
+            if self.history is not None and self.miner_manager is not None:
+                self.history.sample(self.miner_manager.miners)
+            await asyncio.sleep(STATS_DISPLAY_PERIOD)
 
-    def run(self, loop):
+    def display(self):
         sys.stdout.write('======== Mining Stats =======\n')
         if self.stratum_client is not None:
-            connected = 'Yes' if self.stratum_client.notifier is not None else 'No'
-            sys.stdout.write('Stratum server: {0}, connected: {1}\n'.format(
+            connected = 'Yes' if self.stratum_client.connected else 'No'
+            sys.stdout.write('{0} server: {1}, connected: {2}\n'.format(
+                'Node' if self.stratum_client.server.solo else 'Stratum',
                 self.stratum_client.server, connected))
+            if self.stratum_client.connected:
+                sys.stdout.write('Connection: {}\n'.format(
+                    self.stratum_client.server.stats))
         else:
             sys.stdout.write('Waiting for stratum client...\n')
+        if self.selector is not None:
+            sys.stdout.write('Endpoints: {}\n'.format(self.selector))
+        if self.share_rate is not None:
+            share_rate = format(self.share_rate)
+            if share_rate:
+                sys.stdout.write('Share rate: {}\n'.format(share_rate))
+        if self.health is not None and self.stratum_client is not None and \
+           self.stratum_client.connected:
+            sys.stdout.write('Health: {}\n'.format(self.health))
 
         if self.miner_manager is not None:
             sys.stdout.write(self.miner_manager.format_stats())
@@ -82,4 +352,3 @@ class StatsManager(object):
             sys.stdout.write('Waiting for miner backend...\n')
         sys.stdout.write('\n')
         sys.stdout.flush()
-        loop.call_later(STATS_DISPLAY_PERIOD, self.run, loop)
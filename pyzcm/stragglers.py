@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Straggler and degradation detection
+
+The detector periodically takes the solve time histogram of each
+miner (runs since the previous analysis, see
+MinerStats.solve_time_histogram) and evaluates the runs of the last
+STRAGGLER_WINDOW analyses. A miner is flagged when:
+- its median solve time exceeds the median of its peers by more than
+  PEER_SLOWDOWN - peers are miners of the same device type, model
+  (persistent_unique_id of GPU's), solver and instance count
+- its median solve time exceeds its own baseline by more than
+  BASELINE_SLOWDOWN - the baseline is the median taken after
+  BASELINE_WARMUP analyses
+- more than BIMODAL_FRACTION of its runs take SLOW_RUN_FACTOR times
+  longer than the baseline (or the peers) while the median is fine -
+  a bimodal solve time, e.g. an instance that keeps getting stalled
+
+Miners flagged by RESTART_AFTER consecutive analyses are optionally
+restarted (GPU miners get a new backend process), a device is
+restarted at most once per RESTART_MIN_INTERVAL.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from pyzcm.stats import histogram_count, histogram_quantile, \
+    histogram_difference, solve_time_bin
+
+STRAGGLER_PERIOD = 60
+# Number of the last analysis periods evaluated
+STRAGGLER_WINDOW = 5
+# Runs required in the window for evaluating a miner
+MIN_RUNS = 20
+PEER_SLOWDOWN = 1.25
+BASELINE_SLOWDOWN = 1.25
+# Analyses of a miner before its baseline is taken (solvers warm up)
+BASELINE_WARMUP = 2
+SLOW_RUN_FACTOR = 1.5
+BIMODAL_FRACTION = 0.1
+RESTART_AFTER = 3
+RESTART_MIN_INTERVAL = 1800
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+class _MinerState(object):
+    """Solve times of a miner kept by the detector"""
+    def __init__(self):
+        self.last_histogram = {}
+        # histograms of the last analysis periods
+        self.windows = collections.deque(maxlen=STRAGGLER_WINDOW)
+        self.analysis_count = 0
+        self.median = None
+        self.baseline = None
+        self.window_histogram = {}
+        # consecutive analyses that flagged the miner
+        self.flagged_count = 0
+
+    def update(self, histogram):
+        self.windows.append(histogram_difference(histogram,
+                                                 self.last_histogram))
+        self.last_histogram = dict(histogram)
+        self.window_histogram = {}
+        for w in self.windows:
+            for b, count in w.items():
+                self.window_histogram[b] = self.window_histogram.get(b, 0) + count
+        self.median = None
+        if histogram_count(self.window_histogram) >= MIN_RUNS:
+            self.analysis_count += 1
+            self.median = histogram_quantile(self.window_histogram, 0.5)
+            if self.baseline is None and \
+               self.analysis_count > BASELINE_WARMUP:
+                self.baseline = self.median
+
+    def slow_fraction(self, reference):
+        """Fraction of runs in the window taking SLOW_RUN_FACTOR times
+        longer than the reference solve time"""
+        slow_bin = solve_time_bin(reference * SLOW_RUN_FACTOR)
+        return histogram_count(self.window_histogram, slow_bin + 1) / \
+            histogram_count(self.window_histogram)
+
+
+class StragglerDetector(object):
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'StragglerDetector'))
+
+    def __init__(self, period=STRAGGLER_PERIOD, restart=False):
+        """
+        @param restart - restart miners that keep being flagged
+        """
+        self.period = period
+        self.restart = restart
+        self.states = {}
+        # last restart time by device
+        self.restarts = {}
+        # findings of the last analysis by miner name
+        self.findings = collections.OrderedDict()
+        # kinds of the problems found by the last analysis by miner name,
+        # a problem is logged when it appears
+        self.problem_kinds = {}
+
+    @staticmethod
+    def get_peer_key(miner):
+        return (miner.device_type, miner.device_model,
+                getattr(miner.solver_class, '__name__', str(miner.solver_class)),
+                getattr(miner, 'instances', 1))
+
+    def analyse(self, miners):
+        """@return miners to be restarted"""
+        states = {}
+        for m in miners:
+            state = self.states.get(m) or _MinerState()
+            if not m.paused:
+                state.update(m.stats.solve_time_histogram)
+            else:
+                # solve times measured before pausing would be compared
+                # with the peers in the next window
+                state.last_histogram = dict(m.stats.solve_time_histogram)
+                state.median = None
+            states[m] = state
+        # forget miners that have been stopped
+        self.states = states
+
+        peers = collections.defaultdict(list)
+        for m, state in states.items():
+            if state.median is not None:
+                peers[self.get_peer_key(m)].append(m)
+
+        findings = collections.OrderedDict()
+        problem_kinds = {}
+        for m, state in states.items():
+            if state.median is None:
+                continue
+            # (kind, description) pairs
+            problems = []
+            peer_medians = [states[p].median for p in peers[self.get_peer_key(m)]
+                            if p is not m]
+            peer_median = median(peer_medians) if peer_medians else None
+            if peer_median is not None and \
+               state.median > PEER_SLOWDOWN * peer_median:
+                problems.append(('peers', 'median solve time {0:.03f} s ' \
+                                 'is {1:.0%} above {2} peers'.format(
+                                     state.median,
+                                     state.median / peer_median - 1,
+                                     len(peer_medians))))
+            if state.baseline is not None and \
+               state.median > BASELINE_SLOWDOWN * state.baseline:
+                problems.append(('baseline', 'median solve time {0:.03f} s ' \
+                                 'is {1:.0%} above its baseline'.format(
+                                     state.median,
+                                     state.median / state.baseline - 1)))
+            reference = state.baseline or peer_median
+            if not problems and reference is not None:
+                slow_fraction = state.slow_fraction(reference)
+                if slow_fraction > BIMODAL_FRACTION:
+                    problems.append(('bimodal', '{0:.0%} of runs take over ' \
+                                     '{1:.03f} s (bimodal solve time)'.format(
+                                         slow_fraction,
+                                         reference * SLOW_RUN_FACTOR)))
+            if problems:
+                state.flagged_count += 1
+                name = format(m, 's')
+                findings[name] = [p for (kind, p) in problems]
+                problem_kinds[name] = set(kind for (kind, p) in problems)
+                # the figures change every period, only a new kind of
+                # problem is reported
+                for (kind, p) in problems:
+                    if kind not in self.problem_kinds.get(name, ()):
+                        self.log.warn('Straggler {0}: {1}'.format(name, p))
+            else:
+                state.flagged_count = 0
+        self.findings = findings
+        self.problem_kinds = problem_kinds
+
+        restarts = []
+        now = time.time()
+        for m, state in states.items():
+            device = (m.device_type, m.device_id)
+            if self.restart and state.flagged_count >= RESTART_AFTER and \
+               now - self.restarts.get(device, 0) > RESTART_MIN_INTERVAL:
+                self.restarts[device] = now
+                restarts.append(m)
+        return restarts
+
+    async def run(self, miner_manager):
+        while True:
+            await asyncio.sleep(self.period)
+            try:
+                for m in self.analyse(miner_manager.miners):
+                    self.log.warn('Restarting straggler {:s}'.format(m))
+                    await miner_manager.restart_miner(m)
+            except Exception as e:
+                self.log.error('Straggler detection failed: {}'.format(e))
+
+    def as_dict(self):
+        return {'findings': self.findings,
+                'medians': {format(m, 's'): state.median
+                            for m, state in self.states.items()},
+                'baselines': {format(m, 's'): state.baseline
+                              for m, state in self.states.items()}}
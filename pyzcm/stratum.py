@@ -15,6 +15,24 @@ from hashlib import sha256
 
 from pyzcm.version import VERSION
 from pyzcm.miner.params import *
+from pyzcm.selector import open_happy_eyeballs
+from pyzcm.stats import HASH_SPACE
+from pyzcm.sharerate import SHARE_RATE_PERIOD, target_to_difficulty
+
+# Stratum error code of shares submitted for an unknown (stale) job
+STALE_ERROR_CODE = 21
+
+
+def is_stale_error(error):
+    """Checks whether a share was rejected for being stale, pools report
+    either error code 21 or describe it in the message"""
+    if isinstance(error, (list, tuple)) and len(error) > 0:
+        if error[0] == STALE_ERROR_CODE:
+            return True
+        error = error[1] if len(error) > 1 else ''
+    message = str(error).lower()
+    return 'stale' in message or 'job not found' in message
+
 
 class Job(object):
     log = logging.getLogger('{0}.{1}'.format(__name__, 'Job'))
@@ -52,57 +70,273 @@ class Job(object):
         assert(len(header) == ZC_BLOCK_HEADER_LENGTH)
         return header
 
-    def is_valid(self, header, len_and_solution):
+    def get_hash_int(self, header, len_and_solution):
+        """Hash of the header with solution as an integer that is compared
+        to the target
+        """
         assert(len(header) == ZC_BLOCK_HEADER_LENGTH)
-        assert(len(len_and_solution) == ZC_SOLUTION_LENGTH + 3)
-        assert(self.target is not None)
+        assert(len(len_and_solution) == ZC_LEN_AND_SOLUTION_LENGTH)
+
+        # len_and_solution may be a view into the solver buffer, hash it
+        # without concatenating
+        header_hash = sha256(header)
+        header_hash.update(len_and_solution)
+        hash = sha256(header_hash.digest()).digest()
+        return int.from_bytes(hash, 'little')
 
-        hash = sha256(sha256(header + len_and_solution).digest()).digest()
-        hash_int = int.from_bytes(hash, 'little')
+    @property
+    def share_work(self):
+        """Expected number of solutions per share at the current target"""
+        return HASH_SPACE / self.target
+
+    def is_valid(self, header, len_and_solution):
+        assert(self.target is not None)
+        hash_int = self.get_hash_int(header, len_and_solution)
         result = hash_int < self.target
 
         # hash values are formatted as 2(0x) + 64 characters = 66 with leading 0's
-        self.log.debug('Job ID:{0} hash {1:#066x} < {2:#066x} = result:{3}'.format(
-            self.job_id, hash_int, self.target, result))
+        self.log.debug('Job ID:%s hash %#066x < %#066x = result:%s',
+                       self.job_id, hash_int, self.target, result)
 
         return result
     def __repr__(self):
         return str(self.__dict__)
 
+
+class JobDelta(object):
+    """Attributes in which a job differs from the base job.
+
+    Jobs that only refresh the previous one (typically ntime or the
+    merkle root) are shipped to miner backends as a delta, the backend
+    patches a copy of its current job.
+    """
+    def __init__(self, base, job):
+        self.base = base
+        self.job_id = job.job_id
+        self.changes = {name: value for name, value in vars(job).items()
+                        if name not in vars(base) or vars(base)[name] != value}
+
+    def __format__(self, format_spec):
+        return 'Job ID: {0}, changes: {1}'.format(
+            self.job_id, ', '.join(sorted(self.changes)))
+
+
 class StratumClient(object):
     """Stratum client as per specification @ https://github.com/zcash/zips/pull/78"""
 
     log = logging.getLogger('{0}.{1}'.format(__name__, 'StratumClient'))
 
-    def __init__(self, loop, server, miners):
+    def __init__(self, loop, server, miners, recorder=None, share_rate=None,
+                 health=None):
+        """
+        @param recorder - optional SessionRecorder for capturing the traffic
+        @param share_rate - optional ShareRateController that suggests the
+        target to the pool and limits the submitted shares
+        @param health - optional SessionHealth that records the jobs and
+        share responses
+        """
         self.loop = loop
         self.server = server
         self.miners = miners
+        self.recorder = recorder
+        self.share_rate = share_rate
+        self.health = health
         self.msg_id = 0 # counter of stratum messages
 
         self.writer = None
         self.notifier = None
-
-    @asyncio.coroutine
-    def connect(self):
-        self.log.debug('Connecting to {}'.format(self.server))
-        #asyncio.open_connection()
-        reader, self.writer = yield from asyncio.open_connection(self.server.host, self.server.port, loop=self.loop)
+        # authorized worker names by worker suffixes (see
+        # MinerManager.get_worker)
+        self.worker_names = {}
+        # authorized and subscribed for jobs
+        self.established = False
+        self.target = None
+        # parameters of the last mining.notify
+        self.last_notify = None
+        # set when the session has been handed over to another process,
+        # shares are passed to the callback from then on
+        self.forward_share = None
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    @property
+    def detached(self):
+        return self.forward_share is not None
+
+    async def connect(self, session=None):
+        """Establishes the stratum session and processes it until the
+        connection fails
+
+        @param session - session handed over by another process (see
+        detach()), it is resumed on its socket without authorizing and
+        subscribing again
+        """
+        if session is None:
+            reader = await self.open()
+        else:
+            reader = await self.resume(session)
+        tls_context = self.server.tls_context
 
         # Observe and route incoming message
-        self.notifier = StratumNotifier(reader, self.on_notify)
+        self.notifier = StratumNotifier(reader, self.on_notify, self.recorder)
+        if session is not None:
+            # Responses to the requests of the previous process may already
+            # be buffered, the waiters have to be registered before the
+            # notifier starts processing
+            handed_over = [(msg_id, self.notifier.wait_for(msg_id))
+                           for msg_id in session['pending']]
         self.notifier.run()
 
-        yield from self.authorize()
-        yield from self.subscribe()
+        if session is None:
+            await self.authorize()
+            await self.subscribe()
+            if tls_context is not None:
+                # Server has responded by now, session tickets should be
+                # available
+                tls_context.save_session(
+                    self.writer.get_extra_info('ssl_object'))
+        else:
+            for (msg_id, response) in handed_over:
+                self.loop.create_task(self.wait_for_handed_over(msg_id,
+                                                                response))
+        self.server.stats.record_success()
+        self.established = True
+
+        # Wait until the notifier fails or wants to stop processing
+        if self.share_rate is not None and self.share_rate.enabled:
+            share_rate_task = self.loop.create_task(self.control_share_rate())
+            await asyncio.wait([self.notifier.task])
+            share_rate_task.cancel()
+        else:
+            await asyncio.wait([self.notifier.task])
+        if self.detached:
+            return
+        # Let ServerSwitcher catch this and round-robin connection
+        raise self.notifier.task.exception() or Exception('StratumNotifier failed, restarting.')
 
-        while True:
-            yield from asyncio.sleep(1)
+    async def open(self):
+        """Connects to the server
 
-            if self.notifier.task.done():
-                # Notifier failed or wanted to stop procesing
-                # Let ServerSwitcher catch this and round-robin connection
-                raise self.notifier.task.exception() or Exception('StratumNotifier failed, restarting.')
+        @return reader of the connection
+        """
+        self.log.debug('Connecting to {}'.format(self.server))
+        t_start = time.time()
+        (sock, rtt) = await open_happy_eyeballs(self.loop,
+                                                     self.server.host,
+                                                     self.server.port)
+        t_connected = time.time()
+        self.server.stats.update_rtt(rtt)
+
+        tls_context = self.server.tls_context
+        if tls_context is None:
+            reader, self.writer = await asyncio.open_connection(sock=sock)
+            self.server.stats.update(t_connected - t_start)
+        else:
+            try:
+                reader, self.writer = await asyncio.open_connection(
+                    sock=sock, ssl=tls_context.context,
+                    server_hostname=self.server.host)
+                ssl_object = self.writer.get_extra_info('ssl_object')
+                tls_context.check_peer(ssl_object)
+            except:
+                # Don't try to resume a session that has just failed
+                tls_context.forget_session()
+                if self.writer is not None:
+                    self.writer.close()
+                else:
+                    sock.close()
+                raise
+            self.server.stats.update(t_connected - t_start,
+                                     time.time() - t_connected,
+                                     ssl_object.session_reused)
+        self.log.info('Connected to {0}, {1}'.format(self.server,
+                                                      self.server.stats))
+        if self.recorder is not None:
+            self.recorder.connected(self.server)
+        return reader
+
+    async def resume(self, session):
+        """Restores the session handed over by another process on its
+        socket
+
+        @return reader of the connection
+        """
+        reader = asyncio.StreamReader()
+        # data received by the previous process but not processed yet
+        reader.feed_data(session['buffer'].encode('latin-1'))
+        protocol = asyncio.StreamReaderProtocol(reader)
+        (transport, _) = await self.loop.create_connection(
+            lambda: protocol, sock=session['socket'])
+        self.writer = asyncio.StreamWriter(transport, protocol, reader,
+                                           self.loop)
+        self.log.info('Resumed session with {0}, nonce1:{1}'.format(
+            self.server, session['nonce1']))
+        if self.recorder is not None:
+            self.recorder.connected(self.server)
+
+        self.msg_id = session['msg_id']
+        self.target = session['target']
+        self.worker_names = session['worker_names']
+        self.miners.reset_worker_targets()
+        for worker, target in session['worker_targets'].items():
+            self.miners.set_worker_target(worker, target)
+        if self.share_rate is not None:
+            self.share_rate.suggested_target = session['suggested_target']
+        self.miners.set_nonce(binascii.unhexlify(session['nonce1']))
+        if session['notify'] is not None:
+            await self.on_notify({'id': None, 'method': 'mining.notify',
+                                  'params': session['notify']})
+        return reader
+
+    def detach(self, forward_share):
+        """Stops processing the connection so that the session can be
+        handed over to another process, shares found from now on are
+        passed to forward_share(worker_name, job, nonce2,
+        len_and_solution)
+
+        @return the session (the socket has to be sent along), None when
+        the connection cannot be handed over
+        """
+        if not self.established or self.server.tls or \
+           self.notifier.task.done():
+            return None
+        self.forward_share = forward_share
+        self.writer.transport.pause_reading()
+        # the notifier can only be waiting for data, the unprocessed part
+        # stays in the reader buffer
+        self.notifier.task.cancel()
+        share_rate = self.share_rate
+        return {
+            'socket': self.writer.get_extra_info('socket').fileno(),
+            'buffer': bytes(self.notifier.reader._buffer).decode('latin-1'),
+            'msg_id': self.msg_id,
+            'pending': [msg_id for (msg_id, f) in self.notifier.waiters.items()
+                        if not f.done()],
+            'nonce1': binascii.hexlify(self.miners.nonce1).decode(),
+            'target': self.target,
+            'notify': self.last_notify,
+            'worker_names': self.worker_names,
+            'worker_targets': self.miners.worker_targets,
+            'suggested_target': share_rate.suggested_target
+                                if share_rate is not None else None,
+        }
+
+    async def wait_for_handed_over(self, msg_id, response):
+        """Logs the response to a request of the previous process
+
+        @param response - awaitable response registered by
+        StratumNotifier.wait_for()
+        """
+        try:
+            ret = await response
+        except Exception as e:
+            self.log.warn('No response to request {0} of the previous ' \
+                          'process: {1}'.format(msg_id, e))
+            return
+        self.log.info('Response to request {0} of the previous process: ' \
+                      '{1}'.format(msg_id, ret))
 
     def new_id(self):
         self.msg_id += 1
@@ -112,33 +346,109 @@ class StratumClient(object):
         self.log.debug('Closing the socket')
         self.writer.close()
 
-    @asyncio.coroutine
-    def on_notify(self, msg):
+    async def on_notify(self, msg):
         if msg['method'] == 'mining.notify':
             self.log.debug('Giving new job to miners')
+            self.last_notify = msg['params']
+            if self.health is not None:
+                self.health.record_job()
             j = Job(msg['params'])
-            j.set_target(self.target)
+            j.set_target(self.limit_target(self.target))
             self.miners.register_new_job(j, self.submit)
             return
 
         if msg['method'] == 'mining.set_target':
-            self.target = int.from_bytes(binascii.unhexlify(msg['params'][0]), 'big')
-            self.log.debug('Received set.target: {:#064x}'.format(self.target))
+            target = int.from_bytes(binascii.unhexlify(msg['params'][0]), 'big')
+            # optional worker name limits the target to the worker (the
+            # target may arrive before the authorization is processed)
+            workers = {self.get_worker_name(w): w
+                       for w in self.miners.get_workers() if w is not None}
+            if len(msg['params']) > 1 and msg['params'][1] in workers:
+                self.miners.set_worker_target(workers[msg['params'][1]],
+                                              self.limit_target(target))
+                self.log.debug('Received set.target: {0:#064x} for {1}'.format(
+                    target, msg['params'][1]))
+            else:
+                self.target = target
+                self.log.debug('Received set.target: {:#064x}'.format(self.target))
             return
 
         self.log.warn('Received unknown notification: {}'.format(msg))
 
-    @asyncio.coroutine
-    def authorize(self):
-        ret = yield from self.call('mining.authorize', self.server.username, self.server.password)
+    def limit_target(self, target):
+        """Target of the jobs, shares below the minimum difficulty are not
+        submitted"""
+        if self.share_rate is None:
+            return target
+        return self.share_rate.limit_target(target)
+
+    async def control_share_rate(self):
+        """Suggests the target that yields the configured share rate"""
+        while True:
+            self.share_rate.update(self.miners.miners)
+            target = self.share_rate.get_target()
+            if self.share_rate.needs_suggestion(target):
+                await self.suggest_target(target)
+            await asyncio.sleep(SHARE_RATE_PERIOD)
+
+    async def suggest_target(self, target):
+        self.share_rate.suggested_target = target
+        self.log.info('Suggesting difficulty {:.02f}'.format(
+            target_to_difficulty(target)))
+        try:
+            ret = await self.call('mining.suggest_target',
+                                  '{:064x}'.format(target))
+            self.log.debug('Suggest target result: {}'.format(ret))
+        except Exception as e:
+            # pools are not required to respond
+            self.log.debug('Suggest target failed: {}'.format(e))
+
+    async def authorize(self):
+        password = self.server.password
+        if self.share_rate is not None:
+            password = self.share_rate.get_password(password)
+        ret = await self.call('mining.authorize', self.server.username, password)
         self.log.debug('Authorization result: {}'.format(ret))
         if ret['result'] != True:
             raise Exception('Authorization failed: {}'.format(ret['error']))
         self.log.info('Successfully authorized as {}'.format(self.server.username))
 
-    @asyncio.coroutine
-    def subscribe(self):
-        ret = yield from self.call('mining.subscribe', VERSION, None, self.server.host, self.server.port)
+        self.worker_names = {}
+        self.miners.reset_worker_targets()
+        workers = [w for w in self.miners.get_workers() if w is not None]
+        results = await asyncio.gather(*[self.authorize_worker(w)
+                                         for w in workers])
+        for worker, name in zip(workers, results):
+            if name is not None:
+                self.worker_names[worker] = name
+
+    def get_worker_name(self, worker):
+        """Full name of the worker - the suffix extends the worker of the
+        server username ('account.rig' -> 'account.rig_gpu0_0') or names a
+        worker of the account ('account' -> 'account.gpu0_0')
+        """
+        if worker is None:
+            return self.server.username
+        return '{0}{1}{2}'.format(self.server.username,
+                                  '_' if '.' in self.server.username else '.',
+                                  worker)
+
+    async def authorize_worker(self, worker):
+        """@return name of the authorized worker, None when its miners
+        have to submit under the server username"""
+        name = self.get_worker_name(worker)
+        ret = await self.call('mining.authorize', name, self.server.password)
+        if ret['result'] != True:
+            self.log.warn('Authorization of worker {0} failed, submitting ' \
+                          'as {1}: {2}'.format(name, self.server.username,
+                                               ret['error']))
+            self.miners.set_worker_target(worker, None)
+            return None
+        self.log.info('Successfully authorized worker {}'.format(name))
+        return name
+
+    async def subscribe(self):
+        ret = await self.call('mining.subscribe', VERSION, None, self.server.host, self.server.port)
         nonce1_str = ret['result'][1]
         nonce1 = binascii.unhexlify(nonce1_str)
         self.log.debug('Successfully subscribed for jobs, nonce1:{}'.format(nonce1_str))
@@ -149,11 +459,14 @@ class StratumClient(object):
         """Triggers asynchronous submission of the share to the stratum server
 
         """
-        asyncio.async(self._do_submit(miner, job, nonce2, len_and_solution),
-                      loop=self.loop)
+        if self.detached:
+            self.forward_share(self.get_submit_name(miner), job, nonce2,
+                               len_and_solution)
+            return
+        self.loop.create_task(self._do_submit(miner, job, nonce2,
+                                              len_and_solution))
 
-    @asyncio.coroutine
-    def _do_submit(self, miner, job, nonce2, len_and_solution):
+    async def _do_submit(self, miner, job, nonce2, len_and_solution):
         """Submit a solution (share) to the stratum server.
 
         @param job - job that the miner has worked on and found solution
@@ -162,45 +475,92 @@ class StratumClient(object):
         prefix as required by the zcash protocol
         """
         t = time.time()
-        ret = yield from self.call('mining.submit',
-                        self.server.username,
-                        job.job_id,
-                        binascii.hexlify(job.ntime).decode('utf-8'),
-                        binascii.hexlify(nonce2).decode('utf-8'),
-                        binascii.hexlify(len_and_solution).decode('utf-8'))
+        try:
+            ret = await self.call('mining.submit',
+                            self.get_submit_name(miner),
+                            job.job_id,
+                            binascii.hexlify(job.ntime).decode('utf-8'),
+                            binascii.hexlify(nonce2).decode('utf-8'),
+                            binascii.hexlify(len_and_solution).decode('utf-8'))
+        except Exception as e:
+            if self.detached:
+                self.log.info('Share submitted before the handover, the ' \
+                              'response goes to the new process')
+                return
+            miner.update_lost_stats()
+            if self.health is not None:
+                self.health.record_lost()
+            self.log.warn('Share LOST: {}'.format(e))
+            return
         delta_time = time.time() - t
         delta_time_str = '{:.02f} s'.format(delta_time)
+        if self.health is not None:
+            self.health.record_response(delta_time, ret['result'] == True)
         if ret['result'] == True:
-            miner.update_accepted_stats(delta_time)
+            miner.update_accepted_stats(delta_time, job.share_work)
             self.log.info('Share ACCEPTED in ' + delta_time_str)
         else:
-            miner.update_rejected_stats(delta_time)
-            self.log.warn('Share REJECTED in ' + delta_time_str)
+            stale = is_stale_error(ret.get('error'))
+            miner.update_rejected_stats(delta_time, stale)
+            self.log.warn('Share REJECTED{0} in {1}: {2}'.format(
+                ' (stale)' if stale else '', delta_time_str, ret.get('error')))
+
+    def get_submit_name(self, miner):
+        """Worker name the miner submits under"""
+        return self.worker_names.get(self.miners.get_worker(miner),
+                                     self.server.username)
+
+    async def submit_forwarded(self, name, job_id, ntime, nonce2,
+                               len_and_solution):
+        """Submits a share forwarded by the previous process after the
+        handover"""
+        try:
+            ret = await self.call('mining.submit', name, job_id, ntime,
+                                  nonce2, len_and_solution)
+        except Exception as e:
+            self.log.warn('Forwarded share LOST: {}'.format(e))
+            return
+        if ret['result'] == True:
+            self.log.info('Forwarded share ACCEPTED')
+        else:
+            self.log.warn('Forwarded share REJECTED: {}'.format(
+                ret.get('error')))
 
-    @asyncio.coroutine
-    def call(self, method, *params):
+    async def call(self, method, *params):
         msg_id = self.new_id()
         msg = {'id': msg_id,
                'method': method,
                'params': params}
 
         data = '{}\n'.format(json.dumps(msg))
-        self.log.debug('< %s' % data[:200] + (data[200:] and '...\n'))
+        # skip formatting of the debug messages on the hot path
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.log.debug('< %s%s', data[:200], data[200:] and '...\n')
+        if self.recorder is not None:
+            self.recorder.sent(msg)
+        # The response may arrive as soon as the request is written,
+        # the waiter has to be registered before
+        response = self.notifier.wait_for(msg_id)
+        t = time.time()
         self.writer.write(data.encode())
 
         try:
-            #r = asyncio.ensure_future(self.notifier.wait_for(msg_id))
-            r = asyncio.async(self.notifier.wait_for(msg_id))
-            yield from asyncio.wait([r, self.notifier.task], timeout=30, return_when=asyncio.FIRST_COMPLETED)
+            r = self.loop.create_task(response)
+            await asyncio.wait([r, self.notifier.task], timeout=30, return_when=asyncio.FIRST_COMPLETED)
 
             if self.notifier.task.done():
+                if self.detached:
+                    raise Exception('Session has been handed over')
                 raise self.notifier.task.exception()
 
             data = r.result()
-            log = '> {}'.format(data)
-            self.log.debug(log[:100] + (log[100:] and '...'))
+            self.server.stats.update_stratum_rtt(time.time() - t)
+            if debug:
+                log = '> {}'.format(data)
+                self.log.debug('%s%s', log[:100], log[100:] and '...')
 
-        except TimeoutError:
+        except asyncio.TimeoutError:
             raise Exception('Request to server timed out.')
 
         return data
@@ -209,45 +569,54 @@ class StratumClient(object):
 class StratumNotifier(object):
     log = logging.getLogger('{0}.{1}'.format(__name__, 'StratumNotifier'))
 
-    def __init__(self, reader, on_notify):
+    def __init__(self, reader, on_notify, recorder=None):
         self.waiters = {}
         self.on_notify = on_notify
         self.reader = reader
+        self.recorder = recorder
         self.task = None
 
     def run(self):
-        # self.task = asyncio.ensure_future(self.observe())
-        self.task = asyncio.async(self.observe())
+        self.task = asyncio.ensure_future(self.observe())
         return self.task
 
-    @asyncio.coroutine
-    def observe(self):
+    async def observe(self):
         try:
             while True:
-                data = yield from self.reader.readline()
+                data = await self.reader.readline()
                 if data == b'':
                     raise Exception('Server closed connection.')
+                if self.recorder is not None:
+                    self.recorder.received(data)
 
                 try:
                     msg = json.loads(data.decode())
-                    self.log.debug('Received JSON message:{}'.format(msg))
+                    self.log.debug('Received JSON message:%s', msg)
                 except:
                     raise Exception('Received corrupted data from server: {}'.format(data))
 
                 if msg['id'] == None:
                     # It is notification
-                    yield from self.on_notify(msg)
+                    await self.on_notify(msg)
                 else:
                     # It is response of our call
-                    self.waiters[int(msg['id'])].set_result(msg)
-
-        except Exception as e:
+                    waiter = self.waiters.pop(int(msg['id']), None)
+                    if waiter is None or waiter.done():
+                        self.log.warning('Dropping response to unknown ' \
+                                         'request: {}'.format(msg['id']))
+                        continue
+                    waiter.set_result(msg)
+
+        except Exception:
             # Do not try to recover from errors, let ServerSwitcher handle this
             traceback.print_exc()
             raise
 
-    @asyncio.coroutine
     def wait_for(self, msg_id):
+        """Registers a waiter for the response to the request
+
+        @return awaitable response
+        """
         f = asyncio.Future()
         self.waiters[msg_id] = f
-        return (yield from asyncio.wait_for(f, 10))
+        return asyncio.wait_for(f, 10)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""TLS support for stratum connections
+
+The module provides per server TLS settings that keep the SSL context
+and the last TLS session so that reconnects (e.g. after a failover)
+can resume the session instead of doing a full handshake.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import ssl
+import hashlib
+import logging
+
+# URL schemes that select a TLS connection
+TLS_SCHEMES = ('stratum+ssl', 'stratum+tls')
+# URL schemes that select a plain TCP connection
+TCP_SCHEMES = ('', 'stratum+tcp')
+
+
+class TlsPinningError(ssl.SSLError):
+    """Peer certificate doesn't match any of the pinned fingerprints"""
+    pass
+
+
+class _ResumingSSLContext(ssl.SSLContext):
+    """SSL context that offers the last saved session to the server.
+
+    asyncio doesn't provide a way to pass an SSL session when
+    establishing a connection, therefore, the session is injected
+    when the SSL object is being created.
+    """
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session
+        return super(_ResumingSSLContext, self).wrap_bio(
+            incoming, outgoing, server_side=server_side,
+            server_hostname=server_hostname, session=session)
+
+
+def format_fingerprint(fingerprint):
+    """Normalize a SHA256 fingerprint - accepts hex string with
+    optional ':' separators in any case.
+    """
+    return fingerprint.replace(':', '').lower()
+
+
+def cert_fingerprint(der_cert):
+    """SHA256 fingerprint of a DER encoded certificate as hex string"""
+    return hashlib.sha256(der_cert).hexdigest()
+
+
+class TlsContext(object):
+    """TLS settings of a single stratum server.
+
+    The SSL context is kept for the lifetime of the server so that
+    the cached session can be reused for the next connection.
+    """
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'TlsContext'))
+
+    def __init__(self, cafile=None, verify=True, fingerprints=()):
+        """
+        @param cafile - optional file with trusted CA certificates,
+        system defaults are used if not specified
+        @param verify - verify the certificate chain and hostname
+        @param fingerprints - SHA256 fingerprints of pinned server
+        certificates, any certificate is accepted when empty
+        """
+        self.cafile = cafile
+        self.verify = verify
+        self.fingerprints = set(format_fingerprint(f) for f in fingerprints)
+        self.context = self._create_context()
+
+    def _create_context(self):
+        context = _ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if self.verify:
+            if self.cafile is not None:
+                context.load_verify_locations(cafile=self.cafile)
+            else:
+                context.load_default_certs()
+        else:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def add_fingerprint(self, fingerprint):
+        self.fingerprints.add(format_fingerprint(fingerprint))
+
+    @property
+    def session(self):
+        return self.context.session
+
+    def check_peer(self, ssl_object):
+        """Verify that the peer certificate is pinned (if pinning has been
+        requested)
+
+        @raise TlsPinningError if the certificate is not pinned
+        """
+        if not self.fingerprints:
+            return
+        fingerprint = cert_fingerprint(ssl_object.getpeercert(binary_form=True))
+        if fingerprint not in self.fingerprints:
+            raise TlsPinningError('Server certificate {0} is not pinned'.format(
+                fingerprint))
+
+    def save_session(self, ssl_object):
+        """Remember the session of the connection for future resumption.
+
+        Session tickets (TLS 1.3) are sent by the server after the
+        handshake, therefore, this should be called once the server has
+        sent some application data.
+        """
+        session = ssl_object.session
+        if session is None:
+            return
+        # TLS 1.3 session without a ticket cannot be resumed
+        if session.has_ticket or ssl_object.version() != 'TLSv1.3':
+            self.context.session = session
+
+    def forget_session(self):
+        self.context.session = None
+
+    def __format__(self, format_spec):
+        return 'verify:{0} pinned:{1} session cached:{2}'.format(
+            self.verify, len(self.fingerprints),
+            self.context.session is not None)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""CPU mining with the reference solver on a machine without pyopencl
+
+Run by: python -m unittest test_cli
+"""
+import asyncio
+import json
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# Runs the miner as 'python -m pyzcm' would, pyopencl can't be imported
+MINER_CODE = "import sys; sys.modules['pyopencl'] = None; " \
+             "from pyzcm.__main__ import main; main()"
+# How long the miner may take to connect
+CONNECT_TIMEOUT = 30
+
+
+class TestCpuOnly(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.cache = tempfile.TemporaryDirectory()
+        self.requests = []
+        self.subscribed = asyncio.Event()
+
+    def tearDown(self):
+        self.loop.close()
+        self.cache.cleanup()
+
+    async def handle_client(self, reader, writer):
+        while True:
+            try:
+                data = await reader.readline()
+            except ConnectionError:
+                # latency probes of the miner
+                break
+            if data == b'':
+                break
+            msg = json.loads(data.decode())
+            self.requests.append(msg['method'])
+            result = [None, '01020304'] if msg['method'] == 'mining.subscribe' \
+                     else True
+            writer.write('{}\n'.format(json.dumps(
+                {'id': msg['id'], 'result': result, 'error': None})).encode())
+            if msg['method'] == 'mining.subscribe':
+                self.subscribed.set()
+        writer.close()
+
+    def run_miner(self, *args):
+        """Runs the miner until it subscribes to a stand-in pool
+
+        @return tuple (subscribed, exit code or None when still running,
+        output)
+        """
+        async def run():
+            listener = await asyncio.start_server(self.handle_client,
+                                                  '127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            miner = await asyncio.create_subprocess_exec(
+                sys.executable, '-c', MINER_CODE, *args,
+                'stratum+tcp://user:x@127.0.0.1:{}'.format(port),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = self.loop.create_task(miner.stdout.read())
+            exited = self.loop.create_task(miner.wait())
+            await asyncio.wait([exited, self.loop.create_task(
+                self.subscribed.wait())], timeout=CONNECT_TIMEOUT,
+                               return_when=asyncio.FIRST_COMPLETED)
+            returncode = miner.returncode
+            if returncode is None:
+                miner.kill()
+            await exited
+            listener.close()
+            await listener.wait_closed()
+            return (self.subscribed.is_set(), returncode,
+                    (await output).decode())
+        return self.loop.run_until_complete(run())
+
+    def test_reference_solver(self):
+        (subscribed, returncode, output) = self.run_miner(
+            '-g', '-1', '-c', '1', '-s', 'cpu=reference',
+            '--solver-cache', '{}/solvers.json'.format(self.cache.name))
+        self.assertIsNone(returncode, output)
+        self.assertTrue(subscribed, output)
+        self.assertEqual(self.requests[:2], ['mining.authorize',
+                                             'mining.subscribe'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Resuming of a stratum session handed over by another process
+
+Run by: python -m unittest test_handover
+"""
+import asyncio
+import json
+import logging
+import socket
+import unittest
+
+from pyzcm import Server
+from pyzcm.stratum import StratumClient
+from teststubs import MinerManagerStub
+
+
+def get_session(sock, buffer, pending):
+    return {'socket': sock, 'buffer': buffer, 'msg_id': max(pending),
+            'pending': pending, 'nonce1': '01020304', 'target': None,
+            'notify': None, 'worker_names': {}, 'worker_targets': {},
+            'suggested_target': None}
+
+
+class TestResumeSession(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        (self.sock, self.peer) = socket.socketpair()
+
+    def tearDown(self):
+        self.peer.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        self.loop.close()
+
+    def resume(self, session):
+        """Resumes the session until the connection is closed by the peer
+
+        @return tuple (exception raised by connect(), the client)
+        """
+        client = StratumClient(self.loop, Server.from_url(
+            'stratum+tcp://user:x@localhost:3333'), MinerManagerStub())
+
+        async def run():
+            connect = self.loop.create_task(client.connect(session))
+            # let the client process the buffered data
+            await asyncio.sleep(0.1)
+            self.peer.shutdown(socket.SHUT_WR)
+            try:
+                await asyncio.wait_for(connect, 5)
+            except Exception as e:
+                return e
+        return (self.loop.run_until_complete(run()), client)
+
+    def test_buffered_response_to_pending_request(self):
+        response = {'id': 5, 'result': True, 'error': None}
+        with self.assertLogs('pyzcm.stratum.StratumClient',
+                             logging.INFO) as logs:
+            (e, client) = self.resume(get_session(
+                self.sock, '{}\n'.format(json.dumps(response)), [5]))
+        self.assertEqual(str(e), 'Server closed connection.')
+        self.assertTrue(client.established)
+        self.assertTrue(any('Response to request 5 of the previous process'
+                            in line for line in logs.output))
+
+    def test_buffered_response_to_unknown_request(self):
+        response = {'id': 7, 'result': True, 'error': None}
+        with self.assertLogs('pyzcm.stratum.StratumNotifier',
+                             logging.WARNING) as logs:
+            (e, client) = self.resume(get_session(
+                self.sock, '{}\n'.format(json.dumps(response)), [5]))
+        self.assertEqual(str(e), 'Server closed connection.')
+        self.assertTrue(any('unknown request: 7' in line
+                            for line in logs.output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""TLS session resumption and certificate pinning against the stand-in
+pool (requires the openssl tool)
+
+Run by: python -m unittest test_tls
+"""
+import asyncio
+import shutil
+import tempfile
+import unittest
+
+from pyzcm import Server
+from pyzcm.stratum import StratumClient
+from pyzcm.tls import TlsPinningError
+from teststubs import MinerManagerStub
+from tlspool import TlsStandInPool, generate_certificate, \
+    get_fingerprint
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is not available')
+class TestTls(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.TemporaryDirectory()
+        (self.cert, key) = generate_certificate(self.path.name)
+        self.loop = asyncio.new_event_loop()
+        self.pool = TlsStandInPool(self.loop, self.cert, key)
+        self.listener = self.loop.run_until_complete(self.pool.start(0))
+        port = self.listener.sockets[0].getsockname()[1]
+        self.url = 'stratum+ssl://user:x@localhost:{}'.format(port)
+
+    def tearDown(self):
+        self.listener.close()
+        self.loop.run_until_complete(self.listener.wait_closed())
+        self.loop.close()
+        self.path.cleanup()
+
+    def connect(self, server):
+        """Establishes a session and closes it
+
+        @return exception raised when establishing the session
+        """
+        client = StratumClient(self.loop, server, MinerManagerStub())
+
+        async def run():
+            connect = self.loop.create_task(client.connect())
+            for i in range(50):
+                if client.established or connect.done():
+                    break
+                await asyncio.sleep(0.1)
+            if not connect.done():
+                client.close()
+            try:
+                await asyncio.wait_for(connect, 5)
+            except Exception as e:
+                return None if client.established else e
+        return self.loop.run_until_complete(run())
+
+    def test_session_resumed(self):
+        server = Server.from_url(self.url)
+        server.set_tls_options(self.cert, True, [get_fingerprint(self.cert)])
+        self.assertIsNone(self.connect(server))
+        self.assertIsNone(self.connect(server))
+        self.assertEqual(self.pool.resumed, [False, True])
+        self.assertEqual(server.stats.resumed_count, 1)
+
+    def test_wrong_pin_rejected(self):
+        server = Server.from_url(self.url)
+        server.set_tls_options(self.cert, True, ['00' * 32])
+        self.assertIsInstance(self.connect(server), TlsPinningError)
+
+
+if __name__ == '__main__':
+    unittest.main()
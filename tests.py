@@ -4,6 +4,8 @@ from pyzceqsolver import Solver
 import binascii
 from hashlib import sha256
 
+from pyzcm.equihash import verify_solutions
+
 def main():
     vectors = (
         {
@@ -32,6 +34,9 @@ def main():
         print("Testing block %s" % v['hash'])
         header = binascii.unhexlify(v['block'])[:140]
         solution = binascii.unhexlify(v['block'])[143:143+1344]
+        if not verify_solutions(header, [solution])[0]:
+            raise Exception("Reference solution failed verification!")
+        print("Reference solution verified")
         sol_cnt = s.find_solutions(header)
 
         for i in range(sol_cnt):
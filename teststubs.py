@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""Stand-ins of miner objects shared by the tests"""
+
+
+class MinerManagerStub(object):
+    """Minimal MinerManager for establishing or resuming a stratum
+    session"""
+    def __init__(self):
+        self.nonce1 = None
+        self.worker_targets = {}
+        self.jobs = []
+
+    def get_workers(self):
+        return []
+
+    def reset_worker_targets(self):
+        self.worker_targets = {}
+
+    def set_worker_target(self, worker, target):
+        self.worker_targets[worker] = target
+
+    def set_nonce(self, nonce1):
+        self.nonce1 = nonce1
+
+    def register_new_job(self, job, on_share):
+        self.jobs.append(job)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Stand-in stratum pool with TLS for testing TLS connections
+
+Used by test_tls, it is not part of the package. 'python tlspool.py'
+serves the stratum subset used by StratumClient (mining.subscribe,
+mining.authorize, mining.set_target, mining.notify and mining.submit -
+every share is accepted) over TLS with a self-signed certificate for
+localhost. The certificate is generated by the openssl tool unless
+'--cert' and '--key' are given, its SHA256 fingerprint is printed for
+'--tls-pin'.
+
+The pool reports the TLS version of each connection and whether the
+session has been resumed. '--close-after' closes the connections after
+the given time so that the miner reconnects - the second connection
+should resume the session:
+
+    pyzcm -g -1 -c 1 -s cpu=fake --tls-ca-file CERT stratum+ssl://user:x@localhost:3334
+
+A pin of a different fingerprint ('--tls-pin localhost=00...') has to
+be rejected by the miner.
+
+(c) 2016 Jan Čapek (honzik666)
+
+MIT license
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import ssl
+import subprocess
+import tempfile
+
+from pyzcm.tls import cert_fingerprint
+
+TLS_POOL_PORT = 3334
+# Period of new jobs
+JOB_PERIOD = 10
+# Target of the shares, every solution is a share
+POOL_TARGET = 'ff' * 32
+
+
+def generate_certificate(path, host='localhost'):
+    """Generates a self-signed certificate for the host by the openssl
+    tool
+
+    @return tuple (certificate file, key file)
+    """
+    cert = os.path.join(path, 'cert.pem')
+    key = os.path.join(path, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-days', '30', '-subj', '/CN={}'.format(host),
+                    '-addext', 'subjectAltName=DNS:{}'.format(host),
+                    '-keyout', key, '-out', cert],
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return (cert, key)
+
+
+def get_fingerprint(cert):
+    with open(cert) as f:
+        return cert_fingerprint(ssl.PEM_cert_to_DER_cert(f.read()))
+
+
+class TlsStandInPool(object):
+    log = logging.getLogger('{0}.{1}'.format(__name__, 'TlsStandInPool'))
+
+    def __init__(self, loop, cert, key, close_after=None):
+        """
+        @param close_after - seconds after which the connections are
+        closed by the pool, None = never
+        """
+        self.loop = loop
+        self.close_after = close_after
+        # the same context issues and accepts the session tickets of all
+        # connections
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(cert, key)
+        self.job_count = 0
+        self.connection_count = 0
+        # TLS session resumed by each connection
+        self.resumed = []
+
+    def send(self, writer, msg):
+        writer.write('{}\n'.format(json.dumps(msg)).encode())
+
+    async def send_jobs(self, writer):
+        self.send(writer, {'id': None, 'method': 'mining.set_target',
+                           'params': [POOL_TARGET]})
+        while True:
+            self.job_count += 1
+            self.send(writer, {'id': None, 'method': 'mining.notify',
+                               'params': ['{:x}'.format(self.job_count),
+                                          '04000000', '00' * 32, '11' * 32,
+                                          '00' * 32,
+                                          '{:08x}'.format(self.job_count),
+                                          '0f0f0f1f', True]})
+            await asyncio.sleep(JOB_PERIOD)
+
+    async def handle_client(self, reader, writer):
+        self.connection_count += 1
+        n = self.connection_count
+        ssl_object = writer.get_extra_info('ssl_object')
+        self.resumed.append(ssl_object.session_reused)
+        self.log.warning('Connection {0}: {1}, session resumed: {2}'.format(
+            n, ssl_object.version(), ssl_object.session_reused))
+        jobs = None
+        if self.close_after is not None:
+            close = self.loop.call_later(self.close_after, self.close, n,
+                                         writer)
+        try:
+            while True:
+                data = await reader.readline()
+                if data == b'':
+                    break
+                msg = json.loads(data.decode())
+                if msg['method'] == 'mining.subscribe':
+                    result = [None, os.urandom(4).hex()]
+                    if jobs is None:
+                        jobs = self.loop.create_task(self.send_jobs(writer))
+                else:
+                    result = True
+                self.log.info('Connection {0}: {1}'.format(n, msg['method']))
+                self.send(writer, {'id': msg['id'], 'result': result,
+                                   'error': None})
+        except (OSError, ValueError) as e:
+            self.log.warning('Connection {0} failed: {1}'.format(n, e))
+        finally:
+            if self.close_after is not None:
+                close.cancel()
+            if jobs is not None:
+                jobs.cancel()
+            writer.close()
+
+    def close(self, n, writer):
+        self.log.warning('Connection {}: closing'.format(n))
+        writer.close()
+
+    async def start(self, port, host='localhost'):
+        return (await asyncio.start_server(self.handle_client, host, port,
+                                           ssl=self.context))
+
+
+def main():
+    """Serve stratum over TLS to a miner"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('-p', '--port', dest='port', default=TLS_POOL_PORT,
+                        type=int, help='Port to listen on')
+    parser.add_argument('--cert', dest='cert', default=None,
+                        help='Certificate file (PEM), a self-signed one is ' \
+                        'generated when omitted')
+    parser.add_argument('--key', dest='key', default=None,
+                        help='Private key file (PEM)')
+    parser.add_argument('--close-after', dest='close_after', default=None,
+                        type=float,
+                        help='Close connections after the given seconds')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
+
+    with tempfile.TemporaryDirectory() as path:
+        if args.cert is None:
+            try:
+                (args.cert, args.key) = generate_certificate(path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                parser.error('Cannot generate certificate: {}'.format(e))
+            # keep the certificate for --tls-ca-file of the miner
+            cert = os.path.join(tempfile.gettempdir(), 'pyzcm-tlspool.pem')
+            with open(args.cert) as f_in, open(cert, 'w') as f_out:
+                f_out.write(f_in.read())
+            print('Certificate: {}'.format(cert))
+        print('SHA256 fingerprint: {}'.format(get_fingerprint(args.cert)))
+
+        loop = asyncio.new_event_loop()
+        pool = TlsStandInPool(loop, args.cert, args.key, args.close_after)
+        loop.run_until_complete(pool.start(args.port))
+        print('Listening on localhost:{}'.format(args.port))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()